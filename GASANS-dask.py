@@ -15,10 +15,27 @@ import pandas as pd
 from pathlib import Path
 import lmfit as lmf
 import scipy.interpolate as scpint 
+import scipy.optimize as scpopt
 import dask.distributed as distributed
 import os
 import time
-from read_json_input import _read_json_input
+import hashlib
+import itertools
+import json
+import cProfile
+import contextlib
+import importlib.util
+import math
+import pickle
+import threading
+import traceback
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from read_json_input import _read_json_input, _read_json_section
+from sans_library import _interpolate_library, _interpolate_library_memmap, _open_library, _read_SANSFiles, _grid_key
+from sans_library import _cluster_profiles, _gram_index
+from executors import make_client, is_dask_client
+from executors import as_completed as client_as_completed
 
 
 def _intperp_chi2(sasdata, expdata, ddof=1):
@@ -38,6 +55,13 @@ def reduced_chi2(expected, model, sigma_exp, ddof=1):
 def unique_arr(arr):
     return (np.unique(arr).shape[0] == arr.shape[0])
 
+def unique_rows(ensembles):
+    """
+    unique_arr for every row of a (n_ens, ens_size) array at once
+    """
+    sorted_ensembles = np.sort(ensembles, axis=1)
+    return ~np.any(sorted_ensembles[:, 1:] == sorted_ensembles[:, :-1], axis=1)
+
 def probfitness_func(rchi2):
     """
     Alternative fitness function using squared values to properly select the fitness according to proximity to 1.0 
@@ -76,10 +100,10 @@ def _residual_lmf(pars, I, data=None, sigma=None):
     model = c*(np.array([wparms[n]*I[:,n] for n in range(I.shape[1])]).sum(axis=0)) + b
     
     #print(model.shape)
-    if np.all(data) == None:
+    if data is None:
         #print(I.shape)
         return model
-    elif np.all(sigma) == None:
+    elif sigma is None:
         return (model-data)
     else:
         return (model-data)/sigma
@@ -111,10 +135,368 @@ def gen_modelparams(ens_size, param_dict={})->None:
     return pars
     
     
-def fitness(set_data, expdata, ens_size, fitting_algorithm='Differential Evolution'):
+## fitting_algorithm names (lower case) that are solved exactly as a bounded linear least squares problem
+LINEAR_FITTING_ALGORITHMS = ('linear least squares', 'linear', 'bvls')
+
+## largest ensemble size whose bounded linear fits (batch and gram) are solved by enumerating the 2^ens_size free sets
+LINEAR_SUBSET_MAX_SIZE = 6
+
+def _is_linear_algorithm(fitting_algorithm):
+    return fitting_algorithm.lower() in LINEAR_FITTING_ALGORITHMS
+
+def _fit_linear_lsq(set_data, expected, sigma=None):
+    """
+    Exact solution of the ensemble fit c*sum(w_i*I_i) + b with sum(w_i) = 1.
+    The model is linear in the products a_i = c*w_i and b, so the fit is a bounded linear
+    least squares problem with a_i >= 0 and b free. c = sum(a_i) and w_i = a_i/c are recovered after.
+    Returns the coefficients a_i, the background b and the scipy OptimizeResult
+    """
+    I = set_data.reshape(expected.shape[0], -1)
+    if sigma is None:
+        sigma = np.ones_like(expected)
+        
+    design = np.hstack([I, np.ones((I.shape[0], 1))])/sigma[:, None]
+    lower_bounds = np.append(np.zeros(I.shape[1]), -np.inf)
+    lsq_fit = scpopt.lsq_linear(design, expected/sigma, bounds=(lower_bounds, np.inf), method='bvls')
+    
+    return lsq_fit.x[:-1], lsq_fit.x[-1], lsq_fit
+
+def _linear_params(coeffs, background):
+    """
+    Convert the linear coefficients a_i = c*w_i and b into the c, b, w1...wn parameters of gen_modelparams
+    """
+    scale = coeffs.sum()
+    weights = coeffs/scale if scale > 0 else np.zeros_like(coeffs)
+    params = {'c':scale, 'b':background}
+    params.update({f"w{nw}":weights[nw-1] for nw in range(1, coeffs.shape[0]+1, 1)})
+    return params
+
+def _fit_statistics(residuals, nvarys):
+    """
+    chi2 statistics as calculated by lmfit: reduced chi2 and the Akaike information criterion
+    """
+    ndata = residuals.shape[-1]
+    chisqr = np.power(residuals, 2).sum(axis=-1)
+    redchi = chisqr/(ndata-nvarys)
+    aic = ndata*np.log(np.maximum(chisqr, 1e-250)/ndata) + 2*nvarys
+    return redchi, aic
+
+def _param_names(ens_size, n_datasets=1):
+    """
+    Parameter names in the order of gen_modelparams: c, b, w1...wn
+    or c_1, b_1, ..., c_m, b_m, w1...wn for a joint fit of m datasets
+    """
+    if n_datasets == 1:
+        scale_names = ['c', 'b']
+    else:
+        scale_names = [f"{par}_{nd}" for nd in range(1, n_datasets+1, 1) for par in ('c', 'b')]
+    return scale_names + [f"w{nw}" for nw in range(1, ens_size+1, 1)]
+
+def _dataset_params(fit_pars, n_dataset, n_datasets=1):
+    """
+    c, b and weights of dataset n_dataset (from 0) of a joint fit, in the order of gen_modelparams
+    """
+    if n_datasets == 1:
+        return fit_pars
+    params = {'c':fit_pars[f"c_{n_dataset+1}"], 'b':fit_pars[f"b_{n_dataset+1}"]}
+    params.update({ky:val for ky, val in fit_pars.items() if ky.startswith('w')})
+    return params
+
+def _fit_linear_batch(ens_data, expected, sigma=None):
+    """
+    Exact linear fit of a whole set of ensembles at once.
+    ens_data: (n_ens, nq, ens_size) stacked scattering of the ensembles
+    expected, sigma: (nq,) experimental intensities and errors, or (n_ens, nq) for a different curve per ensemble
+    
+    The unconstrained problems are solved together with a stacked QR decomposition. When every a_i = c*w_i
+    is positive this is also the bounded solution, the remaining (and rank deficient) ensembles
+    are refit together with _bounded_lstsq_solve, or one by one with _fit_linear_lsq above LINEAR_SUBSET_MAX_SIZE.
+    Returns a dict of arrays with the same entries as fitness(); params is (n_ens, ens_size+2) ordered as _param_names
+    """
+    n_ens, nq, ens_size = ens_data.shape
+    expected = np.broadcast_to(expected, (n_ens, nq))
+    if sigma is None:
+        sigma = np.ones(nq)
+    sigma = np.broadcast_to(sigma, (n_ens, nq))
+    
+    design = np.concatenate([ens_data, np.ones((n_ens, nq, 1))], axis=2)/sigma[:, :, None]
+    qmat, rmat = np.linalg.qr(design)
+    rdiag = np.abs(np.diagonal(rmat, axis1=1, axis2=2))
+    full_rank = rdiag.min(axis=1) > (rdiag.max(axis=1)*nq*np.finfo(float).eps)
+    
+    coeffs = np.zeros((n_ens, ens_size+1))
+    rhs = np.einsum('nqk,nq->nk', qmat, expected/sigma)
+    coeffs[full_rank] = np.linalg.solve(rmat[full_rank], rhs[full_rank, :, None])[:, :, 0]
+    
+    success = np.ones(n_ens, dtype=bool)
+    nfev = np.ones(n_ens, dtype=int)
+    refit = np.where(~full_rank | np.any(coeffs[:, :-1] <= 0, axis=1))[0]
+    if ens_size <= LINEAR_SUBSET_MAX_SIZE:
+        ## |design x - y|^2 = |R x - Q^T y|^2 + const, the subsets are solved on the small triangular systems
+        coeffs[refit] = _bounded_lstsq_solve(rmat[refit], rhs[refit])
+        refit = refit[:0]
+    for nrefit in refit:
+        coeffs[nrefit, :-1], coeffs[nrefit, -1], lsq_fit = _fit_linear_lsq(ens_data[nrefit], expected[nrefit], sigma[nrefit])
+        success[nrefit] = lsq_fit.success
+        nfev[nrefit] = lsq_fit.nit
+    
+    model = np.einsum('nqk,nk->nq', ens_data, coeffs[:, :-1]) + coeffs[:, -1:]
+    residuals = (model-expected)/sigma
+    redchi, aic = _fit_statistics(residuals, ens_size+1)
+    
+    scale = coeffs[:, :-1].sum(axis=1)
+    weights = np.divide(coeffs[:, :-1], scale[:, None], out=np.zeros((n_ens, ens_size)), where=(scale[:, None] > 0))
+    
+    return {'success':success, 'nfev':nfev, 'chi2':redchi, 'aic':aic,
+            'params':np.column_stack([scale, coeffs[:, -1], weights]),
+            'model':model, 'residuals':residuals}
+
+def _bounded_lstsq_solve(design, target):
+    """
+    Non-negative coefficients (all but the last, the background) minimizing |design x - target|^2 for a set of
+    small problems at once, design (n_sys, n_rows, n_coeffs) and target (n_sys, n_rows). As in _bounded_gram_solve,
+    the bounded minimum is the best non-negative least squares solution over the 2^ens_size subsets of free
+    coefficients; the subsets are solved on the design itself (or its R factor), not on the normal equations
+    """
+    n_sys, n_rows, n_coeffs = design.shape
+    best = np.zeros((n_sys, n_coeffs))
+    best_objective = np.full(n_sys, np.inf)
+    for free_weights in itertools.product((False, True), repeat=n_coeffs-1):
+        free = np.array(free_weights + (True,))
+        coeffs = np.zeros((n_sys, n_coeffs))
+        coeffs[:, free] = (np.linalg.pinv(design[:, :, free])@target[:, :, None])[:, :, 0]
+        objective = np.power(np.einsum('nqk,nk->nq', design, coeffs)-target, 2).sum(axis=1)
+        better = np.all(coeffs[:, :-1] >= 0, axis=1) & (objective < best_objective)
+        best[better] = coeffs[better]
+        best_objective[better] = objective[better]
+    return best
+
+def _bounded_gram_solve(normal, rhs):
+    """
+    Non-negative coefficients (all but the last, the background) minimizing x^T normal x - 2 x^T rhs for a set of
+    small systems at once. The minimum of the bounded problem is the best of the unconstrained minima over every
+    subset of free coefficients that is non-negative, there are 2^ens_size subsets.
+    """
+    n_sys, n_coeffs = rhs.shape
+    best = np.zeros((n_sys, n_coeffs))
+    best_objective = np.full(n_sys, np.inf)
+    for free_weights in itertools.product((False, True), repeat=n_coeffs-1):
+        free = np.array(free_weights + (True,))
+        coeffs = np.zeros((n_sys, n_coeffs))
+        coeffs[:, free] = (np.linalg.pinv(normal[:, free][:, :, free])@rhs[:, free, None])[:, :, 0]
+        objective = np.einsum('nk,nkl,nl->n', coeffs, normal, coeffs) - 2*np.einsum('nk,nk->n', coeffs, rhs)
+        better = np.all(coeffs[:, :-1] >= 0, axis=1) & (objective < best_objective)
+        best[better] = coeffs[better]
+        best_objective[better] = objective[better]
+    return best
+
+def _fit_linear_gram(ensembles, index):
+    """
+    Linear fit of a set of ensembles (rows of conformer indices) from the inner products of _gram_index:
+    the normal equations of c*sum(w_i*I_i) + b are the (ens_size+1) square system of the gram entries of the
+    ensemble, so the cost does not depend on the number of q values. Ensembles with a negative (or no unique)
+    solution are refit with the bounded problem on the square root of their system.
+    Returns the success, nfev, chi2, aic and params of _fit_linear_batch, without the model and residuals
+    """
+    n_ens, ens_size = ensembles.shape
+    normal = np.zeros((n_ens, ens_size+1, ens_size+1))
+    normal[:, :ens_size, :ens_size] = index['gram'][ensembles[:, :, None], ensembles[:, None, :]]
+    normal[:, :ens_size, ens_size] = index['profile_flat'][ensembles]
+    normal[:, ens_size, :ens_size] = index['profile_flat'][ensembles]
+    normal[:, ens_size, ens_size] = index['flat_flat']
+    rhs = np.column_stack([index['profile_target'][ensembles], np.full(n_ens, index['target_flat'])])
+    
+    ## cond(normal) = cond(design)^2 is lost in rounding long before that of the design, ill-conditioned systems
+    ## go to the bounded solver
+    full_rank = np.linalg.cond(normal) < 1.0/(index['nq']*np.finfo(float).eps)
+    coeffs = np.zeros((n_ens, ens_size+1))
+    coeffs[full_rank] = np.linalg.solve(normal[full_rank], rhs[full_rank, :, None])[:, :, 0]
+    
+    success = np.ones(n_ens, dtype=bool)
+    nfev = np.ones(n_ens, dtype=int)
+    refit = np.where(~full_rank | np.any(coeffs[:, :-1] <= 0, axis=1))[0]
+    if ens_size <= LINEAR_SUBSET_MAX_SIZE:
+        coeffs[refit] = _bounded_gram_solve(normal[refit], rhs[refit])
+        refit = refit[:0]
+    lower_bounds = np.append(np.zeros(ens_size), -np.inf)
+    for nrefit in refit:
+        ## |design x - y|^2 = |root x - t|^2 + const with normal = root^T root and root^T t = rhs
+        eigvals, eigvecs = np.linalg.eigh(normal[nrefit])
+        keep = eigvals > eigvals.max()*np.finfo(float).eps*index['nq']
+        root = np.sqrt(eigvals[keep])[:, None]*eigvecs[:, keep].T
+        lsq_fit = scpopt.lsq_linear(root, (eigvecs[:, keep].T@rhs[nrefit])/np.sqrt(eigvals[keep]),
+                                    bounds=(lower_bounds, np.inf), method='bvls')
+        coeffs[nrefit] = lsq_fit.x
+        success[nrefit] = lsq_fit.success
+        nfev[nrefit] = lsq_fit.nit
+    
+    chisqr = index['target_target'] - 2*np.einsum('nk,nk->n', coeffs, rhs) + np.einsum('nk,nkl,nl->n', coeffs, normal, coeffs)
+    ndata, nvarys = index['nq'], ens_size+1
+    redchi = np.maximum(chisqr, 0)/(ndata-nvarys)
+    aic = ndata*np.log(np.maximum(chisqr, 1e-250)/ndata) + 2*nvarys
+    
+    scale = coeffs[:, :-1].sum(axis=1)
+    weights = np.divide(coeffs[:, :-1], scale[:, None], out=np.zeros((n_ens, ens_size)), where=(scale[:, None] > 0))
+    return {'success':success, 'nfev':nfev, 'chi2':redchi, 'aic':aic,
+            'params':np.column_stack([scale, coeffs[:, -1], weights])}
+
+def _fit_linear_joint_batch(ens_data, expected, sigma, dataset_slices, n_als=100, tol=1e-9):
+    """
+    Joint linear fit of several datasets with shared weights, I_d = c_d*sum(w_i*P_di) + b_d, for a set of ensembles.
+    ens_data: (n_ens, nq, ens_size) scattering of the ensembles at the q values of all datasets one after the other
+    expected, sigma: (nq,) experimental intensities and errors, or (n_ens, nq) for a different curve per ensemble
+    dataset_slices: slice of the q values of each dataset, in order
+    
+    Alternating least squares started from the mean of the weights fit to each dataset alone: c_d and b_d in closed form
+    for fixed weights, then the weights for fixed c_d and b_d (non-negative least squares when a weight is negative).
+    Rank deficient systems (e.g. the same profile twice in an ensemble) are solved one by one with lstsq and nnls.
+    Returns the dict of _fit_linear_batch, params ordered as _param_names(ens_size, len(dataset_slices))
+    """
+    n_ens, nq, ens_size = ens_data.shape
+    n_datasets = len(dataset_slices)
+    if sigma is None:
+        sigma = np.ones(nq)
+    expected = np.broadcast_to(expected, (n_ens, nq))
+    sigma = np.broadcast_to(sigma, (n_ens, nq))
+    weighted = ens_data/sigma[:, :, None]
+    target = expected/sigma
+    inv_sigma = 1.0/sigma
+    
+    weights = np.mean([_fit_linear_batch(ens_data[:, dslice], expected[:, dslice], sigma[:, dslice])['params'][:, 2:]
+                       for dslice in dataset_slices], axis=0)
+    scale = np.zeros((n_ens, n_datasets))
+    background = np.zeros((n_ens, n_datasets))
+    success = np.zeros(n_ens, dtype=bool)
+    for nals in range(n_als):
+        ## c_d, b_d: 2 parameter least squares of the ensemble curve and a constant to each dataset
+        for nd, dslice in enumerate(dataset_slices):
+            curve = np.einsum('nqk,nk->nq', weighted[:, dslice], weights)
+            s_cc = np.power(curve, 2).sum(axis=1)
+            s_c1 = (curve*inv_sigma[:, dslice]).sum(axis=1)
+            s_11 = np.power(inv_sigma[:, dslice], 2).sum(axis=1)
+            s_cy = (curve*target[:, dslice]).sum(axis=1)
+            s_1y = (inv_sigma[:, dslice]*target[:, dslice]).sum(axis=1)
+            det = s_cc*s_11-np.power(s_c1, 2)
+            solvable = det > s_cc*s_11*nq*np.finfo(float).eps
+            scale[solvable, nd] = (s_cy*s_11-s_c1*s_1y)[solvable]/det[solvable]
+            background[solvable, nd] = (s_cc*s_1y-s_c1*s_cy)[solvable]/det[solvable]
+            for nsingular in np.where(~solvable)[0]:
+                scale[nsingular, nd], background[nsingular, nd] = np.linalg.lstsq(
+                    np.column_stack([curve[nsingular], inv_sigma[nsingular, dslice]]), target[nsingular, dslice], rcond=None)[0]
+        
+        ## weights: least squares of sum_d |c_d*P_d w - (I_d - b_d)|^2 with w >= 0, normalized with the scale in c_d
+        design = np.concatenate([scale[:, nd, None, None]*weighted[:, dslice] for nd, dslice in enumerate(dataset_slices)], axis=1)
+        rhs = np.concatenate([target[:, dslice]-background[:, nd, None]*inv_sigma[:, dslice]
+                              for nd, dslice in enumerate(dataset_slices)], axis=1)
+        gram = np.einsum('nqk,nql->nkl', design, design)
+        full_rank = np.linalg.cond(gram) < 1.0/(nq*np.finfo(float).eps)
+        new_weights = np.zeros((n_ens, ens_size))
+        new_weights[full_rank] = np.linalg.solve(gram[full_rank], np.einsum('nqk,nq->nk', design[full_rank], rhs[full_rank])[:, :, None])[:, :, 0]
+        for nneg in np.where(~full_rank | np.any(new_weights < 0, axis=1))[0]:
+            new_weights[nneg] = scpopt.nnls(design[nneg], rhs[nneg])[0]
+        total = new_weights.sum(axis=1)
+        new_weights = np.divide(new_weights, total[:, None], out=np.zeros_like(new_weights), where=(total[:, None] > 0))
+        scale *= total[:, None]
+        
+        success = np.abs(new_weights-weights).max(axis=1) < tol
+        weights = new_weights
+        if np.all(success):
+            break
+    
+    model = np.concatenate([scale[:, nd, None]*np.einsum('nqk,nk->nq', ens_data[:, dslice], weights) + background[:, nd, None]
+                            for nd, dslice in enumerate(dataset_slices)], axis=1)
+    residuals = (model-expected)/sigma
+    ## c_d, b_d of every dataset and n-1 weights
+    redchi, aic = _fit_statistics(residuals, 2*n_datasets+ens_size-1)
+    return {'success':success, 'nfev':np.full(n_ens, nals+1), 'chi2':redchi, 'aic':aic,
+            'params':np.column_stack([np.column_stack([scale[:, nd], background[:, nd]]) for nd in range(n_datasets)] + [weights]),
+            'model':model, 'residuals':residuals}
+
+def _fit_linear_datasets(ens_data, expected, sigma=None, dataset_slices=None):
+    """
+    _fit_linear_batch, or _fit_linear_joint_batch for several datasets
+    """
+    if (dataset_slices is None) or (len(dataset_slices) == 1):
+        return _fit_linear_batch(ens_data, expected, sigma)
+    return _fit_linear_joint_batch(ens_data, expected, sigma, dataset_slices)
+
+def _bootstrap_fits(ens_data, expected, sigma, n_boot=200, method='error', rng=None, dataset_slices=None):
+    """
+    Bootstrap replicates of the linear fits of a set of ensembles, all fit in one _fit_linear_datasets batch.
+    ens_data: (n_ens, nq, ens_size) stacked scattering of the ensembles, expected, sigma: (nq,)
+    method 'error': intensities resampled from their errors, I + sigma*N(0,1)
+           'q': q points resampled with replacement (within each dataset)
+    Returns the fit dict of _fit_linear_batch with (n_ens, n_boot, ...) arrays
+    """
+    rng = np.random.default_rng(rng)
+    n_ens, nq, ens_size = ens_data.shape
+    if method == 'error':
+        replicate_data = np.broadcast_to(ens_data[:, None], (n_ens, n_boot, nq, ens_size))
+        replicate_expected = expected + sigma*rng.standard_normal((n_ens, n_boot, nq))
+        replicate_sigma = np.broadcast_to(sigma, (n_ens, n_boot, nq))
+    elif method == 'q':
+        dslices = dataset_slices if (dataset_slices is not None) else [slice(0, nq)]
+        resample = np.concatenate([rng.integers(dslice.start, dslice.stop, (n_ens, n_boot, dslice.stop-dslice.start))
+                                   for dslice in dslices], axis=2)
+        replicate_data = np.take_along_axis(ens_data[:, None], resample[:, :, :, None], axis=2)
+        replicate_expected = expected[resample]
+        replicate_sigma = sigma[resample]
+    else:
+        raise ValueError(f"bootstrap_method must be 'error' or 'q', not {method}")
+    
+    fits = _fit_linear_datasets(replicate_data.reshape(n_ens*n_boot, nq, ens_size), replicate_expected.reshape(n_ens*n_boot, nq),
+                                replicate_sigma.reshape(n_ens*n_boot, nq), dataset_slices)
+    return {ky:val.reshape((n_ens, n_boot) + val.shape[1:]) for ky, val in fits.items()}
+
+def _bootstrap_intervals(bootstrap, param_names, confidence=0.95):
+    """
+    Lower and upper confidence bounds of the parameters and the chi2 of the bootstrap replicates of one ensemble,
+    as {par}_low, {par}_high, chi2_low, chi2_high
+    """
+    quantiles = [(1-confidence)/2, (1+confidence)/2]
+    params_low, params_high = np.quantile(bootstrap['params'], quantiles, axis=0)
+    chi2_low, chi2_high = np.quantile(bootstrap['chi2'], quantiles)
+    intervals = {'chi2_low':chi2_low, 'chi2_high':chi2_high}
+    for npar, par in enumerate(param_names):
+        intervals[f'{par}_low'] = params_low[npar]
+        intervals[f'{par}_high'] = params_high[npar]
+    return intervals
+
+def _stack_fitresults(mfit_array, ens_size, named_params=True, n_datasets=1):
+    """
+    Stack a list of fitness() result dicts into the arrays returned by _fit_linear_batch
+    named_params: params of each fit are a dict (fitness) rather than an array ordered as _param_names
+    """
+    names = _param_names(ens_size, n_datasets)
+    if named_params:
+        params = np.array([[fit['params'][ky] for ky in names] for fit in mfit_array])
+    else:
+        params = np.vstack([fit['params'] for fit in mfit_array])
+    return {'success':np.array([fit['success'] for fit in mfit_array]),
+            'nfev':np.array([fit['nfev'] for fit in mfit_array]),
+            'eval_time':np.array([fit['eval_time'] for fit in mfit_array], dtype=float),
+            'chi2':np.array([fit['chi2'] for fit in mfit_array]),
+            'aic':np.array([fit['aic'] for fit in mfit_array]),
+            'params':params,
+            'model':np.vstack([fit['model'] for fit in mfit_array]),
+            'residuals':np.vstack([fit['residuals'] for fit in mfit_array])}
+
+def _warm_start_valid(params, cut_weight):
+    """
+    Local fit from a warm start is kept when every weight is within (cut_weight, 1]
+    """
+    weights = np.array([params[ky] for ky in params.keys() if ky.startswith('w')])
+    return np.all(weights >= cut_weight) and np.all(weights <= 1.0)
+
+def fitness(set_data, expdata, ens_size, fitting_algorithm='Differential Evolution',
+            init_params=None, local_method='leastsq', cut_weight=1e-6, dataset_slices=None):
     """
     Perform the fit to the experimental data
     Save the fit parameters and the chi2
+    fitting_algorithm: any lmfit method, or one of LINEAR_FITTING_ALGORITHMS for the exact linear solution
+    init_params: starting c, b and weights (dict) for a local_method fit, fitting_algorithm is only used
+                 when the local fit fails or has weights outside (cut_weight, 1]
+    dataset_slices: q values of each dataset for a joint linear fit of several datasets, see _fit_linear_joint_batch
     """
     fit_time_start = time.time()
         
@@ -125,8 +507,41 @@ def fitness(set_data, expdata, ens_size, fitting_algorithm='Differential Evoluti
     else:
         sigmaI = None
     
+    if _is_linear_algorithm(fitting_algorithm) and (dataset_slices is not None):
+        joint_fit = _fit_linear_joint_batch(set_data.reshape(1, expdata.shape[0], -1), expdata.iloc[:,1].values, sigmaI, dataset_slices)
+        result = {ky:joint_fit[ky][0] for ky in joint_fit.keys()}
+        result['params'] = dict(zip(_param_names(ens_size, len(dataset_slices)), result['params']))
+        result['eval_time'] = time.time() - fit_time_start
+        return result
+    
+    if _is_linear_algorithm(fitting_algorithm):
+        expected = expdata.iloc[:,1].values
+        coeffs, background, lsq_fit = _fit_linear_lsq(set_data, expected, sigmaI)
+        eval_model = set_data.reshape(expected.shape[0], -1)@coeffs + background
+        residuals = (eval_model-expected) if sigmaI is None else (eval_model-expected)/sigmaI
+        ## c, b and n-1 weights vary as in the lmfit parameters
+        redchi, aic = _fit_statistics(residuals, ens_size+1)
+        result = {'success':lsq_fit.success, 'nfev':lsq_fit.nit, 'eval_time':(time.time() - fit_time_start),
+                  'chi2':redchi, 'aic':aic, 'params':_linear_params(coeffs, background),
+                  'model':eval_model, 'residuals':residuals}
+        return result
+    
+    nfev_local = 0
+    if init_params is not None:
+        ## the last weight follows from the constraint, only the free parameters are started
+        for ky in list(mpars.keys())[:-1]:
+            mpars[ky].set(value=np.clip(init_params[ky], mpars[ky].min, mpars[ky].max))
+        local_fit = lmf.minimize(_residual_lmf, mpars, method=local_method, args=(set_data, ),
+                                 kws={'data':expdata.iloc[:,1].values, 'sigma':sigmaI})
+        nfev_local = local_fit.nfev
+        if local_fit.success and _warm_start_valid(local_fit.params.valuesdict(), cut_weight):
+            minimize_fit = local_fit
+        else:
+            init_params = None
+            mpars = gen_modelparams(ens_size)
     
-    minimize_fit = lmf.minimize(_residual_lmf, mpars,
+    if init_params is None:
+        minimize_fit = lmf.minimize(_residual_lmf, mpars,
                                     method=fitting_algorithm,
                                     args=(set_data, ),
                                     kws={'data':expdata.iloc[:,1].values,
@@ -138,17 +553,183 @@ def fitness(set_data, expdata, ens_size, fitting_algorithm='Differential Evoluti
     ## X2 is not the fitness here, the weight in choose_parents is so should be adjusted accordingly
     ## 
     #self.gen_fitness[self.curr_gen, data_index]  = minimize_fit.redchi
-    result = {'success':minimize_fit.success, 'nfev':minimize_fit.nfev, 'eval_time':(time.time() - fit_time_start), 
+    result = {'success':minimize_fit.success, 'nfev':minimize_fit.nfev+nfev_local, 'eval_time':(time.time() - fit_time_start), 
                 'chi2':minimize_fit.redchi, 'aic':minimize_fit.aic, 'params':minimize_fit.params.valuesdict(),
                   'model':eval_model, 'residuals':minimize_fit.residual}
         
     return result
 
+def fitness_indices(ensemble, library, expdata, ens_size, fitting_algorithm='Differential Evolution', init_params=None, **fitness_kws):
+    """
+    fitness() for an ensemble given by its conformer indices.
+    library is the (nConf, nq) interpolated library already on the worker, or the path of the memory-mapped library.
+    The ensemble scattering is built here 
+    """
+    if isinstance(library, str):
+        library = _open_library(library, os.stat(library).st_mtime_ns)
+    return fitness(np.asarray(library[ensemble, :].T, dtype=np.float64), expdata, ens_size, fitting_algorithm=fitting_algorithm,
+                   init_params=init_params, **fitness_kws)
+
+def fitness_warm_start(ensemble, init_params, library, expdata, ens_size, fitting_algorithm='Differential Evolution', **fitness_kws):
+    """
+    fitness_indices with the starting parameters of the ensemble as second argument, for client.map
+    """
+    return fitness_indices(ensemble, library, expdata, ens_size, fitting_algorithm=fitting_algorithm,
+                           init_params=init_params, **fitness_kws)
+
+def score_combinations(ensembles, library, expdata, ens_size, topk, fitness_func=invert_x2, cut_weight=0.0, dataset_slices=None,
+                       gram_index=None):
+    """
+    Linear fit of a chunk of ensembles (rows of conformer indices) for the exhaustive search.
+    library is the (nConf, nq) interpolated library or the path of the memory-mapped library,
+    the fits are scored from gram_index (see _gram_index) instead when it is given.
+    Returns the topk valid fits (every weight above cut_weight) by fitness_func(chi2): ensemble, fitness, chi2, aic, params
+    """
+    if gram_index is not None:
+        fits = _fit_linear_gram(ensembles, gram_index)
+    else:
+        if isinstance(library, str):
+            library = _open_library(library, os.stat(library).st_mtime_ns)
+        sigma = expdata['Error'].values if ("Error" in expdata.columns) else None
+        fits = _fit_linear_datasets(np.rollaxis(np.asarray(library[ensembles, :], dtype=np.float64), 2, 1),
+                                    expdata.iloc[:, 1].values, sigma, dataset_slices)
+    
+    valid = ~np.any(fits['params'][:, -ens_size:] < cut_weight, axis=1)
+    top = {'ensemble':ensembles[valid], 'fitness':fitness_func(fits['chi2'][valid]),
+           'chi2':fits['chi2'][valid], 'aic':fits['aic'][valid], 'params':fits['params'][valid]}
+    return _merge_topk(top, None, topk)
+
+def _merge_topk(top, chunk_top, topk):
+    """
+    Best topk by fitness of two score_combinations results (chunk_top can be None)
+    """
+    if chunk_top is not None:
+        top = {ky:np.concatenate([top[ky], chunk_top[ky]]) for ky in top.keys()}
+    keep = np.argsort(-top['fitness'], kind='stable')[:topk]
+    return {ky:top[ky][keep] for ky in top.keys()}
+
+
+class FitnessCache:
+    """
+    Size bounded cache of the ensemble fits, the least recently used fits are evicted first.
+    Keys are built by GAEnsembleOpt._fitness_key from the sorted conformer indices, the fitting options and
+    fingerprints of the library and the experimental data, so one cache can be shared over iterations, ensemble sizes
+    and runs with other options.
+    """
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self.fits = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+    
+    def get(self, key):
+        fit = self.fits.get(key)
+        if fit is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.fits.move_to_end(key)
+        return fit
+    
+    def put(self, key, fit):
+        self.fits[key] = fit
+        self.fits.move_to_end(key)
+        while len(self.fits) > self.max_size:
+            self.fits.popitem(last=False)
+    
+    def clear(self):
+        self.fits.clear()
+    
+    def __len__(self):
+        return len(self.fits)
+
+
+class WorkerData:
+    """
+    Data broadcast to the workers of a client, shared by every GAEnsembleOpt that scatters the same data to the same
+    client (e.g. the concurrent ensemble sizes of __main__). Keys are a hash of the data; the futures are counted
+    and cancelled on the workers when the last user releases them. The data is scattered without hashing: dask would
+    give the same data the same key, and a cancel still on its way to the scheduler would drop a new scatter of it
+    """
+    def __init__(self):
+        self.futures = {}
+        self.lock = threading.Lock()
+    
+    def scatter(self, client, key, data):
+        with self.lock:
+            entry = self.futures.get((id(client), key))
+            if entry is None:
+                entry = self.futures[(id(client), key)] = {'future':client.scatter(data, broadcast=True, hash=False), 'users':0}
+            entry['users'] += 1
+            return entry['future']
+    
+    def release(self, client, key):
+        with self.lock:
+            entry = self.futures.get((id(client), key))
+            if entry is None:
+                return None
+            entry['users'] -= 1
+            if entry['users'] == 0:
+                del self.futures[(id(client), key)]
+                client.cancel([entry['future']])
+    
+    def __len__(self):
+        return len(self.futures)
+
+_WORKER_DATA = WorkerData()
+
+## one cProfile profiler at a time for the ensemble sizes running in threads
+_PROFILE_LOCK = threading.Lock()
+
+
 class GAEnsembleOpt:
     """
     Class for the genetic algorithm. It is initiaed with the calculated ensembe data and the experimental data to validate against.
 
     parallel: should really always be true and can be the default even on one core. 
+    batch_evaluation: with a linear fitting_algorithm, fit the whole generation at once with _fit_linear_batch
+    fitness_cache_size: number of ensemble fits kept in the FitnessCache, 0 turns the cache off
+    persist_fitness_cache: keep the cached fits over the iterations, otherwise the cache is cleared every iteration
+    fitness_cache: FitnessCache to use instead of a new one, e.g. to share the fits between ensemble sizes
+    interpolation_cache_dir: directory to cache the operator interpolating the library to the experimental q values
+    library_backend: 'memory' or 'memmap', keep the interpolated library in memory or in the memory-mapped library_file
+    library_dtype: precision of the interpolated library, 'float64' or 'float32'
+    library_file: .npy file for the memmap backend, shared by the dask workers. By default interp_library_{key}_{nConf}_{dtype}.npy
+                  in the working directory, keyed by the profiles and the q values and reused by every ensemble size
+    random_seed: seed of the random number generator for the genetic algorithm operators
+    n_clusters: cluster the interpolated profiles and run the genetic algorithm over the n_clusters medoids
+    refine_clusters: after the run over the medoids, evolve again over the members of the clusters in the best ensembles
+    data, exp_data: a library and its experiment, or lists of them (e.g. contrasts) fit jointly with shared weights
+                    and a scale and background per dataset (linear fitting only)
+    seed_ensembles: best ensembles of a smaller size (e.g. top_ensembles of the previous size), the first seed_fraction
+                    of the initial parents extend them with conformers of the seed_candidates best ranked, the rest are random
+    q_reduction: fit on the experiments rebinned to n_q q values ('rebin') or to q_oversampling points per Shannon channel
+                 of a particle of maximal dimension dmax ('shannon'); the best model is scored again on the full data
+    search_mode: 'ga' for the genetic algorithm or 'exhaustive' to fit every ensemble of the conformers with the linear
+                 fit, in chunks of exhaustive_chunksize on the workers, keeping the exhaustive_topk best
+    convergence_generations: stop an iteration when its best has not improved for this many generations
+    convergence_tolerance: relative chi2 change of the best below which a generation counts as not improved
+    min_diversity: stop an iteration when the fraction of distinct ensembles in a generation drops below it
+    time_budget: wall-clock seconds for evolve, the running iteration stops and no new iteration starts after it
+    iteration_agreement: stop the iterations once this many consecutive iterations find the same best ensemble
+                         (with island_model, once this many islands hold the same best ensemble)
+    warm_start: start the fits of the children with local_method from the weights of the previous generation,
+                fitting_algorithm is only run when the local fit is not valid (lmfit methods only)
+    telemetry_file: JSON lines file with one record of timings, fits and bests per generation
+    profile_generations: generations to profile with profile_mode 'cprofile' or 'dask' (performance report) into profile_dir
+    checkpoint_file: file the state of the run is saved to every checkpoint_interval generations, see load_checkpoint.
+                     With a results_file, the new fits are appended to {checkpoint_file}.history at every checkpoint
+    evolution_mode: 'generational', or 'steady_state' to keep steady_state_inflight fits (default twice the worker threads)
+                    running and breed a child as soon as a fit finishes, without waiting for the whole generation
+    gram_index: score the linear fits from the error weighted inner products of the profiles and the experiment
+                (_gram_index, in memory or memory-mapped from gram_index_file), independent of the number of q values.
+                Models and residuals are only computed for new bests. In-process fits of one dataset only
+    n_bootstrap: replicates of the experiment (bootstrap_method 'error': intensities resampled from their errors, 'q': q points
+                 resampled) refit with the linear fit for the bootstrap_confidence intervals of the best ensembles, 0 (default) for none
+    results_file: .npz file of every ensemble fit in the run with its parameters, chi2, aic, iteration and generation,
+                  written by save_results and read back with load_results or read_results
+    island_model: evolve the iterations at the same time as islands, with migration every migration_interval 
+                  generations (0 for none) of the n_migrants best ensembles
     method: how to choose and rank the fitness
     rank_prob: ranking probability 
     elitism: keep the top ranking child every iteration and do not crossover
@@ -158,7 +739,21 @@ class GAEnsembleOpt:
                  ensemble_size=2, number_generations=100, number_iterations=5,
                  ensemble_split=0.85, crossover_probability=0.5, mutation_probability=0.15, cutoff_weight=1e-6,
                  method="prob", rank_prob=0.8, fitness_function='inverse_absolute', fitting_algorithm='Differential Evolution',
-                 parallel=True, 
+                 parallel=True, batch_evaluation=True,
+                 fitness_cache_size=10000, persist_fitness_cache=True, fitness_cache=None,
+                 interpolation_cache_dir=None, library_backend='memory', library_dtype='float64', library_file=None,
+                 island_model=False, migration_interval=5, n_migrants=1,
+                 random_seed=None, n_clusters=None, refine_clusters=False,
+                 search_mode='ga', exhaustive_topk=10, exhaustive_chunksize=20000,
+                 convergence_generations=None, convergence_tolerance=0.0, min_diversity=0.0, time_budget=None,
+                 iteration_agreement=None, checkpoint_file=None, checkpoint_interval=10,
+                 telemetry_file=None, profile_generations=None, profile_mode='cprofile', profile_dir='.',
+                 warm_start=False, local_method='leastsq',
+                 q_reduction=None, n_q=None, dmax=None, q_oversampling=3,
+                 seed_ensembles=None, seed_fraction=0.5, seed_candidates=10,
+                 evolution_mode='generational', steady_state_inflight=None, results_file=None,
+                 n_bootstrap=0, bootstrap_method='error', bootstrap_confidence=0.95,
+                 gram_index=False, gram_index_file=None,
                  elitism=True, ):
         
         
@@ -176,55 +771,104 @@ class GAEnsembleOpt:
             self.invabsx2=False
 
         ## Definitions of the data to fit and 
-        self.data = data ## data should be in (nq, nConf) dataframe
-        self.experiment = exp_data.astype('float') ## should be a dataframe
-        self.indices = np.arange(0, data.shape[1], 1)
-        self.interp_data = self.data.T.apply(interpolate2exp,
-                                               axis=1,
-                                               expQ = self.experiment['Q'].values,
-                                               ) ## Will Return (nConf, nq) dataframe
+        ## lists of libraries and experiments are fit jointly, the experiments are put one after the other in q
+        self.data_list = list(data) if isinstance(data, (list, tuple)) else [data]
+        experiment_list = list(exp_data) if isinstance(exp_data, (list, tuple)) else [exp_data]
+        self.n_datasets = len(experiment_list)
+        self.data = self.data_list[0] ## data should be in (nq, nConf) dataframe
         
-        ## Eventually need to change if any of the general parameters are changed
-        remainder = (data.shape[1]*ensemble_split)%self.ens_size
-        if remainder != 0:
-            self.n_ens = int((int(data.shape[1]*ensemble_split)-remainder)/self.ens_size)
-            self.pool_size = int(data.shape[1]*ensemble_split-remainder)
+        ## fits on fewer q values, the best model is scored again on the full experiments
+        self.q_reduction = q_reduction
+        self.full_experiment_list = [exp.astype('float') for exp in experiment_list]
+        self.full_fit = [dict() for exp in experiment_list]
+        if q_reduction is not None:
+            experiment_list = [_reduce_qpoints(exp, q_reduction, n_q, dmax, q_oversampling) for exp in self.full_experiment_list]
+            print(f"Fitting {sum(exp.shape[0] for exp in experiment_list)} of the {sum(exp.shape[0] for exp in self.full_experiment_list)} q values", flush=True)
+        
+        if self.n_datasets == 1:
+            self.experiment = experiment_list[0].astype('float') ## should be a dataframe
+            self.dataset_slices = None
         else:
-            self.n_ens = int(data.shape[1]*ensemble_split/self.ens_size)
-            self.pool_size = int(data.shape[1]*ensemble_split)
+            if (len(self.data_list) != self.n_datasets) or any(dat.shape[1] != self.data.shape[1] for dat in self.data_list):
+                raise ValueError("Joint fits need one library of the same conformers for every experiment")
+            if not _is_linear_algorithm(fitting_algorithm):
+                raise ValueError(f"Joint fits of several datasets use 'Linear Least Squares', not {fitting_algorithm}")
+            if library_backend == 'memmap':
+                raise ValueError("The memmap library backend holds one dataset, use 'memory' for joint fits")
+            self.experiment = pd.concat([exp[['Q', 'I(Q)', 'Error']].astype('float') for exp in experiment_list], ignore_index=True)
+            self.experiment['dataset'] = np.repeat(np.arange(self.n_datasets), [exp.shape[0] for exp in experiment_list])
+            bounds = np.cumsum([0] + [exp.shape[0] for exp in experiment_list])
+            self.dataset_slices = [slice(bounds[nd], bounds[nd+1]) for nd in range(self.n_datasets)]
+        self.indices = np.arange(0, self.data.shape[1], 1)
         
-        ## must be even to divide into parents
-        if (self.n_ens%2)==1:
-            self.n_ens-=1
-            self.pool_size-=self.ens_size
+        ## interpolated library (nConf, nq) as an array, in memory or memory-mapped from library_file
+        self.library_backend = library_backend
+        self.library_dtype = np.dtype(library_dtype)
+        if library_backend == 'memmap':
+            ## the default file is keyed by the profiles, so the ensemble sizes of a run share one file built once
+            shared_library = library_file is None
+            if shared_library:
+                library_key = _grid_key(self.data.index.values, self.experiment['Q'].values, self.data.values)
+                library_file = Path(f"interp_library_{library_key}_{self.data.shape[1]}_{self.library_dtype.name}.npy")
+            self.library_file = Path(library_file)
+            if shared_library and self.library_file.exists():
+                self.interp_matrix = np.load(self.library_file, mmap_mode='r')
+            else:
+                self.interp_matrix = _interpolate_library_memmap(self.data.values, self.data.index.values,
+                                                                 self.experiment['Q'].values, self.library_file,
+                                                                 dtype=self.library_dtype, cache_dir=interpolation_cache_dir)
+        else:
+            self.library_file = None
+            self.interp_matrix = np.ascontiguousarray(np.hstack([_interpolate_library(dat.values, dat.index.values,
+                                                                                      self.experiment['Q'].values[dslice],
+                                                                                      cache_dir=interpolation_cache_dir)
+                                                                 for dat, dslice in zip(self.data_list, self._dataset_ranges())]),
+                                                      dtype=self.library_dtype)
         
-        #self.ens_indices = np.zeros((self.n_ens,self.ens_size))
-        print(self.data.shape[1], self.pool_size)
-        self.mut_indices = np.zeros((self.data.shape[1]-self.pool_size,1))
+        self.rng = np.random.default_rng(random_seed)
+        
+        ## inner products of the profiles for fits that do not depend on the number of q values
+        if gram_index:
+            if not _is_linear_algorithm(fitting_algorithm):
+                raise ValueError(f"The gram index scores the 'Linear Least Squares' fit, not {fitting_algorithm}")
+            if self.n_datasets > 1:
+                raise ValueError("The gram index holds one dataset, joint fits use the library")
+            sigmaI = self.experiment['Error'].values if ("Error" in self.experiment.columns) else None
+            self.gram = _gram_index(self.interp_matrix, self.experiment.iloc[:,1].values, sigmaI, index_file=gram_index_file)
+        else:
+            self.gram = None
+        
+        ## GA over representative conformers: cluster the profiles and sample only the medoids
+        self.n_clusters = n_clusters
+        self.refine_clusters = refine_clusters
+        self.cluster_labels = None
+        if n_clusters is not None:
+            sigmaI = self.experiment['Error'].values if ("Error" in self.experiment.columns) else None
+            self.cluster_medoids, self.cluster_labels = _cluster_profiles(self.interp_matrix, sigmaI, n_clusters, rng=self.rng)
+            self.indices = np.sort(self.cluster_medoids)
+            print(f"Clustered {self.data.shape[1]} conformers into {self.indices.shape[0]} representatives", flush=True)
         
         ## class attribute for the ensemble fitting 
         self.cut_weight = cutoff_weight
         
         ## class attributes for the ga algorithm
-        self.parents = np.zeros((self.n_ens, self.ens_size)) # set of indices ...
-        self.parent_pairs = np.zeros((int(self.n_ens/2),2,self.ens_size))
+        self.ens_split = ensemble_split
         self.elitism=elitism
         self.elite_child = [] ## for elitism 
-        self.children = np.zeros((self.n_ens, self.ens_size)) # set of indices ...
-                                 
-        self.gen_fitness = np.zeros((self.n_gen, self.n_ens))
-        self.gen_rchi2 = np.zeros((self.n_gen, self.n_ens))
-        self.gen_aic = np.zeros((self.n_gen, self.n_ens))
-        self.gen_residuals = np.zeros((self.n_ens, self.experiment.shape[0])) ## residuals per generation 
-        self.gen_models = np.zeros((self.n_ens, self.experiment.shape[0])) ## residuals per generation 
-
-        self.fitness_check = np.ones((self.n_ens, self.n_gen)) ## checks to see if the fit produces proper weights
+        self._set_population()
+        
         self.p_crossover = crossover_probability
         self.p_mutate = mutation_probability 
         
         ##convergence criteria
         self.gen_converged = False
         self.iter_converged = False
+        self.convergence_generations = convergence_generations
+        self.convergence_tolerance = convergence_tolerance
+        self.min_diversity = min_diversity
+        self.time_budget = time_budget
+        self.iteration_agreement = iteration_agreement
+        self.evolve_start_time = time.time()
         
         self.fitness_saturation = 0 ## count how many generations have the same minimum 
         self.pbest_rchi2 = {'chi2':0, 'aic':0, 'fitness':0,
@@ -240,68 +884,465 @@ class GAEnsembleOpt:
         ## average time to calculate the , total time spent doing the fitness calculation,
         ## time spent evaluating, time for validation, time updating for parents, crossovers, mutation
         ## fitness total ~= evaluation time
-        self.individual_fitness_time = np.zeros((self.n_ens,1))
         self.time_log={'fitness_ave':0.0, 'fitness_total':0.0, 'evaluation':0.0, 'validation':0.0, 
-                       'parents':0.0, 'crossover':0.0, 'mutation':0.0}
+                       'parents':0.0, 'crossover':0.0, 'mutation':0.0, 'cache_hits':0, 'cache_misses':0,
+                       'duplicate_ensembles':0}
+        
+        ## cache of the ensemble fits, keyed with the experiment and library fingerprints
+        self.exp_fingerprint = hashlib.sha1(np.ascontiguousarray(self.experiment.values)).hexdigest()
+        self.library_fingerprint = _grid_key(*[grid for dat in self.data_list for grid in (dat.index.values, dat.values)])
+        if fitness_cache is not None:
+            self.fitness_cache = fitness_cache
+        elif fitness_cache_size > 0:
+            self.fitness_cache = FitnessCache(fitness_cache_size)
+        else:
+            self.fitness_cache = None
+        self.persist_fitness_cache = persist_fitness_cache
 
         ## Parallel Options
         ## Fraction of CPUs we want to use? Maybe better to use a localcluster outside of the 
 
         self.parallel = parallel 
         
+        ## island model: iterations evolve together and exchange their best ensembles
+        self.island_model = island_model
+        
+        ## steady-state evolution: fits are consumed as they finish, with no generation barrier
+        if evolution_mode not in ('generational', 'steady_state'):
+            raise ValueError(f"evolution_mode must be 'generational' or 'steady_state', not {evolution_mode}")
+        if (evolution_mode == 'steady_state') and island_model:
+            raise ValueError("The island model evolves generations, it cannot run with the steady_state evolution")
+        if (evolution_mode == 'steady_state') and warm_start:
+            raise ValueError("warm_start starts the fits from the previous generation, the steady_state evolution has none")
+        self.evolution_mode = evolution_mode
+        self.steady_state_inflight = steady_state_inflight
+        self.migration_interval = migration_interval
+        self.n_migrants = n_migrants
+        self.island_attributes = ('curr_iter', 'curr_gen', 'gen_converged', 'fitness_saturation',
+                                  'parents', 'gen_parents', 'parent_pairs', 'children', 'elite_child', 'mut_indices',
+                                  'gen_fitness', 'gen_rchi2', 'gen_aic', 'gen_residuals', 'gen_models', 'gen_paramfit',
+                                  'individual_fitness_time', 'citbest_rchi2')
+        self.gen_parents = self.parents
+        self.gen_paramfit = None
+        
+        ## checkpoints: everything evolve needs to continue a run
+        self.checkpoint_file = checkpoint_file
+        self.checkpoint_interval = checkpoint_interval
+        self.checkpoint_attributes = self.island_attributes + ('iter_converged', 'pbest_rchi2', 'cbest_rchi2', 'itbest_rchi2',
+                                                               'time_log', 'indices', 'n_ens', 'pool_size',
+                                                               'cluster_labels', 'stage', 'representative_best')
+        self.stage = 'search' ## 'search', then 'refine' for the clusters and 'finished'
+        self.representative_best = None
+        self.resumed = False
+        self.resume_islands = None
+        
+        ## bootstrap of the best ensembles after the run
+        if bootstrap_method not in ('error', 'q'):
+            raise ValueError(f"bootstrap_method must be 'error' or 'q', not {bootstrap_method}")
+        self.n_bootstrap = n_bootstrap
+        self.bootstrap_method = bootstrap_method
+        self.bootstrap_confidence = bootstrap_confidence
+        
+        ## every evaluated ensemble, kept when the results are saved to results_file
+        self.results_file = results_file
+        self.history = []
+        ## the history is appended to the history spool of the checkpoint, not pickled with every checkpoint
+        self.history_saved = 0
+        self.history_offset = 0
+        
+        ## telemetry and profiling
+        self.telemetry_file = telemetry_file
+        self.profile_generations = profile_generations
+        self.profile_mode = profile_mode
+        if (profile_mode == 'dask') and (importlib.util.find_spec('bokeh') is None):
+            print("The dask performance report needs bokeh, profiling with cProfile instead", flush=True)
+            self.profile_mode = 'cprofile'
+        self.profile_dir = profile_dir
+        self.gen_nfev = 0
+        self.worker_library = None ## interpolated library (or its memmap file) and experiment on the dask workers
+        self.worker_experiment = None
+        self.worker_client = None
+        self.worker_keys = []
+        self.batch_evaluation = batch_evaluation
+        self.warm_start = warm_start
+        self.local_method = local_method
+        ## starting parameters of the parents of all islands, by sorted ensemble, while the islands are fit together
+        self.island_warm_starts = None
+        
+        ## exhaustive search of every ensemble
+        if search_mode not in ('ga', 'exhaustive'):
+            raise ValueError(f"search_mode must be 'ga' or 'exhaustive', not {search_mode}")
+        if (search_mode == 'exhaustive') and (not _is_linear_algorithm(fitting_algorithm)):
+            raise ValueError(f"The exhaustive search fits with 'Linear Least Squares', not {fitting_algorithm}")
+        self.search_mode = search_mode
+        
+        ## incremental ensemble sizes: start from the best ensembles of a smaller size
+        if (seed_ensembles is not None) and (len(seed_ensembles) > 0):
+            if np.asarray(seed_ensembles).reshape(len(seed_ensembles), -1).shape[1] > self.ens_size:
+                raise ValueError(f"The seed ensembles are larger than the ensemble size {self.ens_size}")
+            self.seed_ensembles = seed_ensembles
+        else:
+            self.seed_ensembles = None
+        self.seed_fraction = seed_fraction
+        self.seed_candidates = seed_candidates
+        self.exhaustive_topk = exhaustive_topk
+        self.exhaustive_chunksize = exhaustive_chunksize
+        
    
     
+    def _set_population(self):
+        """
+        Number of ensembles and pool size from the conformers in self.indices, and the arrays of the generations
+        """
+        ## Eventually need to change if any of the general parameters are changed
+        n_pool = self.indices.shape[0]
+        self.n_ens = int(n_pool*self.ens_split)//self.ens_size
+        
+        ## must be even to divide into parents
+        if (self.n_ens%2)==1:
+            self.n_ens-=1
+        self.pool_size = self.n_ens*self.ens_size
+        
+        #self.ens_indices = np.zeros((self.n_ens,self.ens_size))
+        print(n_pool, self.pool_size)
+        self.mut_indices = self.indices
+        
+        self.parents = np.zeros((self.n_ens, self.ens_size), dtype=np.int64) # set of indices ...
+        self.parent_pairs = np.zeros((int(self.n_ens/2),2,self.ens_size), dtype=np.int64)
+        self.children = np.zeros((self.n_ens, self.ens_size), dtype=np.int64) # set of indices ...
+                                 
+        self.gen_fitness = np.zeros((self.n_gen, self.n_ens))
+        self.gen_rchi2 = np.zeros((self.n_gen, self.n_ens))
+        self.gen_aic = np.zeros((self.n_gen, self.n_ens))
+        self.gen_residuals = np.zeros((self.n_ens, self.experiment.shape[0])) ## residuals per generation 
+        self.gen_models = np.zeros((self.n_ens, self.experiment.shape[0])) ## residuals per generation 
+
+        self.fitness_check = np.ones((self.n_ens, self.n_gen)) ## checks to see if the fit produces proper weights
+        self.individual_fitness_time = np.zeros((self.n_ens,1))
+    
+    def _dataset_ranges(self):
+        """
+        slice of the experimental q values of every dataset
+        """
+        return self.dataset_slices if (self.dataset_slices is not None) else [slice(None)]
+    
+    @property
+    def interp_data(self):
+        """
+        interpolated library as a (nConf, nq) dataframe
+        """
+        return pd.DataFrame(index=self.data.columns, columns=self.experiment['Q'].values, data=self.interp_matrix)
+    
     def randomcol_indices(self):
         """
         randomize the column selections from the data
         """
-        return np.random.choice(np.arange(0, self.data.shape[1], 1), self.pool_size, replace=False).reshape(-1,self.ens_size)    
+        return self.rng.choice(self.indices.shape[0], self.pool_size, replace=False).reshape(-1,self.ens_size)    
     
     
-    def evaluate(self, client):
+    def _extension_scores(self, seeds):
         """
-        Fit each of the parents to the experimental data
-        Evaluate the fitness from the fits 
+        Cheap ranking of the conformers to add to each seed ensemble (rows of conformer indices): the seeds are fit
+        with the linear fit and every conformer is scored by how much it lowers the chi2 of the unconstrained fit
+        when added, (p.r)/|p| with p its weighted profile made orthogonal to the seed profiles and the background
+        of each dataset and r the weighted residual of the seed. Conformers that would need a negative weight score below 0.
+        Returns the (n_seeds, n_indices) scores of the conformers in self.indices
+        """
+        sigma = self.experiment['Error'].values if ("Error" in self.experiment.columns) else np.ones(self.experiment.shape[0])
+        seed_data = np.rollaxis(np.asarray(self.interp_matrix[seeds, :], dtype=np.float64), 2, 1)
+        seed_fits = _fit_linear_datasets(seed_data, self.experiment.iloc[:,1].values, sigma, self.dataset_slices)
+        
+        profiles = np.asarray(self.interp_matrix[self.indices, :], dtype=np.float64)/sigma
+        scores = np.zeros((seeds.shape[0], self.indices.shape[0]))
+        for nseed in range(seeds.shape[0]):
+            orthogonal = profiles.copy()
+            for dslice in self._dataset_ranges():
+                design = np.column_stack([seed_data[nseed, dslice, :], np.ones(sigma[dslice].shape[0])])/sigma[dslice, None]
+                qmat = np.linalg.qr(design)[0]
+                orthogonal[:, dslice] -= (orthogonal[:, dslice]@qmat)@qmat.T
+            norms = np.linalg.norm(orthogonal, axis=1)
+            norms[norms < np.finfo(float).eps*np.linalg.norm(profiles, axis=1)] = np.inf
+            scores[nseed] = -(orthogonal@seed_fits['residuals'][nseed])/norms
+        return scores
+    
+    def _seeded_parents(self):
+        """
+        Initial parents from the seed_ensembles of a smaller ensemble size. The first seed_fraction of the ensembles
+        extend the seeds, in turn, with conformers drawn from the seed_candidates best ranked by _extension_scores;
+        the rest are random for diversity.
+        """
+        seeds = np.asarray(self.seed_ensembles, dtype=np.int64).reshape(len(self.seed_ensembles), -1)
+        n_extend = self.ens_size-seeds.shape[1]
+        parents = self.indices[self.randomcol_indices()]
+        n_seeded = int(self.seed_fraction*self.n_ens)
+        if (n_extend <= 0) or (n_seeded == 0):
+            return parents
+        
+        scores = self._extension_scores(seeds)
+        for nseed, seed in enumerate(seeds):
+            scores[nseed, np.isin(self.indices, seed)] = -np.inf
+        n_candidates = max(self.seed_candidates, n_extend)
+        candidates = np.argsort(scores, axis=1)[:, ::-1][:, :n_candidates]
+        
+        for nens in range(n_seeded):
+            nseed = nens%seeds.shape[0]
+            extension = self.rng.choice(candidates[nseed], n_extend, replace=False)
+            parents[nens] = np.append(seeds[nseed], self.indices[extension])
+        return parents
+    
+    def _fit_ensembles(self, ensembles, client):
+        """
+        Fit each ensemble (row of conformer indices) to the experimental data
+        Returns the stacked fit results, see _fit_linear_batch
         
         For Loop can be parallelized with multiprocess?
         """
-        eval_time_start = time.time()
-        ensemble_scattering_parents = np.rollaxis(self.interp_data.values[self.parents,:], 2, 1)
-        #print(ensemble_scattering_parents.shape)
+        fit_time_start = time.time()
         
         mfit_array = []
-        if self.parallel:
+        batched = (self.batch_evaluation and _is_linear_algorithm(self.fitting_algorithm))
+        if batched and (self.gram is None):
+            ensemble_scattering_parents = np.rollaxis(self.interp_matrix[ensembles,:], 2, 1)
+            #print(ensemble_scattering_parents.shape)
+        
+        if self.gram is not None:
+            ## scores only, the models of the new bests are computed in validate_and_update
+            fit_results = _fit_linear_gram(ensembles, self.gram)
+            fit_results['eval_time'] = np.full(ensembles.shape[0], (time.time()-fit_time_start)/ensembles.shape[0])
+            
+        elif batched:
+            sigmaI = self.experiment['Error'].values if ("Error" in self.experiment.columns) else None
+            fit_results = _fit_linear_datasets(ensemble_scattering_parents, self.experiment.iloc[:,1].values, sigmaI,
+                                               self.dataset_slices)
+            fit_results['eval_time'] = np.full(ensembles.shape[0], (time.time()-fit_time_start)/ensembles.shape[0])
+            
+        elif self.parallel and (client is not None):
             #with distributed.LocalCluster(n_workers=self.cpus,
             #                  processes=True,
             #                  threads_per_worker=1,
             #                 ) as cluster, distributed.Client(cluster) as client:
                 
-            futures_fitmap = client.map(fitness, ensemble_scattering_parents, expdata = self.experiment,
-                                 ens_size=self.ens_size, fitting_algorithm=self.fitting_algorithm)
-            distributed.wait(futures_fitmap)
-            mfit_array = client.gather(futures_fitmap)
+            ## only the conformer indices are sent, the library and experiment are already on the workers
+            if self.worker_library is None:
+                self._scatter_library(client)
+            log_tasks = (self.telemetry_file is not None) and is_dask_client(client)
+            task_stream = distributed.get_task_stream(client) if log_tasks else contextlib.nullcontext()
+            with task_stream:
+                futures_fitmap = client.map(fitness_warm_start, list(ensembles), self._warm_start_params(ensembles),
+                                            library=self.worker_library,
+                                            expdata=self.worker_experiment,
+                                            ens_size=self.ens_size, fitting_algorithm=self.fitting_algorithm,
+                                            local_method=self.local_method, cut_weight=self.cut_weight,
+                                            dataset_slices=self.dataset_slices)
+                mfit_array = client.gather(futures_fitmap)
+            if log_tasks:
+                self._log_task_stream(task_stream.data, time.time()-fit_time_start,
+                                      [future.key for future in futures_fitmap])
             #print(len(mfit_array))
             #fitmap_seq = distributed.as_completed(futures_fitmap)
                 
             #for nfit, fit in enumerate(fitmap_seq):
             #    mfit_array.update({nfit:fit.result()})
         else:
-            for nfit, ens_data in enumerate(ensemble_scattering_parents):
-                #print(datindex)
-                mfit_array.update(self.fitness(ens_data, self.experiment))
-
+            ## serial, in this process
+            for ensemble, init_params in zip(ensembles, self._warm_start_params(ensembles)):
+                mfit_array.append(fitness_indices(ensemble, self.interp_matrix, self.experiment, self.ens_size,
+                                                  fitting_algorithm=self.fitting_algorithm, init_params=init_params,
+                                                  local_method=self.local_method, cut_weight=self.cut_weight,
+                                                  dataset_slices=self.dataset_slices))
+        
+        if not (batched or (self.gram is not None)):
+            fit_results = _stack_fitresults(mfit_array, self.ens_size, n_datasets=self.n_datasets)
+        
+        return fit_results
+    
+    def _warm_start_params(self, ensembles):
+        """
+        Starting parameters of each ensemble from the fits of the previous generation: every conformer takes its weight
+        from the best (lowest chi2) valid fit it was in, and c and b come from the best fit of any of its conformers.
+        The weights are normalized to 1, conformers not fit in the previous generation start at 1/ens_size.
+        None for every ensemble without warm_start or in the first generation.
+        While the islands are fit together, the ensembles take the parameters computed from their own island
+        (see _island_warm_start_params)
+        """
+        if self.island_warm_starts is not None:
+            return [self.island_warm_starts.get(tuple(int(ndx) for ndx in np.sort(ensemble))) for ensemble in ensembles]
+        if (not self.warm_start) or (self.gen_paramfit is None) or (self.curr_gen == 0):
+            return [None]*ensembles.shape[0]
+        
+        params = self.gen_paramfit.values.T.astype(float) ## (n_ens, ens_size+2), c b w1..wn
+        chi2 = self.gen_rchi2[self.curr_gen-1, :]
+        valid = np.all(params[:, 2:] >= self.cut_weight, axis=1)
+        conformer_fit = {}
+        for nfit in np.where(valid)[0][np.argsort(-chi2[valid])]: ## best fits last, they overwrite the others
+            for nconf, conformer in enumerate(self.gen_parents[nfit]):
+                conformer_fit[conformer] = (params[nfit, 2+nconf], params[nfit, 0], params[nfit, 1], chi2[nfit])
+        
+        names = _param_names(self.ens_size)
+        init_params = []
+        for ensemble in ensembles:
+            known = [conformer_fit[conformer] for conformer in ensemble if conformer in conformer_fit]
+            if len(known) == 0:
+                init_params.append(None)
+                continue
+            weights = np.array([conformer_fit[conformer][0] if conformer in conformer_fit else 1.0/self.ens_size
+                                for conformer in ensemble])
+            best_known = min(known, key=lambda fit: fit[3])
+            init_params.append(dict(zip(names, [best_known[1], best_known[2]] + list(weights/weights.sum()))))
+        return init_params
+    
+    def _island_warm_start_params(self, islands):
+        """
+        Starting parameters of the parents of each island from the previous generation of that island, by sorted
+        ensemble. An ensemble that is a parent of several islands starts from the parameters of the first of them
+        """
+        warm_starts = {}
+        for island in islands:
+            self._load_island(island)
+            canonical = np.sort(self.parents, axis=1)
+            for ensemble, init_params in zip(canonical, self._warm_start_params(canonical)):
+                warm_starts.setdefault(tuple(int(ndx) for ndx in ensemble), init_params)
+        return warm_starts
+    
+    def _log_task_stream(self, tasks, wall_time, keys):
+        """
+        Time the workers spent computing and transferring for the fits with the task keys of this run,
+        the task stream also has the tasks of the other runs sharing the cluster. The rest of the wall time of these
+        workers (wall_time*workers - compute - transfer) is dask_idle: waiting for tasks, the scheduler or other runs
+        """
+        keys = set(keys)
+        tasks = [task for task in tasks if task['key'] in keys]
+        actions = {'compute':0.0, 'transfer':0.0}
+        workers = set()
+        for task in tasks:
+            workers.add(task['worker'])
+            for startstop in task['startstops']:
+                if startstop['action'] in actions:
+                    actions[startstop['action']] += startstop['stop']-startstop['start']
+        self.time_log['dask_tasks'] = len(tasks)
+        self.time_log['dask_compute'] = actions['compute']
+        self.time_log['dask_transfer'] = actions['transfer']
+        self.time_log['dask_idle'] = max(0.0, wall_time*len(workers)-actions['compute']-actions['transfer'])
+    
+    def _scatter_library(self, client):
+        """
+        Broadcast the interpolated library and the experimental data to every worker once, shared through _WORKER_DATA
+        with the other runs on the same client. The futures are kept for the rest of evolve and cancelled at the end of it
+        by the last run using them. A memory-mapped library is not sent, the workers open library_file themselves.
+        """
+        self.worker_client = client
+        self.worker_keys = [('experiment', self.exp_fingerprint)]
+        if self.library_file is not None:
+            self.worker_library = str(self.library_file)
+        else:
+            self.worker_keys.append(('library', _grid_key(self.interp_matrix), self.interp_matrix.dtype.str, self.interp_matrix.shape))
+            self.worker_library = _WORKER_DATA.scatter(client, self.worker_keys[-1], self.interp_matrix)
+        self.worker_experiment = _WORKER_DATA.scatter(client, self.worker_keys[0], self.experiment)
+    
+    def _release_library(self):
+        if self.worker_client is not None:
+            for key in self.worker_keys:
+                _WORKER_DATA.release(self.worker_client, key)
+        self.worker_client = None
+        self.worker_keys = []
+        self.worker_library = None
+        self.worker_experiment = None
+    
+    def _cached_fit_ensembles(self, ensembles, client):
+        """
+        Fit the ensembles through self.fitness_cache, only the ensembles not in the cache are fit.
+        Ensembles are cached in sorted (canonical) order and the weights are put back in the order of each ensemble 
+        """
+        order = np.argsort(ensembles, axis=1)
+        canonical = np.take_along_axis(ensembles, order, axis=1)
+        keys = [self._fitness_key(ens) for ens in canonical]
+        cached_fits = [self.fitness_cache.get(key) for key in keys]
+        
+        missing = np.array([nens for nens, fit in enumerate(cached_fits) if fit is None], dtype=int)
+        if missing.shape[0] > 0:
+            missing_fits = self._fit_ensembles(canonical[missing], client)
+            for nmiss, nens in enumerate(missing):
+                cached_fits[nens] = {ky:np.copy(missing_fits[ky][nmiss]) for ky in missing_fits.keys()}
+                self.fitness_cache.put(keys[nens], cached_fits[nens])
+        
+        fit_results = _stack_fitresults(cached_fits, self.ens_size, named_params=False)
+        ## no fitting time for the cached ensembles
+        cache_hits = np.ones(ensembles.shape[0], dtype=bool)
+        cache_hits[missing] = False
+        fit_results['eval_time'][cache_hits] = 0.0
+        fit_results['nfev'][cache_hits] = 0
+        
+        ## canonical weight order back to the order of the ensemble
+        inverse_order = np.argsort(order, axis=1)
+        fit_results['params'][:, -self.ens_size:] = np.take_along_axis(fit_results['params'][:, -self.ens_size:], inverse_order, axis=1)
+        
+        self.time_log['cache_hits'] = ensembles.shape[0]-missing.shape[0]
+        self.time_log['cache_misses'] = missing.shape[0]
+        return fit_results
+    
+    def _fitness_key(self, ensemble):
+        ## everything the fit of an ensemble depends on: a cache shared by other runs never returns their fits
+        return (self.fitting_algorithm, self.local_method, self.warm_start, self.cut_weight,
+                self.library_dtype.str, self.library_backend, self.library_fingerprint, self.exp_fingerprint,
+                tuple(int(ndx) for ndx in ensemble))
+    
+    def _evaluate_fits(self, ensembles, client):
+        """
+        Fit the ensembles, through the fitness cache if there is one.
+        Ensembles with the same conformers (in any order) are fit once and the weights are
+        put back in the order of each ensemble
+        """
+        order = np.argsort(ensembles, axis=1)
+        canonical = np.take_along_axis(ensembles, order, axis=1)
+        distinct, first_index, inverse = np.unique(canonical, axis=0, return_index=True, return_inverse=True)
+        
+        if (self.fitness_cache is None) or (self.gram is not None):
+            ## the gram scores are cheaper than the cache lookups
+            distinct_fits = self._fit_ensembles(distinct, client)
+        else:
+            distinct_fits = self._cached_fit_ensembles(distinct, client)
+        
+        inverse = inverse.reshape(-1)
+        fit_results = {ky:distinct_fits[ky][inverse] for ky in distinct_fits.keys()}
+        fit_results['params'][:, -self.ens_size:] = np.take_along_axis(fit_results['params'][:, -self.ens_size:], np.argsort(order, axis=1), axis=1)
+        
+        ## the fitting time and function evaluations are counted for the first copy only
+        duplicates = np.ones(ensembles.shape[0], dtype=bool)
+        duplicates[first_index] = False
+        fit_results['eval_time'][duplicates] = 0.0
+        fit_results['nfev'][duplicates] = 0
+        self.time_log['duplicate_ensembles'] = int(duplicates.sum())
+        return fit_results
+    
+    def evaluate(self, client):
+        """
+        Fit each of the parents to the experimental data
+        Evaluate the fitness from the fits 
+        """
+        eval_time_start = time.time()
+        fit_results = self._evaluate_fits(self.parents, client)
+        self._store_generation(fit_results)
         self.time_log['evaluation'] = time.time()-eval_time_start
+    
+    def _store_generation(self, fit_results):
+        """
+        Save the fits of the parents for the current generation and evaluate the fitness from the fits
+        """
         ##print(self.pars.valuesdict(), mfit_array[0]['params'])
-        self.gen_paramfit = pd.DataFrame(index=list(mfit_array[0]['params'].keys()),
-                                         columns=np.arange(0,self.n_ens)).fillna(0.0)
+        self.gen_paramfit = pd.DataFrame(index=_param_names(self.ens_size, self.n_datasets), columns=np.arange(0,self.n_ens),
+                                         data=fit_results['params'].T)
         
-        for data_index, fit_results in enumerate(mfit_array):
-            self.gen_rchi2[self.curr_gen, data_index] = mfit_array[data_index]['chi2']
-            self.gen_aic[self.curr_gen, data_index] = mfit_array[data_index]['aic']
-            self.gen_paramfit.loc[list(mfit_array[0]['params'].keys()), data_index] = list(mfit_array[data_index]['params'].values())
-            self.individual_fitness_time[data_index] = mfit_array[data_index]['eval_time']
-            self.gen_models[data_index,:] = mfit_array[data_index]['model']
-            self.gen_residuals[data_index,:] = mfit_array[data_index]['residuals']
+        self.gen_rchi2[self.curr_gen, :] = fit_results['chi2']
+        self.gen_aic[self.curr_gen, :] = fit_results['aic']
+        self.individual_fitness_time[:, 0] = fit_results['eval_time']
+        self.gen_parents = self.parents.copy()
+        self.gen_nfev = int(fit_results['nfev'].sum())
+        if 'model' in fit_results:
+            self.gen_models[:, :] = fit_results['model']
+            self.gen_residuals[:, :] = fit_results['residuals']
+        else:
+            self.gen_models[:, :] = np.nan
+            self.gen_residuals[:, :] = np.nan
 
         if self.method == "prob":
             if (not self.invabsx2): ## if invabsx2 is False, use the standard inversion
@@ -323,10 +1364,23 @@ class GAEnsembleOpt:
             
         elif self.method == "rank_div":
             self.gen_fitness[self.curr_gen, :] = self.gen_rchi2[self.curr_gen, :]
-
-        self.time_log['evaluation'] = time.time()-eval_time_start
         
+        self._record_history(self.parents, fit_results['params'], fit_results['chi2'], fit_results['aic'],
+                             self.gen_fitness[self.curr_gen, :])
         
+    def _record_history(self, ensembles, params, chi2, aic, fitness, generation=None):
+        """
+        Keep the fits of a set of ensembles of the current iteration (and generation) for save_results
+        """
+        if self.results_file is None:
+            return None
+        n_fits = ensembles.shape[0]
+        generation = np.full(n_fits, self.curr_gen) if (generation is None) else np.asarray(generation)
+        self.history.append({'ensemble':np.array(ensembles, dtype=np.int64), 'params':np.array(params, dtype=float),
+                             'chi2':np.array(chi2, dtype=float), 'aic':np.array(aic, dtype=float),
+                             'fitness':np.array(fitness, dtype=float), 'iteration':np.full(n_fits, self.curr_iter),
+                             'generation':generation})
+    
     def validate_and_update(self):
         
         """
@@ -336,8 +1390,8 @@ class GAEnsembleOpt:
         """
         validate_time_start = time.time()
         
-        valid_solutions = ~np.any(self.gen_paramfit.iloc[2:,:]<self.cut_weight,axis=0)
-        unique_ensembles = np.apply_along_axis(unique_arr, 1, self.parents) ## For unique elements within the parent
+        valid_solutions = ~np.any(self.gen_paramfit.iloc[-self.ens_size:,:]<self.cut_weight,axis=0)
+        unique_ensembles = unique_rows(self.parents) ## For unique elements within the parent
         
         vu_indices = np.where(valid_solutions&unique_ensembles)[0]
         vu_parents = self.parents[valid_solutions&unique_ensembles]
@@ -352,10 +1406,10 @@ class GAEnsembleOpt:
         ### Check sizes to make sure their are valid solutions. If no valid solutions,
         ### race condition met and start a new iteration. 
         unique_sol, unq_solut_ndx  = np.unique(vu_parents, axis=0, return_index=True) ## Duplicate parents in the validation ensemble
-        if len(unq_solut_ndx) == 1.0:
+        if len(unq_solut_ndx) <= 1:
             print(f'Only one unique parent solution found. This occured at iteration {self.curr_iter} and generation {self.curr_gen}.')
             print(f'Moving onto the next iteration')
-            self.check_genconvergence=True
+            self.gen_converged=True
             return None 
         
         else:
@@ -393,14 +1447,16 @@ class GAEnsembleOpt:
             ## convert dict entries to floats not lists
             for key in list(self.cbest_rchi2['fit_pars'].keys()):
                 self.cbest_rchi2['fit_pars'][key] = self.cbest_rchi2['fit_pars'][key][0]
-            self.fitness_saturation = 0
             
-        else:
-            self.fitness_saturation += 1
-            
-        ## Update the best over the iteration
+        ## Update the best over the iteration, improvements of the chi2 under convergence_tolerance count as saturated
         if vu_fitmax_value > self.citbest_rchi2['fitness']:
             
+            if (self.citbest_rchi2['chi2'] > 0) and \
+               (abs(vu_chi2[vufitmax][0]-self.citbest_rchi2['chi2'])/self.citbest_rchi2['chi2'] < self.convergence_tolerance):
+                self.fitness_saturation += 1
+            else:
+                self.fitness_saturation = 0
+            
             #print(f"Fitness updated from {self.citbest_rchi2['fitness']['fitness']} to {vu_fitness[unq_solut_ndx].max()}")
             
             #self.cbest_aic['aic'] = vu_aic[unq_solut_ndx].min()
@@ -417,47 +1473,39 @@ class GAEnsembleOpt:
             for key in list(self.cbest_rchi2['fit_pars'].keys()):
                 self.citbest_rchi2['fit_pars'][key] = self.citbest_rchi2['fit_pars'][key][0]
             self.itbest_rchi2[self.curr_iter] = self.citbest_rchi2
-
+        else:
+            self.fitness_saturation += 1
+        
+        self._materialize_model(self.cbest_rchi2)
+        self._materialize_model(self.citbest_rchi2)
         self.time_log['validation'] = time.time()-validate_time_start
     
+    def _materialize_model(self, best):
+        """
+        Model and residuals of a best solution scored without them (gram index), from its fit parameters
+        """
+        if ('model' in best) and np.any(np.isnan(best['model'])) and (len(best.get('fit_pars', {})) > 0):
+            best['model'], best['residuals'] = self._model_from_params(np.asarray(best['ensemble']), best['fit_pars'])
+    
     def choose_parents(self):
         """
         choose parents for the next generation
         """
         parents_time_start = time.time()
         if self.method == "prob": 
-            ## check if parents have duplicate indices in the ensemble 
-            unique_ensembles = np.apply_along_axis(unique_arr, 1, self.parents)
-            weight_ndx = np.arange(0,self.n_ens,1)
-            x2weight = self.gen_fitness[self.curr_gen,:]
-            
-            if np.any(~unique_ensembles):
-                #print("parent is non unique: removing them from the list ")
-                nonunq_ensembles = np.where(~unique_ensembles)[0]
-                weight_ndx = np.delete(weight_ndx, nonunq_ensembles)
-                x2weight = np.delete(x2weight, nonunq_ensembles)
+            ## parents with duplicate indices in the ensemble are not chosen
+            unique_ensembles = unique_rows(self.parents)
+            weight_ndx = np.where(unique_ensembles)[0]
+            x2weight = self.gen_fitness[self.curr_gen, unique_ensembles]
             
             x2weight_norm = x2weight/x2weight.sum()
             
             if self.elitism:
-                max_fitness_parent = np.where(x2weight==x2weight.max())[0]
-                self.elite_child = weight_ndx[max_fitness_parent[0]] ## saving the index of the top fitness  
+                self.elite_child = weight_ndx[x2weight.argmax()] ## saving the index of the top fitness  
                         
-            parent_indices = np.random.choice(weight_ndx,
-                                              self.n_ens,
-                                              p=x2weight_norm)
-            
-            parents_check = self.parents[parent_indices]
-            #unq_func = lambda arr: (np.unique(arr).shape[0] == arr.shape[0])
-            unique_ensembles = np.apply_along_axis(unique_arr, 1, parents_check)
-            if np.any(~unique_ensembles):
-                #print(parents_check)
-                nonunq_ensembles = np.where(~unique_ensembles)[0]
-                #print("parent is non unique")
-                print(parents_check[nonunq_ensembles])
-                
-                #for nq_ndx in nonunq_ensembles:
-                
+            parent_indices = self.rng.choice(weight_ndx,
+                                             self.n_ens,
+                                             p=x2weight_norm)
             
             self.parent_pairs = self.parents[parent_indices.reshape(-1,2)] 
         
@@ -469,90 +1517,54 @@ class GAEnsembleOpt:
         #elif self.method == "rank-div":
         #    pass
         
-        ## check to make sure the ensemble is unique, i.e there are no duplicates pairings
-        
     
     def crossover(self):
         
         """
         crossover the parent indices for the next generation
         Always do the cross over i.e. [A,B],[C,D] ==> [A,C],[B,D] 
-        if ndx is == ens_size children == parents
+        The crossover index is the first position whose random draw is above p_crossover, the tail of the
+        first parent after it is swapped with the head of the second parent.
+        If no draw passes, or either child is not unique, the children are the parents.
         """
         crossover_time_start = time.time()
         
-        copy_parent_pairs = self.parent_pairs
-        for pnumb, ens_pair in enumerate(self.parent_pairs):
-            co_ndx = 0
-            for pi in range(self.ens_size):
-                rcheck = np.random.rand()
-                #print(pi,rcheck)
-                if rcheck > self.p_crossover:
-                    co_ndx=pi
-                    break
-                else:
-                    continue
-            ndx_check = (pi==(self.ens_size-1))
-            co_check = (co_ndx==0)
-            if ndx_check and co_check:
-                ## if each index fails the check to cross over, parents become children i.e. no crossover
-                ## continue onto the next set of parents 
-                continue
-            #print(ens_pair)
-            parent1_copy = ens_pair[0]
-            parent2_copy = ens_pair[1]
-            #print(parent1_copy, parent2_copy)
-            psel1 = parent1_copy[co_ndx+1:]
-            psel2 = parent2_copy[:-(co_ndx+1)]
-            
-            parent1_copy[co_ndx+1:]=psel2
-            parent2_copy[:-(co_ndx+1)]=psel1
-            
-            ### checks to see if the new parents are unique, i.e. each element in the array is singular
-            p1_check = ((np.unique(parent1_copy).shape[0] != parent1_copy.shape[0]))
-            p2_check = ((np.unique(parent2_copy).shape[0] != parent2_copy.shape[0]))
-            
-            ## if either p1_check or p2_check is true: continue on
-            ## count the checks if a certain amount of checks fail for this generation,
-            ## pool is either saturated or a optimal set of conformations has been found
-            ## else crossover
-            if p1_check or p2_check:
-                #print("crossed parents are not unique: continuing", flush=True)
-                continue
-            else:
-                ## crossover
-                copy_parent_pairs[pnumb] = [parent1_copy, parent2_copy]
+        parent1 = self.parent_pairs[:, 0, :]
+        parent2 = self.parent_pairs[:, 1, :]
+        
+        crossed = self.rng.random(parent1.shape) > self.p_crossover
+        co_ndx = np.argmax(crossed, axis=1)[:, None]
+        positions = np.arange(self.ens_size)[None, :]
+        
+        ## child1 = parent1[:co_ndx+1] + parent2[:-(co_ndx+1)], child2 = parent1[co_ndx+1:] + parent2[-(co_ndx+1):]
+        child1 = np.where(positions > co_ndx,
+                          np.take_along_axis(parent2, np.clip(positions-co_ndx-1, 0, None), axis=1), parent1)
+        child2 = np.where(positions < (self.ens_size-co_ndx-1),
+                          np.take_along_axis(parent1, np.clip(positions+co_ndx+1, None, self.ens_size-1), axis=1), parent2)
+        
+        ## count of failed crossovers tells if the pool is saturated or an optimal set of conformations has been found
+        keep_crossover = crossed.any(axis=1) & unique_rows(child1) & unique_rows(child2)
+        child1[~keep_crossover] = parent1[~keep_crossover]
+        child2[~keep_crossover] = parent2[~keep_crossover]
         
         ## after all crossovers are done, children are created. 
-        self.children = copy_parent_pairs.reshape(-1,self.ens_size)
+        self.children = np.stack([child1, child2], axis=1).reshape(-1,self.ens_size)
         self.time_log['crossover'] = time.time() - crossover_time_start
     
     def mutation(self):
         """
         mutate the children after crossover
+        Each element is replaced by a random conformer from mut_indices with probability p_mutate,
+        mutated children that are no longer unique are left as they were 
         """
 
         mutate_time_start = time.time()
         
-        children_copy = self.children
-        for nch, child in enumerate(self.children):
-            
-            for elem, chindx in enumerate(child):
-                mut_check = np.random.rand()
-            
-                if mut_check <= self.p_mutate:
-                    
-                    child_copy = child
-                    child_copy[elem] = np.random.choice(self.mut_indices.shape[0],1)[0]
-                    child_check = ((np.unique(child_copy).shape[0]) != child.shape[0])
-                    if child_check:
-                        print("child is not unique: continuing")
-                        continue
-                    else:
-                        children_copy[nch] = child_copy
-                        continue ## only one mutation per child
-                    
-        self.children=children_copy
+        mutate = self.rng.random(self.children.shape) <= self.p_mutate
+        mutants = np.where(mutate, self.rng.choice(self.mut_indices, size=self.children.shape), self.children)
+        
+        unique_mutants = unique_rows(mutants)
+        self.children = np.where(unique_mutants[:, None], mutants, self.children)
 
         self.time_log['mutation'] = time.time() - mutate_time_start
         
@@ -565,47 +1577,185 @@ class GAEnsembleOpt:
             self.gen_converged = True
             return None
         
+        ## check 2: wall-clock budget, stops the remaining iterations as well
+        if self._out_of_time():
+            print(f"Reached the time budget of {self.time_budget} s at iteration {citer} and generation {self.curr_gen}")
+            self.gen_converged = True
+            self.iter_converged = True
+            return None
         
-        ## check 2:
-        if (not self.elitism):
-            nconverge = 100 
-        else:
-            ## give more chances for the elitist function to be exchanged
-            nconverge = self.n_gen/2.0
-            
-        #if self.fitness_saturation>nconverge:
-        #    print(f"The fitness function has had the same value,{self.cbest_rchi2['fitness']}, over {nconverge} times.")
-        #    print(f"Generation has most likely converged to a set ensemble. Moving onto iteration{citer+1}")
-        #    self.gen_converged = True
-            
-        #    return None
-        
-        ## check 3: ## 
+        ## check 3: the best of the iteration has not improved (by more than convergence_tolerance) for convergence_generations
+        if (self.convergence_generations is not None) and (self.fitness_saturation >= self.convergence_generations):
+            print(f"The fitness function has had the same value,{self.citbest_rchi2['fitness']}, over {self.fitness_saturation} generations.")
+            print(f"Generation has most likely converged to a set ensemble. Moving onto iteration {citer+1}")
+            self.gen_converged = True
+            return None
         
-            
+        ## check 4: diversity collapse, too few distinct ensembles left in the next generation
+        diversity = np.unique(np.sort(self.children, axis=1), axis=0).shape[0]/self.n_ens
+        if diversity < self.min_diversity:
+            print(f"Only {diversity:.2f} of the ensembles are distinct at generation {self.curr_gen}. Moving onto iteration {citer+1}")
+            self.gen_converged = True
+            return None
+    
     def check_iterconvergence(self):
-        pass
+        """
+        Stop the iterations when out of time or when the last iteration_agreement iterations found the same best ensemble
+        """
+        if self._out_of_time():
+            self.iter_converged = True
+            return None
+        if self.iteration_agreement is None:
+            return None
+        
+        found = [tuple(np.sort(itbest['ensemble'])) for itbest in self.itbest_rchi2[:self.curr_iter+1] if 'ensemble' in itbest]
+        if (len(found) >= self.iteration_agreement) and (len(set(found[-self.iteration_agreement:])) == 1):
+            print(f"The last {self.iteration_agreement} iterations found the same best ensemble {found[-1]}. Stopping after iteration {self.curr_iter}")
+            self.iter_converged = True
+    
+    def _out_of_time(self):
+        return (self.time_budget is not None) and ((time.time()-self.evolve_start_time) > self.time_budget)
         
     def wipe_generation(self):
-        pass
+        """
+        New generation arrays for an iteration, nothing of a previous (possibly shorter) iteration is left in them
+        """
+        self.gen_fitness = np.zeros((self.n_gen, self.n_ens))
+        self.gen_rchi2 = np.zeros((self.n_gen, self.n_ens))
+        self.gen_aic = np.zeros((self.n_gen, self.n_ens))
+        self.gen_residuals = np.zeros((self.n_ens, self.experiment.shape[0]))
+        self.gen_models = np.zeros((self.n_ens, self.experiment.shape[0]))
+        self.individual_fitness_time = np.zeros((self.n_ens,1))
+        self.fitness_saturation = 0
+    
+    def _init_iteration(self, it):
+        """
+        Start iteration it from a random set of parents
+        """
+        self.curr_iter = it
+        self.wipe_generation()
+        self.citbest_rchi2 = {'chi2':0, 'aic':0, 'fitness':0, 'ensemble':[0]*self.n_gen, 'gen_found':0, 'fit_pars':{}}
+        if (self.fitness_cache is not None) and (not self.persist_fitness_cache):
+            self.fitness_cache.clear()
+        ## initialize the parents and mutation indices
+        if self.seed_ensembles is not None:
+            self.parents = self._seeded_parents()
+        else:
+            rcols = self.randomcol_indices()
+            self.parents = self.indices[rcols] ## parents, evovling 
+        
+        self.mut_indices = self.indices
+        
+        self.curr_gen=0
+        self.gen_converged = False
+    
+    def _next_generation(self):
+        """
+        Validate the evaluated parents and breed the children for the next generation 
+        """
+        self.validate_and_update()
+        
+        ## choose parents 
+        self.choose_parents()
+        
+        ## make children
+        self.crossover()
+        self.mutation()
+        
+        ## check convergence if not reached
+        self.curr_gen+=1
+        self.check_genconvergence(self.curr_iter)
+        self.time_log['fitness_ave'] = self.individual_fitness_time.mean()
+        self.time_log['fitness_total'] = self.individual_fitness_time.sum()
+        self._record_generation()
+    
+    def _record_generation(self):
+        """
+        Append the telemetry of the generation just evaluated to telemetry_file, one JSON record per line
+        """
+        if self.telemetry_file is None:
+            return None
+        gen = self.curr_gen-1
+        gen_best = self.gen_fitness[gen, :].argmax()
+        record = {'ensemble_size':self.ens_size, 'iteration':int(self.curr_iter), 'generation':int(gen),
+                  'elapsed':time.time()-self.evolve_start_time, 'n_ensembles':int(self.n_ens), 'nfev':self.gen_nfev,
+                  'gen_best_chi2':self.gen_rchi2[gen, gen_best], 'gen_best_fitness':self.gen_fitness[gen, gen_best],
+                  'iteration_best_chi2':self.citbest_rchi2['chi2'], 'best_chi2':self.cbest_rchi2['chi2'],
+                  'best_fitness':self.cbest_rchi2['fitness'], 'fitness_saturation':self.fitness_saturation,
+                  'ensemble_diversity':np.unique(np.sort(self.parents, axis=1), axis=0).shape[0]/self.n_ens,
+                  'conformer_diversity':np.unique(self.parents).shape[0]/self.pool_size,
+                  'cache_size':len(self.fitness_cache) if (self.fitness_cache is not None) else 0,
+                  'converged':bool(self.gen_converged)}
+        record.update(self.time_log)
+        with open(self.telemetry_file, 'a') as ftel:
+            ftel.write(json.dumps(record, default=float)+"\n")
+    
+    @contextlib.contextmanager
+    def _profile_generation(self, iteration, generation, client):
+        """
+        Profile the generations in profile_generations with cProfile (.prof files for pstats/snakeviz)
+        or, with profile_mode 'dask', with a dask performance report (.html), written in profile_dir.
+        Only one cProfile profiler can be active at a time (Python 3.12+ raises otherwise), so the ensemble sizes
+        running concurrently take turns through _PROFILE_LOCK and a profiled generation waits for the other's to end
+        """
+        if (self.profile_generations is None) or (generation not in self.profile_generations):
+            yield None
+            return None
+        profile_name = Path(self.profile_dir)/f"gasans_profile_EnsSize{self.ens_size}_Iteration{iteration}_Generation{generation}"
+        if (self.profile_mode == 'dask') and is_dask_client(client):
+            with distributed.performance_report(filename=f"{profile_name}.html"):
+                yield None
+        else:
+            with _PROFILE_LOCK:
+                profiler = cProfile.Profile()
+                profiler.enable()
+                try:
+                    yield None
+                finally:
+                    profiler.disable()
+                    profiler.dump_stats(f"{profile_name}.prof")
     
     def evolve(self, dask_client):
         
+        self.evolve_start_time = time.time()
+        if self.stage == 'search':
+            self._search(dask_client)
+            self.stage = 'refine'
+        if (self.stage == 'refine') and self.refine_clusters and (self.cluster_labels is not None):
+            self._refine_clusters(dask_client)
+        
+        self.stage = 'finished'
+        self.save_checkpoint()
+        self._release_library()
+    
+    def _search(self, dask_client):
+        if self.search_mode == 'exhaustive':
+            self._exhaustive_search(dask_client)
+        else:
+            self._evolve_population(dask_client)
+    
+    def _evolve_population(self, dask_client):
+        
+        if self.island_model:
+            self._evolve_islands(dask_client)
+            return None
+        if self.evolution_mode == 'steady_state':
+            self._evolve_steady_state(dask_client)
+            return None
+        
         ##evaluate the 
-        self.curr_iter = 0
-        for it in np.arange(0, self.n_iter, 1):
+        ## a resumed run continues the saved iteration, see load_checkpoint
+        if not self.resumed:
+            self.curr_iter = 0
+            self.iter_converged = False
+        for it in np.arange(self.curr_iter, self.n_iter, 1):
             
-            self.curr_iter = it
-            self.citbest_rchi2 = {'chi2':0, 'aic':0, 'fitness':0, 'ensemble':[0]*self.n_gen, 'gen_found':0, 'fit_pars':{}}
-            ## initialize the parents and mutation indices
-            rcols = self.randomcol_indices()
-            self.parents = self.indices[rcols] ## parents, evovling 
-            
-            ## How to check if the 
-            check_indices = [not (m in self.parents.flatten()) for m in self.indices]
-            self.mut_indices = self.indices
-            
-            self.curr_gen=0
+            if self.iter_converged:
+                break
+            if self.resumed:
+                self.resumed = False
+            else:
+                self._init_iteration(it)
             
             while (not self.gen_converged):
                 
@@ -617,61 +1767,656 @@ class GAEnsembleOpt:
                 
                 print(f"Current Generation: {self.curr_gen}", flush=True)
                 ## evaluate parents
-                self.evaluate(dask_client)
-                self.validate_and_update()
-                
-                ## choose parents 
-                self.choose_parents()
-                
-                ## make children
-                self.crossover()
-                self.mutation()
-                
-                ## check convergence if not reached
-                self.curr_gen+=1
-                self.check_genconvergence(it)
-                self.time_log['fitness_ave'] = self.individual_fitness_time.mean()
+                with self._profile_generation(self.curr_iter, self.curr_gen, dask_client):
+                    self.evaluate(dask_client)
+                    self._next_generation()
+                if self.curr_gen%self.checkpoint_interval == 0:
+                    self.save_checkpoint()
                 
                 
             ## clean up and save the best fits and ensembles for the generation, before moving on 
             #self.validate_and_update()
             self.gen_converged = False
+            self.check_iterconvergence()
+    
+    def _fitness_function(self):
+        return invert_absx2 if self.invabsx2 else invert_x2
+    
+    def _evolve_steady_state(self, dask_client):
+        """
+        Steady-state evolution: every iteration is evolved by _steady_state_iteration on the workers of dask_client.
+        A checkpoint is saved after every iteration, a resumed run starts at the next one
+        """
+        if dask_client is None:
+            raise ValueError("The steady_state evolution submits the fits to a client, a dask client or an executors.LocalClient")
+        if self.worker_library is None:
+            self._scatter_library(dask_client)
+        n_threads = sum(dask_client.nthreads().values())
+        n_inflight = self.steady_state_inflight if (self.steady_state_inflight is not None) else 2*n_threads
+        
+        if not self.resumed:
+            self.curr_iter = 0
+            self.iter_converged = False
+        self.resumed = False
+        for it in np.arange(self.curr_iter, self.n_iter, 1):
+            if self.iter_converged:
+                break
+            self._init_iteration(it)
+            self._steady_state_iteration(dask_client, n_inflight, n_threads)
+            self.check_iterconvergence()
+            self.curr_iter = it+1
+            self.save_checkpoint()
+    
+    def _steady_state_children(self, fitness):
+        """
+        Two children of a pair of the population (self.parents) chosen with probability fitness,
+        with the crossover and mutation of the generational algorithm
+        """
+        evaluated = np.where(np.isfinite(fitness))[0]
+        weights = np.clip(fitness[evaluated], 0, None)
+        weights = weights/weights.sum() if weights.sum() > 0 else None
+        self.parent_pairs = self.parents[self.rng.choice(evaluated, 2, p=weights)][None, :, :]
+        self.crossover()
+        self.mutation()
+        return list(np.sort(self.children, axis=1))
+    
+    def _update_steady_best(self, fit, ensemble):
+        """
+        validate_and_update for one fit: a valid fit (every weight above cut_weight) with a higher fitness becomes
+        the best of the run and of the iteration.
+        Returns True when the best of the iteration improved by more than convergence_tolerance
+        """
+        if np.any(fit['params'][-self.ens_size:] < self.cut_weight):
+            return False
+        fitness = self._fitness_function()(fit['chi2'])
+        best = {'chi2':fit['chi2'], 'aic':fit['aic'], 'fitness':fitness, 'ensemble':np.asarray(ensemble),
+                'gen_found':self.curr_gen, 'residuals':fit['residuals'], 'model':fit['model'],
+                'fit_pars':dict(zip(_param_names(self.ens_size, self.n_datasets), fit['params']))}
+        if fitness > self.cbest_rchi2['fitness']:
+            print(f"Fitness updated from {self.cbest_rchi2['fitness']} to {fitness}", flush=True)
+            self.pbest_rchi2 = self.cbest_rchi2
+            self.cbest_rchi2 = dict(best)
+        if fitness <= self.citbest_rchi2['fitness']:
+            return False
+        improved = (self.citbest_rchi2['chi2'] <= 0) or \
+                   (abs(fit['chi2']-self.citbest_rchi2['chi2'])/self.citbest_rchi2['chi2'] >= self.convergence_tolerance)
+        self.citbest_rchi2 = best
+        self.itbest_rchi2[self.curr_iter] = self.citbest_rchi2
+        return improved
+    
+    def _steady_state_iteration(self, client, n_inflight, n_threads=1):
+        """
+        One iteration without generation barriers. n_inflight fits are kept running on the workers: the initial parents
+        first, then children bred from the population as soon as a fit finishes. A finished child replaces the least
+        fit member of the population (self.parents) when it is valid and fitter; children already in the population
+        are not fit again. Every n_ens fits count as a generation for n_gen and the stopping rules.
+        """
+        iteration_start = time.time()
+        names = _param_names(self.ens_size, self.n_datasets)
+        fitness_func = self._fitness_function()
+        self.parents = np.sort(self.parents, axis=1)
+        fitness = np.full(self.n_ens, -np.inf) ## -inf until the member is fit
+        chi2 = np.full(self.n_ens, np.inf)
+        pending = list(range(self.n_ens)) ## members of the initial population not submitted yet
+        children, ready, inflight = [], [], {}
+        completed = client_as_completed(client, with_results=True)
+        n_evaluated, last_improved, n_fits, n_cached, busy_time, gen_nfev = 0, 0, 0, 0, 0.0, 0
+        evaluated = [] ## (ensemble, fit, fitness, generation) of the iteration for the history
+        
+        while not self.gen_converged:
+            ## keep n_inflight fits running, cached and duplicate ensembles are ready at once
+            while (len(inflight) < n_inflight) and (len(ready) == 0):
+                if len(pending) > 0:
+                    member = pending.pop(0)
+                    ensemble = self.parents[member]
+                elif not np.any(np.isfinite(fitness)):
+                    ## the whole population is being fit (n_inflight > n_ens), breed once a member is evaluated
+                    break
+                else:
+                    if len(children) == 0:
+                        children = self._steady_state_children(fitness)
+                    member, ensemble = None, children.pop()
+                    if (not unique_rows(ensemble[None, :])[0]) or \
+                       np.any(np.all(self.parents[np.isfinite(fitness)] == ensemble, axis=1)):
+                        ready.append((ensemble, member, None))
+                        continue
+                
+                cached = self.fitness_cache.get(self._fitness_key(ensemble)) if (self.fitness_cache is not None) else None
+                if cached is not None:
+                    ready.append((ensemble, member, cached))
+                    n_cached += 1
+                    continue
+                future = client.submit(fitness_indices, ensemble, library=self.worker_library, expdata=self.worker_experiment,
+                                       ens_size=self.ens_size, fitting_algorithm=self.fitting_algorithm,
+                                       local_method=self.local_method, cut_weight=self.cut_weight,
+                                       dataset_slices=self.dataset_slices, pure=False)
+                inflight[future] = (ensemble, member)
+                completed.add(future)
+            
+            if len(ready) > 0:
+                ensemble, member, fit = ready.pop(0)
+            else:
+                future, fit = next(completed)
+                ensemble, member = inflight.pop(future)
+                fit = dict(fit, params=np.array([fit['params'][ky] for ky in names]))
+                busy_time += fit['eval_time']
+                gen_nfev += int(fit['nfev'])
+                n_fits += 1
+                if self.fitness_cache is not None:
+                    self.fitness_cache.put(self._fitness_key(ensemble), fit)
+            
+            if fit is not None:
+                valid = np.all(fit['params'][-self.ens_size:] >= self.cut_weight)
+                fit_fitness = fitness_func(fit['chi2']) if valid else 0.0
+                if member is None:
+                    ## the least fit member, members still being fit are not replaced
+                    member = np.where(np.isfinite(fitness), fitness, np.inf).argmin()
+                    if (not np.isfinite(fitness[member])) or (fit_fitness <= fitness[member]):
+                        member = None
+                if member is not None:
+                    self.parents[member] = ensemble
+                    fitness[member] = fit_fitness
+                    chi2[member] = fit['chi2']
+                evaluated.append((ensemble, fit, fit_fitness, self.curr_gen))
+                if self._update_steady_best(fit, ensemble):
+                    last_improved = n_evaluated
+            
+            n_evaluated += 1
+            if n_evaluated%self.n_ens == 0:
+                self.curr_gen = n_evaluated//self.n_ens
+                self.fitness_saturation = (n_evaluated-last_improved)//self.n_ens
+                print(f"Current Generation: {self.curr_gen}", flush=True)
+                self.children = self.parents
+                self.check_genconvergence(self.curr_iter)
+                ## the population at the end of the generation, for the telemetry
+                self.gen_fitness[self.curr_gen-1, :] = np.where(np.isfinite(fitness), fitness, 0.0)
+                self.gen_rchi2[self.curr_gen-1, :] = chi2
+                self.gen_nfev, gen_nfev = gen_nfev, 0
+                self.time_log['evaluation'] = time.time()-iteration_start
+                self._record_generation()
+            elif self._out_of_time():
+                self.check_genconvergence(self.curr_iter)
+        
+        client.cancel(list(inflight))
+        if len(evaluated) > 0:
+            self._record_history(np.array([fit[0] for fit in evaluated]), np.array([fit[1]['params'] for fit in evaluated]),
+                                 [fit[1]['chi2'] for fit in evaluated], [fit[1]['aic'] for fit in evaluated],
+                                 [fit[2] for fit in evaluated], generation=[fit[3] for fit in evaluated])
+        wall_time = time.time()-iteration_start
+        self.gen_converged = False
+        self.time_log['evaluation'] = wall_time
+        self.time_log['fitness_total'] = busy_time
+        self.time_log['fitness_ave'] = busy_time/max(n_fits, 1)
+        self.time_log['cache_hits'] = n_cached
+        self.time_log['cache_misses'] = n_fits
+        self.time_log['worker_utilization'] = busy_time/(wall_time*n_threads)
+    
+    def _refine_clusters(self, dask_client):
+        """
+        Expand the clusters of the conformers in the best ensembles of every iteration back into their members
+        and evolve again over the members. Each iteration keeps the better of its two bests.
+        """
+        if not self.resumed: ## a resumed refinement already has its conformers and population
+            winning_clusters = np.unique(self.cluster_labels[np.concatenate([itbest['ensemble'] for itbest in self.itbest_rchi2
+                                                                              if 'ensemble' in itbest])])
+            members = np.where(np.isin(self.cluster_labels, winning_clusters))[0]
+            if int(members.shape[0]*self.ens_split/self.ens_size) < 2:
+                print(f"Only {members.shape[0]} conformers in the winning clusters: skipping the refinement", flush=True)
+                return None
             
-    def evaluate_bestfit(self, chk_chi2=True):
-        bestpars = gen_modelparams(self.ens_size, self.cbest_rchi2['fit_pars'])
+            print(f"Refining over the {members.shape[0]} members of {winning_clusters.shape[0]} clusters", flush=True)
+            self.representative_best = self.itbest_rchi2
+            self.indices = members
+            self._set_population()
+            self.itbest_rchi2 = [dict() for n in range(self.n_iter)]
+        self._search(dask_client)
+        representative_best = self.representative_best
+        
+        if self.search_mode == 'exhaustive':
+            ## the members include the medoids, so the refined top ensembles already cover the first search
+            return None
+        for ni in range(self.n_iter):
+            if representative_best[ni].get('fitness', 0) > self.itbest_rchi2[ni].get('fitness', 0):
+                self.itbest_rchi2[ni] = representative_best[ni]
+    
+    def _combination_chunks(self):
+        """
+        All the ensembles of self.indices in chunks of exhaustive_chunksize rows
+        """
+        combinations = itertools.combinations(self.indices, self.ens_size)
+        while True:
+            chunk = np.fromiter(itertools.chain.from_iterable(itertools.islice(combinations, self.exhaustive_chunksize)),
+                                dtype=np.int64).reshape(-1, self.ens_size)
+            if chunk.shape[0] == 0:
+                return None
+            yield chunk
+    
+    def _exhaustive_search(self, client):
+        """
+        Fit every ensemble of ens_size conformers with score_combinations, with a few chunks at a time on each worker,
+        and keep the exhaustive_topk best in itbest_rchi2, the best one in cbest_rchi2.
+        With the gram index the chunks are scored in this process, as the fits of the genetic algorithm
+        """
+        search_time_start = time.time()
+        n_combinations = math.comb(self.indices.shape[0], self.ens_size)
+        print(f"Exhaustive search of {n_combinations} ensembles of size {self.ens_size}", flush=True)
+        score_kwargs = {'ens_size':self.ens_size, 'topk':self.exhaustive_topk,
+                        'fitness_func':self._fitness_function(), 'cut_weight':self.cut_weight, 'dataset_slices':self.dataset_slices}
+        
+        top = None
+        chunks = self._combination_chunks()
+        if self.parallel and (client is not None) and (self.gram is None):
+            if self.worker_library is None:
+                self._scatter_library(client)
+            n_inflight = 2*max(1, len(client.scheduler_info()['workers']))
+            chunk_futures = client_as_completed(client, [client.submit(score_combinations, chunk, self.worker_library,
+                                                                       self.worker_experiment, pure=False, **score_kwargs)
+                                                         for chunk in itertools.islice(chunks, n_inflight)])
+            for chunk_future in chunk_futures:
+                top = _merge_topk(chunk_future.result(), top, self.exhaustive_topk)
+                for chunk in itertools.islice(chunks, 1):
+                    chunk_futures.add(client.submit(score_combinations, chunk, self.worker_library,
+                                                    self.worker_experiment, pure=False, **score_kwargs))
+        else:
+            for chunk in chunks:
+                top = _merge_topk(score_combinations(chunk, self.interp_matrix, self.experiment, gram_index=self.gram,
+                                                     **score_kwargs), top, self.exhaustive_topk)
+        
+        if (top is None) or (top['ensemble'].shape[0] == 0):
+            print(f"No valid ensembles found in the exhaustive search of ensemble size {self.ens_size}", flush=True)
+            self.itbest_rchi2 = [dict()]
+            return None
+        
+        ## models and residuals only for the best ensembles
+        sigmaI = self.experiment['Error'].values if ("Error" in self.experiment.columns) else None
+        top_fits = _fit_linear_datasets(np.rollaxis(np.asarray(self.interp_matrix[top['ensemble'], :], dtype=np.float64), 2, 1),
+                                        self.experiment.iloc[:,1].values, sigmaI, self.dataset_slices)
+        names = _param_names(self.ens_size, self.n_datasets)
+        self.itbest_rchi2 = [{'chi2':top['chi2'][nbest], 'aic':top['aic'][nbest], 'fitness':top['fitness'][nbest],
+                              'ensemble':top['ensemble'][nbest], 'gen_found':0,
+                              'fit_pars':dict(zip(names, top['params'][nbest])),
+                              'model':top_fits['model'][nbest], 'residuals':top_fits['residuals'][nbest]}
+                             for nbest in range(top['ensemble'].shape[0])]
+        self.cbest_rchi2 = dict(self.itbest_rchi2[0])
+        self.curr_iter = 0
+        self._record_history(top['ensemble'], top['params'], top['chi2'], top['aic'], top['fitness'])
+        print(f"Best ensemble {self.cbest_rchi2['ensemble']} with chi2 {self.cbest_rchi2['chi2']}", flush=True)
+        self.time_log['evaluation'] = time.time()-search_time_start
+    
+    def _run_key(self):
+        """
+        Settings a checkpoint must have been written with to be resumed
+        """
+        return (self.ens_size, self.n_gen, self.n_iter, self.fitting_algorithm, self.search_mode,
+                self.island_model, self.evolution_mode, self.exp_fingerprint, self.interp_matrix.shape)
+    
+    def save_checkpoint(self, islands=None):
+        """
+        Save the state of the run (generations, bests, random generator) to checkpoint_file,
+        written to a temporary file first so a killed job never leaves a partial checkpoint.
+        islands: the island states of an island model run
+        """
+        if self.checkpoint_file is None:
+            return None
+        self._append_history_spool()
+        state = {attr:getattr(self, attr) for attr in self.checkpoint_attributes}
+        state.update({'run_key':self._run_key(), 'rng_state':self.rng.bit_generator.state, 'islands':islands,
+                      'history_saved':self.history_saved, 'history_offset':self.history_offset})
+        
+        tmp_file = Path(f"{self.checkpoint_file}.tmp")
+        with open(tmp_file, 'wb') as fcheck:
+            pickle.dump(state, fcheck, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, self.checkpoint_file)
+    
+    def _history_spool(self, checkpoint_file=None):
+        return Path(f"{checkpoint_file if checkpoint_file is not None else self.checkpoint_file}.history")
+    
+    def _append_history_spool(self):
+        """
+        Append the fits recorded since the last checkpoint to the history spool (a stream of pickled history entries),
+        from the end of the last checkpoint so entries written after it by a killed run are dropped
+        """
+        if self.results_file is None:
+            return None
+        with open(self._history_spool(), 'r+b' if self._history_spool().exists() else 'wb') as fspool:
+            fspool.seek(self.history_offset)
+            fspool.truncate()
+            for fits in self.history[self.history_saved:]:
+                pickle.dump(fits, fspool, protocol=pickle.HIGHEST_PROTOCOL)
+            fspool.flush()
+            os.fsync(fspool.fileno())
+            self.history_offset = fspool.tell()
+        self.history_saved = len(self.history)
+    
+    def _read_history_spool(self, checkpoint_file, history_offset):
+        history = []
+        if history_offset == 0:
+            return history
+        with open(self._history_spool(checkpoint_file), 'rb') as fspool:
+            while fspool.tell() < history_offset:
+                history.append(pickle.load(fspool))
+        return history
+    
+    def load_checkpoint(self, checkpoint_file=None):
+        """
+        Restore the state saved by save_checkpoint, evolve then continues at the saved iteration and generation.
+        Returns False when there is no checkpoint to resume
+        """
+        checkpoint_file = Path(checkpoint_file if checkpoint_file is not None else self.checkpoint_file)
+        if not checkpoint_file.exists():
+            return False
+        with open(checkpoint_file, 'rb') as fcheck:
+            state = pickle.load(fcheck)
+        if state['run_key'] != self._run_key():
+            raise ValueError(f"The checkpoint {checkpoint_file} was written by a different run: {state['run_key']}")
+        
+        for attr in self.checkpoint_attributes:
+            setattr(self, attr, state[attr])
+        self.history = self._read_history_spool(checkpoint_file, state['history_offset'])
+        self.history_saved, self.history_offset = state['history_saved'], state['history_offset']
+        self.parent_pairs = np.zeros((int(self.n_ens/2),2,self.ens_size), dtype=np.int64)
+        self.fitness_check = np.ones((self.n_ens, self.n_gen))
+        self.rng.bit_generator.state = state['rng_state']
+        self.resume_islands = state['islands']
+        self.resumed = self.stage != 'finished'
+        if self.resumed:
+            print(f"Resuming ensemble size {self.ens_size} from {checkpoint_file} at iteration {self.curr_iter} and generation {self.curr_gen}", flush=True)
+        else:
+            print(f"Ensemble size {self.ens_size} already finished in {checkpoint_file}", flush=True)
+        return True
+    
+    def _save_island(self):
+        return {attr:getattr(self, attr) for attr in self.island_attributes}
+    
+    def _load_island(self, island):
+        for attr in self.island_attributes:
+            setattr(self, attr, island[attr])
+    
+    def _new_island(self, it):
+        """
+        State of a new island, iteration it, with its own generation arrays and random parents
+        """
+        self._init_iteration(it)
+        return self._save_island()
+    
+    def _migrate(self, islands):
+        """
+        Ring migration: the n_migrants fittest ensembles of each island's last generation
+        replace random children of the next island
+        """
+        migrants = []
+        for island in islands:
+            last_gen = island['curr_gen']-1
+            fittest = np.argsort(island['gen_fitness'][last_gen, :])[::-1][:self.n_migrants]
+            migrants.append(island['gen_parents'][fittest].copy())
+        
+        for nisland, island in enumerate(islands):
+            if island['gen_converged']:
+                continue
+            replace = self.rng.choice(self.n_ens, self.n_migrants, replace=False)
+            island['children'][replace] = migrants[nisland-1]
+    
+    def _evolve_islands(self, dask_client):
+        """
+        Island model: the n_iter iterations evolve at the same time as separate populations.
+        Every generation the parents of all islands are fit together, so n_iter times more fits are in flight.
+        Every migration_interval generations the best ensembles move to the neighbouring island.
+        Each island keeps its own best in itbest_rchi2 like an iteration, and the islands stop when
+        iteration_agreement of them hold the same best ensemble (see _check_island_agreement).
+        """
+        if self.resumed:
+            islands = self.resume_islands
+            self.resumed = False
+        else:
+            islands = [self._new_island(it) for it in range(self.n_iter)]
+        
+        while not all(island['gen_converged'] for island in islands):
+            active = [island for island in islands if not island['gen_converged']]
+            for island in active:
+                if island['curr_gen']>0:
+                    island['parents'] = island['children']
+            
+            curr_gen = max(island['curr_gen'] for island in active)
+            print(f"Current Generation: {curr_gen}, islands evolving: {len(active)}", flush=True)
+            with self._profile_generation('islands', curr_gen, dask_client):
+                eval_time_start = time.time()
+                if self.warm_start:
+                    self.island_warm_starts = self._island_warm_start_params(active)
+                fit_results = self._evaluate_fits(np.vstack([island['parents'] for island in active]), dask_client)
+                self.island_warm_starts = None
+                self.time_log['evaluation'] = time.time()-eval_time_start
+                
+                for nisland, island in enumerate(active):
+                    self._load_island(island)
+                    self._store_generation({ky:fit_results[ky][nisland*self.n_ens:(nisland+1)*self.n_ens] for ky in fit_results.keys()})
+                    self._next_generation()
+                    islands[self.curr_iter] = self._save_island()
+            
+            curr_gen = max(island['curr_gen'] for island in islands)
+            if (self.migration_interval > 0) and (curr_gen%self.migration_interval == 0) and \
+               (not all(island['gen_converged'] for island in islands)):
+                self._migrate(islands)
+            self._check_island_agreement(islands)
+            if curr_gen%self.checkpoint_interval == 0:
+                self.save_checkpoint(islands)
+    
+    def _check_island_agreement(self, islands):
+        """
+        check_iterconvergence for the islands, which run at the same time: once iteration_agreement islands
+        hold the same best ensemble, every island stops
+        """
+        if self.iteration_agreement is None:
+            return None
+        found = [tuple(np.sort(island['citbest_rchi2']['ensemble'])) for island in islands if island['citbest_rchi2']['fitness'] > 0]
+        if len(found) == 0:
+            return None
+        best_ensemble = max(set(found), key=found.count)
+        if found.count(best_ensemble) >= self.iteration_agreement:
+            print(f"{found.count(best_ensemble)} islands found the same best ensemble {best_ensemble}. Stopping at generation {self.curr_gen}")
+            for island in islands:
+                island['gen_converged'] = True
+            self.iter_converged = True
+    
+    def top_ensembles(self, n_top=10):
+        """
+        The n_top best distinct ensembles found, from the bests of the iterations and the valid fits of the last
+        generation, ranked by the fitness of their chi2. Used as the seed_ensembles of the next ensemble size
+        """
+        fitness_func = self._fitness_function()
+        found = [(itbest['chi2'], itbest['ensemble']) for itbest in self.itbest_rchi2 if 'ensemble' in itbest]
+        if (self.curr_gen > 0) and (self.gen_paramfit is not None):
+            last_gen = min(self.curr_gen, self.n_gen)-1
+            valid = ~np.any(self.gen_paramfit.values[-self.ens_size:, :].astype(float) < self.cut_weight, axis=0)
+            found += [(chi2, ensemble) for chi2, ensemble in zip(self.gen_rchi2[last_gen, valid], self.gen_parents[valid])]
+        
+        top, seen = [], set()
+        for chi2, ensemble in sorted(found, key=lambda chi2_ens: -fitness_func(np.float64(chi2_ens[0]))):
+            key = tuple(np.sort(ensemble))
+            if key not in seen:
+                seen.add(key)
+                top.append(list(key))
+            if len(top) == n_top:
+                break
+        return top
+    
+    def save_results(self, results_file=None):
+        """
+        Write every ensemble fit of the run to results_file (.npz) at once: conformer indices, fit parameters
+        (ordered as param_names), chi2, aic, fitness, iteration and generation, with the library conformer names
+        and the fitted experiment
+        """
+        results_file = Path(results_file if results_file is not None else self.results_file)
+        if len(self.history) == 0:
+            print(f"No fits to save for ensemble size {self.ens_size}", flush=True)
+            return None
+        results = {ky:np.concatenate([fits[ky] for fits in self.history]) for ky in self.history[0].keys()}
+        np.savez_compressed(results_file, ensemble_size=self.ens_size, search_mode=self.search_mode,
+                            param_names=np.array(_param_names(self.ens_size, self.n_datasets)),
+                            conformers=self.data.columns.values.astype(str), experiment=self.experiment[['Q', 'I(Q)', 'Error']].values,
+                            **results)
+        print(f"Saved {results['chi2'].shape[0]} ensemble fits of ensemble size {self.ens_size} to {results_file}", flush=True)
+        return results_file
+    
+    def _model_from_params(self, ensemble, fit_pars):
+        """
+        Model of an ensemble and its residuals on the experimental q values from saved fit parameters
+        """
+        sigma = self.experiment['Error'].values if ("Error" in self.experiment.columns) else np.ones(self.experiment.shape[0])
+        ens_data = np.asarray(self.interp_matrix[ensemble, :], dtype=np.float64)
+        model = np.zeros(self.experiment.shape[0])
+        for n_dataset, dslice in enumerate(self._dataset_ranges()):
+            pars = gen_modelparams(self.ens_size, _dataset_params(fit_pars, n_dataset, self.n_datasets))
+            model[dslice] = _residual_lmf(pars, ens_data[:, dslice].T)
+        return model, (model-self.experiment.iloc[:,1].values)/sigma
+    
+    def load_results(self, results_file=None):
+        """
+        Restore the fits saved by save_results without running the genetic algorithm again: the history, the best
+        valid ensemble of every iteration (the top ensembles of an exhaustive search) and the best overall, with their
+        models rebuilt from the parameters, so evaluate_bestfit, _write_bestmodel and _write_parameterfile can be used
+        """
+        results_file = Path(results_file if results_file is not None else self.results_file)
+        with np.load(results_file) as results:
+            if (int(results['ensemble_size']) != self.ens_size) or \
+               (list(results['param_names']) != _param_names(self.ens_size, self.n_datasets)):
+                raise ValueError(f"{results_file} holds fits of ensemble size {int(results['ensemble_size'])} "
+                                 f"with parameters {list(results['param_names'])}")
+            self.history = [{ky:results[ky] for ky in ('ensemble', 'params', 'chi2', 'aic', 'fitness', 'iteration', 'generation')}]
+            exhaustive = str(results['search_mode']) == 'exhaustive'
+        fits = self.history[0]
+        names = _param_names(self.ens_size, self.n_datasets)
+        
+        valid = np.where(~np.any(fits['params'][:, -self.ens_size:] < self.cut_weight, axis=1))[0]
+        ranked = valid[np.argsort(-fits['fitness'][valid], kind='stable')]
+        if exhaustive:
+            best_fits = list(ranked)
+        else:
+            n_iter = int(fits['iteration'].max())+1
+            best_fits = [ranked[fits['iteration'][ranked] == it][0] for it in range(n_iter) if np.any(fits['iteration'][ranked] == it)]
+        
+        self.itbest_rchi2 = []
+        for nfit in best_fits:
+            fit_pars = dict(zip(names, fits['params'][nfit]))
+            model, residuals = self._model_from_params(fits['ensemble'][nfit], fit_pars)
+            self.itbest_rchi2.append({'chi2':fits['chi2'][nfit], 'aic':fits['aic'][nfit], 'fitness':fits['fitness'][nfit],
+                                      'ensemble':fits['ensemble'][nfit], 'gen_found':int(fits['generation'][nfit]),
+                                      'fit_pars':fit_pars, 'model':model, 'residuals':residuals})
+        if len(self.itbest_rchi2) > 0:
+            self.cbest_rchi2 = dict(max(self.itbest_rchi2, key=lambda itbest: itbest['fitness']))
+        self.stage = 'finished'
+        return self.itbest_rchi2
+    
+    def bootstrap_best(self, n_boot=None, method=None):
+        """
+        Bootstrap the best ensemble of every iteration (the top ensembles of an exhaustive search) and the best overall:
+        n_boot replicates of the experiment are refit with the linear fit, all in one batch (for any fitting_algorithm,
+        the linear fit is the exact solution of the same model). Every best gets a 'bootstrap' entry with the params
+        (n_boot, n_params) and chi2 (n_boot,) of the replicates
+        """
+        bootstrap_time_start = time.time()
+        n_boot = self.n_bootstrap if (n_boot is None) else n_boot
+        method = self.bootstrap_method if (method is None) else method
+        bests = [itbest for itbest in self.itbest_rchi2 if 'ensemble' in itbest]
+        if len(self.cbest_rchi2['fit_pars']) > 0:
+            bests.append(self.cbest_rchi2)
+        if (len(bests) == 0) or (n_boot == 0):
+            return None
+        
+        ensembles = np.array([best['ensemble'] for best in bests], dtype=np.int64)
+        sigma = self.experiment['Error'].values if ("Error" in self.experiment.columns) else np.ones(self.experiment.shape[0])
+        bootstrap = _bootstrap_fits(np.rollaxis(np.asarray(self.interp_matrix[ensembles, :], dtype=np.float64), 2, 1),
+                                    self.experiment.iloc[:,1].values, sigma, n_boot, method, self.rng, self.dataset_slices)
+        for nbest, best in enumerate(bests):
+            best['bootstrap'] = {'params':bootstrap['params'][nbest], 'chi2':bootstrap['chi2'][nbest]}
+        self.time_log['bootstrap'] = time.time()-bootstrap_time_start
+        print(f"Bootstrapped {len(bests)} best ensembles of size {self.ens_size} with {n_boot} replicates in {self.time_log['bootstrap']:.2f} s", flush=True)
+        return bootstrap
+    
+    def _bootstrap_model_error(self, n_dataset=0):
+        """
+        Standard deviation of the best model of dataset n_dataset over the bootstrap replicates, on the q values of its library
+        """
+        names = _param_names(self.ens_size, self.n_datasets)
+        params = self.cbest_rchi2['bootstrap']['params']
+        suffix = f"_{n_dataset+1}" if (self.n_datasets > 1) else ""
+        profiles = self.data_list[n_dataset].loc[:, self.cbest_rchi2['ensemble']].values
+        models = params[:, names.index(f'c{suffix}'), None]*(params[:, -self.ens_size:]@profiles.T) + params[:, names.index(f'b{suffix}'), None]
+        return models.std(axis=0)
+    
+    def evaluate_bestfit(self, chk_chi2=True, n_dataset=0):
+        """
+        best model on the q values of the library of dataset n_dataset
+        """
+        bestpars = gen_modelparams(self.ens_size, _dataset_params(self.cbest_rchi2['fit_pars'], n_dataset, self.n_datasets))
+        library = self.data_list[n_dataset]
+        dslice = self._dataset_ranges()[n_dataset]
 
         best_model = _residual_lmf(bestpars,
-                                    self.data.loc[:,self.cbest_rchi2['ensemble']].values)
+                                    library.loc[:,self.cbest_rchi2['ensemble']].values)
         
         if chk_chi2:
-            best_model_saved = self.cbest_rchi2['model'] ## length experimental data
+            best_model_saved = self.cbest_rchi2['model'][dslice] ## length experimental data
+            experiment = self.experiment.iloc[dslice]
 
-            residuals, rchi2 = _intperp_chi2(pd.Series(index=self.data.index.values,data=best_model), self.experiment, ddof=(self.ens_size+1))
-            residuals_saved, rchi2_saved = reduced_chi2(self.experiment.iloc[:,1].values, best_model_saved, self.experiment.iloc[:,2], ddof=(self.ens_size+1))
+            residuals, rchi2 = _intperp_chi2(pd.Series(index=library.index.values,data=best_model), experiment, ddof=(self.ens_size+1))
+            residuals_saved, rchi2_saved = reduced_chi2(experiment.iloc[:,1].values, best_model_saved, experiment.iloc[:,2], ddof=(self.ens_size+1))
             print(f"lmfit = {self.cbest_rchi2['chi2']}; strict_extract = {rchi2}; strict_saved={rchi2_saved}")
             #print(residuals, self.cbest_rchi2['residuals'])
+        
+        if self.q_reduction is not None:
+            full_experiment = self.full_experiment_list[n_dataset]
+            full_residuals, full_rchi2 = _intperp_chi2(pd.Series(index=library.index.values, data=best_model), full_experiment, ddof=(self.ens_size+1))
+            self.full_fit[n_dataset] = {'chi2':full_rchi2, 'residuals':full_residuals,
+                                        'model':full_experiment['I(Q)'].values + full_residuals*full_experiment['Error'].values}
+            print(f"chi2 of the best model on the {full_experiment.shape[0]} q values of the full data = {full_rchi2}", flush=True)
         return best_model
     
+    def _has_valid_best(self):
+        """
+        True once a valid fit (every weight above cut_weight) has become the best of the run
+        """
+        return len(self.cbest_rchi2.get('fit_pars', {})) > 0
+    
     def _write_bestmodel(self, foutname: Path = Path('./'), err=True):
-        #print(self.data.index.values.shape, self.evaluate_bestfit().shape)
-        bmdf = pd.DataFrame(columns=['q', 'intensity'],
-                             data=np.vstack([self.data.index.values, self.evaluate_bestfit()]).T
-                            )
-        if err:
-            bmdf['error'] = bmdf['intensity']*0.04
-
-        bmdf.to_csv(f'{foutname}/best_model_EnsembleSize{self.ens_size}.csv', float_format='%E', sep=' ', index=None, columns=None)
-        fitpresiduals = pd.DataFrame(columns=['q','intensity','error','residuals'],
-                                      data=np.vstack([self.experiment.iloc[:,0].values,
-                                                       self.cbest_rchi2['model'],
-                                                         self.cbest_rchi2['model']*0.04, self.cbest_rchi2['residuals']]).T
-                                      )
-        fitpresiduals.to_csv(f'{foutname}/best_model_EnsembleSize{self.ens_size}_FitwResiduals.csv', float_format='%E', sep=' ', index=None, columns=None)
+        """
+        Best model and its fit to the experiment, one pair of files per dataset (_Dataset1, ... for joint fits).
+        err: error of the models, their standard deviation over the bootstrap replicates (see bootstrap_best)
+        """
+        if not self._has_valid_best():
+            print(f"No valid ensemble of size {self.ens_size} was found (every weight at least {self.cut_weight}): no best model written", flush=True)
+            return None
+        if err and ('bootstrap' not in self.cbest_rchi2) and (self.n_bootstrap > 0):
+            self.bootstrap_best()
+        for n_dataset, dslice in enumerate(self._dataset_ranges()):
+            suffix = f"_Dataset{n_dataset+1}" if (self.n_datasets > 1) else ""
+            #print(self.data.index.values.shape, self.evaluate_bestfit().shape)
+            bmdf = pd.DataFrame(columns=['q', 'intensity'],
+                                 data=np.vstack([self.data_list[n_dataset].index.values, self.evaluate_bestfit(n_dataset=n_dataset)]).T
+                                )
+            if err and ('bootstrap' in self.cbest_rchi2):
+                bmdf['error'] = self._bootstrap_model_error(n_dataset)
+            elif err:
+                bmdf['error'] = bmdf['intensity']*0.04
+
+            bmdf.to_csv(f'{foutname}/best_model_EnsembleSize{self.ens_size}{suffix}.csv', float_format='%E', sep=' ', index=None, columns=None)
+            ## with the q reduction the fit is written on the full data
+            if self.q_reduction is not None:
+                fit_q = self.full_experiment_list[n_dataset]['Q'].values
+                fit_model, fit_residuals = self.full_fit[n_dataset]['model'], self.full_fit[n_dataset]['residuals']
+            else:
+                fit_q = self.experiment.iloc[dslice,0].values
+                fit_model, fit_residuals = self.cbest_rchi2['model'][dslice], self.cbest_rchi2['residuals'][dslice]
+            fit_error = np.interp(fit_q, bmdf['q'].values, bmdf['error'].values) if err else fit_model*0.04
+            fitpresiduals = pd.DataFrame(columns=['q','intensity','error','residuals'],
+                                          data=np.vstack([fit_q, fit_model, fit_error, fit_residuals]).T
+                                          )
+            fitpresiduals.to_csv(f'{foutname}/best_model_EnsembleSize{self.ens_size}{suffix}_FitwResiduals.csv', float_format='%E', sep=' ', index=None, columns=None)
         return None
     
     def _write_parameterfile(self, pfile_name, structuredf, pfile_path: Path = Path('.')):
         """
-        Write out the best fits for the all the iterations of the genetic algorithm in order of chi^2
+        Write out the best fits for the all the iterations of the genetic algorithm (or the top ensembles of
+        the exhaustive search) in order of chi^2
         Required parameters to save:
         Fit parameters to regenerate best models
         quality of fit: chi^2 , aic
@@ -682,6 +2427,9 @@ class GAEnsembleOpt:
         Ensemble Size
         Structural Parameters:  provided by a separate file. Ordered the same as the scattering data. Should be of format PDBNAME ... parameters
         """
+        if not self._has_valid_best():
+            print(f"No valid ensemble of size {self.ens_size} was found (every weight at least {self.cut_weight}): no parameter file written", flush=True)
+            return None
         parameter_cols = ['chi2', 'aic', 'fitness', 'ensemble_size', 'generation_found']
         parameter_cols = parameter_cols + list(self.cbest_rchi2['fit_pars'].keys())
         ensemble_cols = [f'ensemble_index_{nn:d}' for nn in range(1, self.ens_size+1, 1)]
@@ -693,20 +2441,27 @@ class GAEnsembleOpt:
             parameter_cols = parameter_cols + ensemble_cols + pdb_cols 
 
         #print(parameter_cols)
-        gasans_summary_df = pd.DataFrame(index=range(0, self.n_iter, 1), columns=parameter_cols)
+        ## iterations skipped by the convergence checks have no best
+        itbest_rchi2 = [itbest for itbest in self.itbest_rchi2 if 'ensemble' in itbest]
+        ensembles = np.array([itbest['ensemble'] for itbest in itbest_rchi2], dtype=np.int64).reshape(-1, self.ens_size)
         
-        ## Order the self.itbest_rchi2
-        for ni in range(self.n_iter):
-            gasans_summary_df.loc[ni, 'chi2'] =  self.itbest_rchi2[ni]['chi2']
-            gasans_summary_df.loc[ni, 'aic'] = self.itbest_rchi2[ni]['aic']
-            gasans_summary_df.loc[ni, 'fitness'] = self.itbest_rchi2[ni]['fitness']
-            gasans_summary_df.loc[ni, 'ensemble_size'] = self.ens_size
-            gasans_summary_df.loc[ni, 'generation_found'] = self.itbest_rchi2[ni]['gen_found']
-            gasans_summary_df.loc[ni, list(self.itbest_rchi2[ni]['fit_pars'].keys())] = list(self.itbest_rchi2[ni]['fit_pars'].values())
-            gasans_summary_df.loc[ni, ensemble_cols] = self.itbest_rchi2[ni]['ensemble']
-            gasans_summary_df.loc[ni, pdb_cols] = structuredf.iloc[self.itbest_rchi2[ni]['ensemble'],0].values
-            if structuredf.shape[1]>2:
-                gasans_summary_df.loc[ni, structure_cols] = structuredf.iloc[self.itbest_rchi2[ni]['ensemble'],2:].values.flatten()
+        ## built by column at once
+        summary = {'chi2':[itbest['chi2'] for itbest in itbest_rchi2], 'aic':[itbest['aic'] for itbest in itbest_rchi2],
+                   'fitness':[itbest['fitness'] for itbest in itbest_rchi2],
+                   'ensemble_size':np.full(len(itbest_rchi2), self.ens_size),
+                   'generation_found':[itbest['gen_found'] for itbest in itbest_rchi2]}
+        summary.update({par:[itbest['fit_pars'][par] for itbest in itbest_rchi2] for par in self.cbest_rchi2['fit_pars'].keys()})
+        summary.update(dict(zip(ensemble_cols, ensembles.T)))
+        summary.update(dict(zip(pdb_cols, structuredf.iloc[:,0].values[ensembles].T)))
+        if structuredf.shape[1]>2:
+            summary.update(dict(zip(structure_cols, structuredf.iloc[:,2:].values[ensembles].reshape(ensembles.shape[0], -1).T)))
+        ## bootstrap confidence intervals of the parameters and chi2
+        if (len(itbest_rchi2) > 0) and all('bootstrap' in itbest for itbest in itbest_rchi2):
+            intervals = [_bootstrap_intervals(itbest['bootstrap'], list(self.cbest_rchi2['fit_pars'].keys()), self.bootstrap_confidence)
+                         for itbest in itbest_rchi2]
+            summary.update({col:[interval[col] for interval in intervals] for col in intervals[0].keys()})
+            parameter_cols = parameter_cols + list(intervals[0].keys())
+        gasans_summary_df = pd.DataFrame(summary, columns=parameter_cols)
         
         print(f"Writing parameter values for all iterations for ensemble size {self.ens_size}",flush=True)
         gasans_summary_df.sort_values('chi2').to_csv("{}/{}".format(pfile_path,pfile_name.format(self.ens_size)))
@@ -714,22 +2469,108 @@ class GAEnsembleOpt:
         return None
 
 
-def _read_SANSFiles(sans_dir: Path, sans_struct, qmin=0.0, qmax=0.5, nq=501):
+def _run_ensemble_size(enssize_config, scatteringdf, experimentdf, structuredf, client, checkpoint_dir=None, resume=False,
+                       results_dir=None):
     """
-    Read in the sans files 
+    Run the genetic algorithm for one ensemble size on the shared dask client and write its outputs
+    checkpoint_dir: directory of the checkpoint of every ensemble size, continued when resume is True
+    results_dir: directory of the results file (every ensemble fit) of every ensemble size
     """
+    enssize_config = dict(enssize_config)
+    if checkpoint_dir is not None:
+        enssize_config.setdefault('checkpoint_file', Path(checkpoint_dir)/f"gasans_checkpoint_EnsSize{enssize_config['ensemble_size']}.pkl")
+    if results_dir is not None:
+        enssize_config.setdefault('results_file', Path(results_dir)/f"gasans_results_EnsSize{enssize_config['ensemble_size']}.npz")
+    print(f"Running Genetic Algorithm for Ensemble Size:{enssize_config['ensemble_size']}", flush=True)
+    GARes = GAEnsembleOpt(scatteringdf,
+                          experimentdf,
+                          **enssize_config  
+#                        #ens_size=2, n_gen=5, n_iter=5, ens_split=1.0,
+#                        #mut_prob=0.1,elitism=False, invabsx2=True, parallel=True,
+                        )
+    if resume and (GARes.checkpoint_file is not None):
+        GARes.load_checkpoint()
+    GARes.evolve(dask_client=client)
+    
+    GARes.bootstrap_best()
+    GARes._write_bestmodel()
+    GARes._write_parameterfile("gasans_summary_EnsSize{}.csv", structuredf)
+    if GARes.results_file is not None:
+        GARes.save_results()
+    return GARes
 
-    scatteringdf = pd.DataFrame(index=np.linspace(qmin,qmax,nq),
-                                          columns=sans_struct.index)
+def _run_concurrent_sizes(config_ga_input, n_concurrent, *run_args):
+    """
+    _run_ensemble_size for every ensemble size config, n_concurrent at a time in threads sharing the client of run_args.
+    A size that fails is reported and the others go on.
+    Returns the GAEnsembleOpt of every finished size and the exception of every failed size, by ensemble size
+    """
+    finished, failed = {}, {}
+    with ThreadPoolExecutor(max_workers=n_concurrent) as size_pool:
+        size_runs = {size_pool.submit(_run_ensemble_size, enssize_config, *run_args):enssize_config['ensemble_size']
+                     for enssize_config in config_ga_input}
+        for size_run in as_completed(size_runs):
+            try:
+                finished[size_runs[size_run]] = size_run.result()
+            except Exception as error:
+                print(f"Genetic Algorithm for Ensemble Size:{size_runs[size_run]} failed:", flush=True)
+                traceback.print_exception(type(error), error, error.__traceback__)
+                failed[size_runs[size_run]] = error
+                continue
+            print(f"Finished Genetic Algorithm for Ensemble Size:{size_runs[size_run]}", flush=True)
+    return finished, failed
+
+def read_results(results_files):
+    """
+    Fits saved by GAEnsembleOpt.save_results as one dataframe, for one file or a list of them (e.g. one per ensemble size):
+    ensemble_size, iteration, generation, chi2, aic, fitness, the fit parameters and ensemble_index_1...
+    """
+    if isinstance(results_files, (str, Path)):
+        results_files = [results_files]
     
-    for nn, file in sans_struct.iterrows():
-        #print(file['SCATTERINGFILE'])
-        sansdf = pd.read_csv(f"{sans_dir}/{file['SCATTERINGFILE']}", delim_whitespace=True,
-                                usecols=[0,1], skiprows=6, header=None, names=['q','I'])
-        
-        scatteringdf.loc[:,nn] = sansdf['I'].values
+    results_dfs = []
+    for results_file in results_files:
+        with np.load(results_file) as results:
+            results_df = pd.DataFrame({'ensemble_size':np.full(results['chi2'].shape[0], int(results['ensemble_size'])),
+                                       'iteration':results['iteration'], 'generation':results['generation'],
+                                       'chi2':results['chi2'], 'aic':results['aic'], 'fitness':results['fitness']})
+            results_df = pd.concat([results_df,
+                                    pd.DataFrame(results['params'], columns=results['param_names']),
+                                    pd.DataFrame(results['ensemble'], columns=[f'ensemble_index_{nn:d}' for nn in range(1, results['ensemble'].shape[1]+1, 1)])],
+                                   axis=1)
+        results_dfs.append(results_df)
+    return pd.concat(results_dfs, ignore_index=True)
+
+def _reduce_qpoints(expdata, method='rebin', n_q=None, dmax=None, oversampling=3):
+    """
+    Error weighted rebinning of an experiment to fewer q values for the fits.
+    method 'rebin': n_q bins of equal width in q
+           'shannon': oversampling bins per Shannon channel of width pi/dmax (dmax the maximal dimension in A)
+    Q and I(Q) of a bin are the 1/Error^2 weighted means of its points and Error = 1/sqrt(sum(1/Error^2)).
+    Experiments with no more points than bins are returned as they are
+    """
+    q = expdata['Q'].values
+    if method == 'shannon':
+        if dmax is None:
+            raise ValueError("The Shannon channel reduction needs the maximal dimension dmax")
+        n_bins = int(np.ceil(oversampling*(q.max()-q.min())*dmax/np.pi))
+    elif method == 'rebin':
+        if n_q is None:
+            raise ValueError("The rebinning needs the number of q values n_q")
+        n_bins = int(n_q)
+    else:
+        raise ValueError(f"q_reduction must be 'rebin' or 'shannon', not {method}")
+    if n_bins >= q.shape[0]:
+        return expdata.copy()
     
-    return scatteringdf
+    edges = np.linspace(q.min(), q.max(), n_bins+1)
+    bins = np.clip(np.digitize(q, edges)-1, 0, n_bins-1)
+    inv_var = 1.0/np.power(expdata['Error'].values, 2)
+    weight_sum = np.bincount(bins, weights=inv_var, minlength=n_bins)
+    occupied = weight_sum > 0
+    return pd.DataFrame({'Q':np.bincount(bins, weights=q*inv_var, minlength=n_bins)[occupied]/weight_sum[occupied],
+                         'I(Q)':np.bincount(bins, weights=expdata['I(Q)'].values*inv_var, minlength=n_bins)[occupied]/weight_sum[occupied],
+                         'Error':1.0/np.sqrt(weight_sum[occupied])})
 
 def _read_experiment_data(dataloc,):
     
@@ -750,43 +2591,79 @@ if __name__=="__main__":
     if config_file1.exists():
         print(f"config file, {config_file1}, exists. Reading config file")
         config_filelist, config_ga_input = _read_json_input(config_file1)
+        run_options = _read_json_section(config_file1, 'run', {'concurrent_sizes':True, 'checkpoint_dir':None, 'resume':False,
+                                                                'incremental_sizes':False, 'n_seed_ensembles':10,
+                                                                'results_dir':None, 'executor':'dask', 'n_workers':None,
+                                                                'cpu_fraction':0.8, 'threads_per_worker':1,
+                                                                'scheduler_address':None})
+        data_options = _read_json_section(config_file1, 'data', {'qmin':0.02, 'qmax':0.45})
     else:
         print(f"config file, {config_file1}, does not exist")
 
-    path2sans = Path(config_filelist['scatter_dir'])
+    ## several experiments (e.g. contrasts) with a scatter_dir each are fit jointly
+    experiment_files = config_filelist['experiment'] if isinstance(config_filelist['experiment'], list) else [config_filelist['experiment']]
+    scatter_dirs = config_filelist['scatter_dir'] if isinstance(config_filelist['scatter_dir'], list) else [config_filelist['scatter_dir']]
+    if len(scatter_dirs) != len(experiment_files):
+        raise SystemExit(f"{len(experiment_files)} experiments need as many scatter_dir entries, not {len(scatter_dirs)}")
 
     ## Need to make this arbirary read to also remove comments
-    experiment_datadf = _read_experiment_data(config_filelist['experiment'])
-    qmin = 0.02
-    qmax = 0.45 
+    ## fitting range of the experiments
+    qmin = data_options['qmin']
+    qmax = data_options['qmax']
 
     ScatStructureDF = pd.read_csv(config_filelist['structurefile']) 
     print(ScatStructureDF.head())
     
-    ## Changed to local path or like MultiFOXS a txt file of paths to scattering intensities
-    ## 
-    ensemble_scatteringdf = _read_SANSFiles(config_filelist['scatter_dir'], ScatStructureDF)
-
-    exp_qmax_ndx = np.where(experiment_datadf['Q']<qmax)[0][-1]
-    for enssize_config in config_ga_input:
-        print(f"Running Genetic Algorithm for Ensemble Size:{enssize_config['ensemble_size']}")
-        GARes = GAEnsembleOpt(ensemble_scatteringdf,
-                              experiment_datadf.iloc[1:exp_qmax_ndx],
-                              **enssize_config  
-    #                        #ens_size=2, n_gen=5, n_iter=5, ens_split=1.0,
-    #                        #mut_prob=0.1,elitism=False, invabsx2=True, parallel=True,
-                            )
+    experiment_datadfs = []
+    ensemble_scatteringdfs = []
+    for ndataset, (experiment_file, scatter_dir) in enumerate(zip(experiment_files, scatter_dirs)):
+        experiment_datadf = _read_experiment_data(experiment_file)
+        in_qrange = (experiment_datadf['Q'] >= qmin) & (experiment_datadf['Q'] <= qmax)
+        experiment_datadfs.append(experiment_datadf[in_qrange].reset_index(drop=True))
+        
+        library_cache = config_filelist.get('library_cache', None)
+        if (library_cache is not None) and (len(scatter_dirs) > 1):
+            library_cache = Path(library_cache).with_name(f"{Path(library_cache).stem}_Dataset{ndataset+1}{Path(library_cache).suffix}")
+        ## Changed to local path or like MultiFOXS a txt file of paths to scattering intensities
+        ## 
+        ensemble_scatteringdfs.append(_read_SANSFiles(scatter_dir, ScatStructureDF,
+                                                      n_workers=config_filelist.get('read_workers', None),
+                                                      cache_file=library_cache))
+    if len(experiment_files) == 1:
+        experiment_datadfs, ensemble_scatteringdfs = experiment_datadfs[0], ensemble_scatteringdfs[0]
     
-        with distributed.LocalCluster(n_workers=int(0.8*os.cpu_count()),
-                                  processes=True,
-                                  threads_per_worker=1,
-                                  ) as cluster, distributed.Client(cluster) as client:
-            GARes.evolve(dask_client=client)
-
-        #print(GA2_HDX.time_log)
-        #print(GA2_HDX.cbest_rchi2)
+    ## One client for the whole job. The ensemble sizes run concurrently in threads of this process and
+    ## interleave their fitness tasks on the shared workers; each size writes its outputs when it finishes.
+    ## The executor is a dask LocalCluster (or an existing scheduler), or a serial, thread or process pool for small jobs
+    with make_client(run_options['executor'], n_workers=run_options['n_workers'], cpu_fraction=run_options['cpu_fraction'],
+                     threads_per_worker=run_options['threads_per_worker'],
+                     scheduler_address=run_options['scheduler_address']) as client:
+        
+        if run_options['incremental_sizes']:
+            ## each size starts from the best ensembles of the size before it, so the sizes run in order
+            ## a failed size is reported and the next one starts from random parents
+            seed_ensembles = None
+            failed_sizes = []
+            for enssize_config in sorted(config_ga_input, key=lambda enssize_config: enssize_config['ensemble_size']):
+                try:
+                    GARes = _run_ensemble_size(dict(enssize_config, seed_ensembles=seed_ensembles), ensemble_scatteringdfs,
+                                               experiment_datadfs, ScatStructureDF, client,
+                                               run_options['checkpoint_dir'], run_options['resume'], run_options['results_dir'])
+                except Exception as error:
+                    print(f"Genetic Algorithm for Ensemble Size:{enssize_config['ensemble_size']} failed:", flush=True)
+                    traceback.print_exception(type(error), error, error.__traceback__)
+                    failed_sizes.append(enssize_config['ensemble_size'])
+                    seed_ensembles = None
+                    continue
+                seed_ensembles = GARes.top_ensembles(run_options['n_seed_ensembles'])
+                print(f"Finished Genetic Algorithm for Ensemble Size:{enssize_config['ensemble_size']}", flush=True)
+        else:
+            n_concurrent = len(config_ga_input) if run_options['concurrent_sizes'] else 1
+            size_results, size_failures = _run_concurrent_sizes(config_ga_input, n_concurrent, ensemble_scatteringdfs,
+                                                                experiment_datadfs, ScatStructureDF, client,
+                                                                run_options['checkpoint_dir'], run_options['resume'],
+                                                                run_options['results_dir'])
+            failed_sizes = sorted(size_failures.keys())
     
-        GARes._write_bestmodel()
-        GARes._write_parameterfile("gasans_summary_EnsSize{}.csv", ScatStructureDF)
-
-
+    if len(failed_sizes) > 0:
+        raise SystemExit(f"The ensemble sizes {failed_sizes} failed, the outputs of the other sizes were written")
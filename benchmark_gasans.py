@@ -0,0 +1,180 @@
+#!/bin/python
+"""
+Throughput and scaling benchmark of GASANS-dask.py on synthetic libraries.
+
+Generates Pepsi-SANS like libraries (sphere and Guinier profiles on the 0-0.5 1/A grid of 501 points) and an
+experimental curve made from a random ensemble of them, then reports
+    setup: time and peak memory of GAEnsembleOpt.__init__ (library interpolation)
+    evaluation: fitness evaluations per second of one generation
+    evolve: time_log stages of a short run
+    scaling: strong (same population) and weak (population growing with the workers) scaling over 1..N local workers
+             of the --executor backend (Dask by default)
+as JSON, to compare runs. With the batched linear fit the generation is fit on the client, use --no-batch
+(or an lmfit --fitting-algorithm) to measure the scaling of the fits on the workers:
+
+    python benchmark_gasans.py --nconf 2000 --nq 150 --ensemble-size 2 3 --max-workers 4 --output bench.json
+"""
+import argparse
+import importlib.util
+import json
+import os
+import platform
+import resource
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import dask
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+from executors import make_client
+_spec = importlib.util.spec_from_file_location("gasans", Path(__file__).resolve().parent/"GASANS-dask.py")
+gasans = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(gasans)
+
+
+def synthetic_library(nconf=1000, nq=100, ensemble_size=2, seed=0):
+    """
+    nconf sphere/Guinier profiles on the Pepsi-SANS q grid and a nq point experimental curve
+    of an ensemble_size ensemble of them, with 2% errors
+    """
+    rng = np.random.default_rng(seed)
+    q = np.linspace(0, 0.5, 501)
+    radius = rng.uniform(10, 40, nconf)
+    qr = np.outer(q, radius)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        sphere = np.where(qr > 0, 3*(np.sin(qr)-qr*np.cos(qr))/np.power(qr, 3), 1.0)
+    guinier = np.exp(-np.power(qr, 2)/5.0)
+    mix = rng.uniform(0, 1, nconf)
+    library = pd.DataFrame(index=q, data=100*(mix*np.power(sphere, 2) + (1-mix)*guinier) + 0.05)
+
+    ensemble = rng.choice(nconf, ensemble_size, replace=False)
+    weights = rng.dirichlet(np.ones(ensemble_size))
+    expQ = np.linspace(0.01, 0.45, nq)
+    intensity = 2.0*sum(weight*np.interp(expQ, q, library[nconf_ens].values) for weight, nconf_ens in zip(weights, ensemble)) + 0.01
+    error = 0.02*intensity + 1e-3
+    expdata = pd.DataFrame({'Q':expQ, 'I(Q)':intensity + rng.normal(0, error), 'Error':error})
+    return library, expdata, {'ensemble':ensemble.tolist(), 'weights':weights.tolist()}
+
+def _max_rss_mb():
+    ## ru_maxrss is in kB on linux and in bytes on macOS
+    scale = 1.0/1024 if sys.platform != 'darwin' else 1.0/1024**2
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*scale
+
+def bench_setup(library, expdata, ga_options):
+    """
+    Time and peak python memory of GAEnsembleOpt.__init__
+    """
+    tracemalloc.start()
+    setup_start = time.perf_counter()
+    ga = gasans.GAEnsembleOpt(library, expdata, **ga_options)
+    setup_time = time.perf_counter()-setup_start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return ga, {'time':setup_time, 'peak_memory_mb':peak/1024**2}
+
+def bench_evaluation(ga, client, repeats=3):
+    """
+    Fitness evaluations per second of one generation of random parents, without the fitness cache
+    """
+    fitness_cache, ga.fitness_cache = ga.fitness_cache, None
+    times = []
+    for nrepeat in range(repeats):
+        parents = ga.indices[ga.randomcol_indices()]
+        eval_start = time.perf_counter()
+        ga._evaluate_fits(parents, client)
+        times.append(time.perf_counter()-eval_start)
+    ga.fitness_cache = fitness_cache
+    ga._release_library()
+    return {'n_ensembles':int(ga.n_ens), 'times':times, 'evaluations_per_s':ga.n_ens/np.median(times)}
+
+def bench_evolve(ga, client):
+    """
+    Wall time and time_log stages of a short run
+    """
+    evolve_start = time.perf_counter()
+    ga.evolve(dask_client=client)
+    return {'time':time.perf_counter()-evolve_start, 'time_log':{ky:float(val) for ky, val in ga.time_log.items()},
+            'best_chi2':float(ga.cbest_rchi2['chi2']), 'best_ensemble':[int(ndx) for ndx in ga.cbest_rchi2['ensemble']]}
+
+def bench_scaling(args, ensemble_size, ga_options):
+    """
+    Evaluations per second on 1..max_workers local workers.
+    strong: the same library for every number of workers, weak: nconf*n_workers conformers
+    """
+    scaling = {'strong':[], 'weak':[]}
+    library, expdata, truth = synthetic_library(args.nconf, args.nq, ensemble_size, args.seed)
+    for n_workers in range(1, args.max_workers+1):
+        with make_client(args.executor, n_workers=n_workers) as client:
+            ga = gasans.GAEnsembleOpt(library, expdata, **ga_options)
+            scaling['strong'].append(dict(bench_evaluation(ga, client, args.repeats), n_workers=n_workers))
+
+            weak_library, weak_expdata, truth = synthetic_library(args.nconf*n_workers, args.nq, ensemble_size, args.seed)
+            ga = gasans.GAEnsembleOpt(weak_library, weak_expdata, **ga_options)
+            scaling['weak'].append(dict(bench_evaluation(ga, client, args.repeats), n_workers=n_workers))
+        print(f"Ensemble size {ensemble_size}, {n_workers} workers: "
+              f"{scaling['strong'][-1]['evaluations_per_s']:.1f} evaluations/s", flush=True)
+
+    for mode in ('strong', 'weak'):
+        base = scaling[mode][0]['evaluations_per_s']
+        for point in scaling[mode]:
+            point['speedup'] = point['evaluations_per_s']/base
+            point['efficiency'] = point['speedup']/point['n_workers'] if mode == 'strong' else \
+                                  point['evaluations_per_s']/(base*point['n_workers'])
+    return scaling
+
+def run_benchmarks(args):
+    results = {'machine':{'platform':platform.platform(), 'python':platform.python_version(), 'cpu_count':os.cpu_count(),
+                          'numpy':np.__version__, 'pandas':pd.__version__, 'dask':dask.__version__},
+               'options':vars(args), 'sizes':{}}
+
+    for ensemble_size in args.ensemble_size:
+        ga_options = {'ensemble_size':ensemble_size, 'number_generations':args.generations, 'number_iterations':1,
+                      'fitting_algorithm':args.fitting_algorithm, 'random_seed':args.seed,
+                      'batch_evaluation':not args.no_batch}
+        library, expdata, truth = synthetic_library(args.nconf, args.nq, ensemble_size, args.seed)
+        size_results = {'truth':truth}
+
+        with make_client(args.executor, n_workers=args.workers) as client:
+            ga, size_results['setup'] = bench_setup(library, expdata, ga_options)
+            size_results['evaluation'] = bench_evaluation(ga, client, args.repeats)
+            size_results['evolve'] = bench_evolve(ga, client)
+        print(f"Ensemble size {ensemble_size}: setup {size_results['setup']['time']:.2f} s, "
+              f"{size_results['evaluation']['evaluations_per_s']:.1f} evaluations/s", flush=True)
+
+        if args.max_workers > 0:
+            size_results['scaling'] = bench_scaling(args, ensemble_size, ga_options)
+        results['sizes'][str(ensemble_size)] = size_results
+
+    results['peak_rss_mb'] = _max_rss_mb()
+    return results
+
+def _parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Throughput and scaling benchmark of GASANS-dask.py on synthetic libraries")
+    parser.add_argument('--nconf', type=int, default=1000, help="number of conformers in the library")
+    parser.add_argument('--nq', type=int, default=100, help="number of experimental q values")
+    parser.add_argument('--ensemble-size', type=int, nargs='+', default=[2], help="ensemble sizes to benchmark")
+    parser.add_argument('--fitting-algorithm', default='Linear Least Squares', help="fitting_algorithm of GAEnsembleOpt")
+    parser.add_argument('--no-batch', action='store_true', help="fit the ensembles one by one on the workers")
+    parser.add_argument('--generations', type=int, default=10, help="generations of the evolve run")
+    parser.add_argument('--repeats', type=int, default=3, help="generations timed for the evaluations per second")
+    parser.add_argument('--executor', default='dask', choices=['serial', 'threads', 'processes', 'dask'],
+                        help="backend of the fits, see executors.make_client")
+    parser.add_argument('--workers', type=int, default=max(1, int(0.8*os.cpu_count())), help="workers of the throughput runs")
+    parser.add_argument('--max-workers', type=int, default=0, help="scaling over 1..max_workers workers (0 to skip)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None, help="JSON file for the results, printed if not given")
+    return parser.parse_args(argv)
+
+if __name__=="__main__":
+
+    bench_args = _parse_args()
+    bench_results = run_benchmarks(bench_args)
+    if bench_args.output is None:
+        print(json.dumps(bench_results, indent=2, default=float))
+    else:
+        with open(bench_args.output, 'w') as fout:
+            json.dump(bench_results, fout, indent=2, default=float)
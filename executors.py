@@ -0,0 +1,194 @@
+"""
+Execution backends for the ensemble fits: the dask client of GAEnsembleOpt, or a local stand-in for it
+running the fits serially, in a thread pool or in a process pool
+"""
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future, FIRST_COMPLETED
+import concurrent.futures
+import contextlib
+import functools
+import itertools
+import os
+import shutil
+import tempfile
+import threading
+import cloudpickle
+import numpy as np
+import dask.distributed as distributed
+
+
+EXECUTOR_BACKENDS = ('serial', 'threads', 'processes', 'dask')
+
+def _n_workers(n_workers=None, cpu_fraction=0.8):
+    """
+    n_workers, or the cpu_fraction of the CPUs of the machine (at least 1)
+    """
+    if n_workers is not None:
+        return max(1, int(n_workers))
+    return max(1, int(cpu_fraction*os.cpu_count()))
+
+@functools.lru_cache(maxsize=16)
+def _loads_function(func_bytes):
+    return cloudpickle.loads(func_bytes)
+
+def _call_pickled(func_bytes, args_bytes):
+    """
+    Run a function sent to a worker process with cloudpickle, so functions of modules the worker
+    cannot import (e.g. GASANS-dask.py) can be sent. The function is unpickled once per process
+    """
+    args, kwargs = cloudpickle.loads(args_bytes)
+    return _loads_function(func_bytes)(*args, **kwargs)
+
+
+class LocalClient:
+    """
+    The part of the dask client used by GAEnsembleOpt (submit, map, gather, scatter, cancel, nthreads),
+    running the fits in this process:
+    'serial': one at a time when submitted, no startup cost for small jobs
+    'threads': thread pool of n_workers*threads_per_worker threads sharing the library (numpy releases the GIL)
+    'processes': pool of n_workers processes. The scattered library is saved once to a .npy file in shared memory
+                 (/dev/shm when there is one), the workers memory-map it so it is not copied to every worker
+    """
+    def __init__(self, backend='serial', n_workers=1, threads_per_worker=1, shared_dir=None):
+        if backend not in ('serial', 'threads', 'processes'):
+            raise ValueError(f"LocalClient backend must be 'serial', 'threads' or 'processes', not {backend}")
+        self.backend = backend
+        self.n_workers = 1 if (backend == 'serial') else max(1, int(n_workers))
+        self.threads_per_worker = threads_per_worker if (backend == 'threads') else 1
+        if backend == 'threads':
+            self.pool = ThreadPoolExecutor(max_workers=self.n_workers*self.threads_per_worker)
+        elif backend == 'processes':
+            self.pool = ProcessPoolExecutor(max_workers=self.n_workers)
+        else:
+            self.pool = None
+
+        if (shared_dir is None) and Path('/dev/shm').is_dir():
+            shared_dir = '/dev/shm'
+        self.shared_dir = shared_dir
+        self.scatter_dir = None
+        ## scatter can be called from several threads (e.g. the concurrent ensemble sizes of __main__)
+        self._scatter_lock = threading.Lock()
+        self._scatter_count = itertools.count()
+        self._pickled_functions = {}
+
+    def submit(self, func, *args, pure=None, **kwargs):
+        """
+        Run func(*args, **kwargs) on the pool, returns a concurrent.futures.Future
+        pure is accepted for the dask signature, every call is run
+        """
+        if self.backend == 'serial':
+            future = Future()
+            try:
+                future.set_result(func(*args, **kwargs))
+            except Exception as error:
+                future.set_exception(error)
+            return future
+        if self.backend == 'threads':
+            return self.pool.submit(func, *args, **kwargs)
+        if func not in self._pickled_functions:
+            self._pickled_functions[func] = cloudpickle.dumps(func)
+        return self.pool.submit(_call_pickled, self._pickled_functions[func], cloudpickle.dumps((args, kwargs)))
+
+    def map(self, func, *iterables, pure=None, **kwargs):
+        return [self.submit(func, *args, **kwargs) for args in zip(*iterables)]
+
+    def gather(self, futures):
+        return [future.result() for future in futures]
+
+    def scatter(self, data, broadcast=True, hash=True):
+        """
+        Data for the workers. Threads share the data as it is, a process pool gets arrays as the path
+        of a .npy file in shared_dir that the workers memory-map. Every scatter has its own file, hash is
+        only there for the signature of dask's scatter
+        """
+        if (self.backend != 'processes') or (not isinstance(data, np.ndarray)):
+            return data
+        with self._scatter_lock:
+            if self.scatter_dir is None:
+                self.scatter_dir = tempfile.mkdtemp(prefix='gasans_', dir=self.shared_dir)
+            scatter_file = Path(self.scatter_dir)/f"scattered_{next(self._scatter_count)}.npy"
+        np.save(scatter_file, data)
+        return str(scatter_file)
+
+    def cancel(self, futures):
+        ## scattered data is the data itself or its file, removed with the scatter directory
+        for future in futures:
+            if isinstance(future, Future):
+                future.cancel()
+
+    def nthreads(self):
+        return {f"local-{nworker}":self.threads_per_worker for nworker in range(self.n_workers)}
+
+    def scheduler_info(self):
+        return {'workers':{worker:{'nthreads':nthreads} for worker, nthreads in self.nthreads().items()}}
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=True, cancel_futures=True)
+        if self.scatter_dir is not None:
+            shutil.rmtree(self.scatter_dir, ignore_errors=True)
+            self.scatter_dir = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class LocalAsCompleted:
+    """
+    distributed.as_completed for the futures of a LocalClient: iterate over the futures (and their
+    results with with_results) as they finish, futures can be added while iterating
+    """
+    def __init__(self, futures=(), with_results=False):
+        self.futures = set(futures)
+        self.with_results = with_results
+
+    def add(self, future):
+        self.futures.add(future)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if len(self.futures) == 0:
+            raise StopIteration
+        done = next(iter(concurrent.futures.wait(self.futures, return_when=FIRST_COMPLETED).done))
+        self.futures.remove(done)
+        return (done, done.result()) if self.with_results else done
+
+
+def as_completed(client, futures=(), with_results=False):
+    """
+    distributed.as_completed, or LocalAsCompleted for a LocalClient
+    """
+    if isinstance(client, LocalClient):
+        return LocalAsCompleted(futures, with_results=with_results)
+    return distributed.as_completed(futures, with_results=with_results)
+
+def is_dask_client(client):
+    return isinstance(client, distributed.Client)
+
+@contextlib.contextmanager
+def make_client(executor='dask', n_workers=None, cpu_fraction=0.8, threads_per_worker=1, scheduler_address=None):
+    """
+    Client for the fits of the "run" section options:
+    executor: 'serial', 'threads', 'processes' (LocalClient) or 'dask' (a LocalCluster, or the scheduler at scheduler_address)
+    n_workers: number of workers, or the cpu_fraction of the CPUs when not given
+    threads_per_worker: threads of each worker (threads and dask)
+    """
+    if executor not in EXECUTOR_BACKENDS:
+        raise ValueError(f"executor must be one of {EXECUTOR_BACKENDS}, not {executor}")
+    if executor != 'dask':
+        with LocalClient(executor, _n_workers(n_workers, cpu_fraction), threads_per_worker) as client:
+            yield client
+    elif scheduler_address is not None:
+        with distributed.Client(scheduler_address) as client:
+            yield client
+    else:
+        with distributed.LocalCluster(n_workers=_n_workers(n_workers, cpu_fraction),
+                                      processes=True,
+                                      threads_per_worker=threads_per_worker,
+                                      ) as cluster, distributed.Client(cluster) as client:
+            yield client
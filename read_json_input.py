@@ -7,7 +7,7 @@ def _read_json_input(config_file="./config.json"):
     Function to read a json file for the inputs of the genetic algorithm:
     mapping function to change dict keys to 
     Should include:
-    experimental data to read in 
+    experimental data to read in (a list of files, with a list of scatter_dir, to fit several contrasts jointly)
     directory of the files if not in working directory
     scattering data file: PDBFILENAME SCATTERINGFILENAME [...Structural Parameters...]
     Genetic Algorithm:
@@ -21,6 +21,26 @@ def _read_json_input(config_file="./config.json"):
     8. Evaluation of Fitness (standard or inv_absolute)
     9. Run evaluation step in parallel (parallel) (if parallel = False: Nedler-Mead instead of DiffEv)
     10. what type of algorithm to use the weights (default is Differential Evolution )
+        'Linear Least Squares' solves the weights exactly as a bounded linear least squares problem
+    11. fit the whole generation at once when using 'Linear Least Squares' (batch_evaluation, default True)
+    12. number of ensemble fits to cache (fitness_cache_size, 0 to turn off) and keep over the iterations (persist_fitness_cache)
+    13. directory to cache the interpolation of the library to the experimental q values (interpolation_cache_dir)
+    14. interpolated library storage: library_backend ('memory' or 'memmap'), library_dtype ('float64' or 'float32'), library_file
+    15. run the iterations at the same time as islands (island_model) exchanging n_migrants ensembles every migration_interval generations
+    16. seed of the random number generator (random_seed) for reproducible runs
+    17. run over the medoids of n_clusters clusters of the profiles, and again over the winning clusters (refine_clusters)
+    18. search_mode "exhaustive" fits every ensemble (linear fitting only), keeping the exhaustive_topk best, in chunks of exhaustive_chunksize
+    19. stopping rules: convergence_generations, convergence_tolerance, min_diversity, time_budget (s) and iteration_agreement
+    20. checkpoint_interval: generations between checkpoints when the "run" section has a checkpoint_dir
+    21. telemetry_file (JSON lines per generation) and profile_generations profiled with profile_mode "cprofile" or "dask" into profile_dir
+    22. warm_start the lmfit fits from the weights of the previous generation with local_method (default leastsq)
+    23. q_reduction ('rebin' to n_q values or 'shannon' with dmax and q_oversampling) of the experiment for the fits
+    24. seed_fraction of the initial parents extending the best ensembles of the previous size, with one of the
+        seed_candidates best ranked conformers, when the "run" section has incremental_sizes
+    25. evolution_mode "steady_state" keeps steady_state_inflight fits running and breeds as the fits finish
+    26. n_bootstrap replicates (default 0, bootstrap_method "error" or "q") for the bootstrap_confidence intervals of the best ensembles
+    27. gram_index scores the linear fits from the inner products of the profiles (memory-mapped from gram_index_file if given,
+        reused by the runs with the same profiles and errors)
     
     """
     
@@ -28,15 +48,37 @@ def _read_json_input(config_file="./config.json"):
         cfile_params = json.load(cfile)
     
     ga_input_list = []
-    ga_param_ndx = 2
-    cfile_keys = list(cfile_params.keys())
+    ## GA entries in the order of the file, other sections (e.g. "run") can be anywhere in the file
+    cfile_keys = [ky for ky in cfile_params.keys() if ky.startswith('GA_input')]
     for nens, ens_size in enumerate(range(2, cfile_params['max_ensemble_size']+1, 1)):
         
-        ga_input_list.append(cfile_params[cfile_keys[ga_param_ndx+nens]])
+        ga_input_list.append(cfile_params[cfile_keys[nens]])
 
 
     return cfile_params['files'], ga_input_list
 
+def _read_json_section(config_file="./config.json", section="run", defaults={}):
+    """
+    Read an optional section of the json config file, e.g. the "run" options of the whole job:
+    concurrent_sizes: run every ensemble size at the same time on the cluster (default True)
+    checkpoint_dir: directory of the checkpoint of every ensemble size (default None, no checkpoints)
+    resume: continue every ensemble size from its checkpoint in checkpoint_dir (default False)
+    incremental_sizes: run the sizes one after the other, each seeded with the n_seed_ensembles (default 10)
+                       best ensembles of the previous size (default False)
+    results_dir: directory of the file of every ensemble fit of every ensemble size (default None, not saved)
+    executor: where the fits run, 'dask' (default), 'processes', 'threads' or 'serial', see executors.make_client,
+              with n_workers (default None: cpu_fraction, 0.8, of the CPUs), threads_per_worker (default 1)
+              and scheduler_address (default None: a local dask cluster)
+    or the "data" options: qmin, qmax of the experimental q values to fit (default 0.02, 0.45)
+    Entries missing from the file take the values in defaults
+    """
+    with open(config_file ,mode='r') as cfile:
+        cfile_params = json.load(cfile)
+    
+    section_params = dict(defaults)
+    section_params.update(cfile_params.get(section, {}))
+    return section_params
+
 if __name__=="__main__":
 
     #with open("testing_read.json", mode='w', encoding='utf-8') as testjson:
@@ -0,0 +1,285 @@
+"""
+Scattering library utilities: reading the calculated profiles and resampling them to the experimental q values
+"""
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import functools
+import hashlib
+import json
+import os
+import tempfile
+import numpy as np
+import pandas as pd
+import scipy.interpolate as scpint
+
+
+def _grid_key(*grids):
+    """
+    Short hash of the q grids, used to name the cached files
+    """
+    grid_hash = hashlib.sha1()
+    for grid in grids:
+        grid_hash.update(np.ascontiguousarray(grid, dtype=np.float64).tobytes())
+    return grid_hash.hexdigest()[:16]
+
+def _temporary_file(target_file, suffix='.tmp.npy'):
+    """
+    New empty file next to target_file, unique to this writer, to write target_file atomically with os.replace
+    even when several threads or processes write it at the same time
+    """
+    target_file = Path(target_file)
+    fd, tmp_file = tempfile.mkstemp(dir=target_file.parent, prefix=target_file.name+'.', suffix=suffix)
+    os.close(fd)
+    return Path(tmp_file)
+
+def _interpolation_operator(model_q, exp_q, cache_dir=None):
+    """
+    Matrix that resamples profiles from model_q to exp_q: I(exp_q) = operator @ I(model_q)
+    An interpolating cubic spline (splrep with s=0, not-a-knot ends) is linear in the intensities,
+    so interpolating the identity gives the same result as fitting a spline to every profile.
+    cache_dir: directory to save/load the operator, keyed by both q grids
+    Returns the (len(exp_q), len(model_q)) operator
+    """
+    if cache_dir is not None:
+        cache_file = Path(cache_dir)/f"interp_operator_{_grid_key(model_q, exp_q)}.npy"
+        if cache_file.exists():
+            return np.load(cache_file)
+    
+    operator = scpint.make_interp_spline(model_q, np.eye(model_q.shape[0]), k=3)(exp_q)
+    
+    if cache_dir is not None:
+        Path(cache_dir).mkdir(parents=True, exist_ok=True)
+        tmp_file = _temporary_file(cache_file)
+        np.save(tmp_file, operator)
+        os.replace(tmp_file, cache_file)
+    return operator
+
+def _interpolate_library(library, model_q, exp_q, cache_dir=None):
+    """
+    Resample the whole (nq, nConf) library to the experimental q values with one matrix product
+    Returns the (nConf, len(exp_q)) interpolated library
+    """
+    operator = _interpolation_operator(np.asarray(model_q, dtype=np.float64), np.asarray(exp_q, dtype=np.float64), cache_dir)
+    return (operator@np.asarray(library, dtype=np.float64)).T
+
+def _interpolate_library_memmap(library, model_q, exp_q, library_file, dtype=np.float32, chunk_size=10000, cache_dir=None):
+    """
+    Resample the (nq, nConf) library into a memory-mapped .npy file, chunk_size conformers at a time.
+    The file is conformer-major (nConf, len(exp_q)) so an ensemble is a set of contiguous rows, and it is
+    written to a temporary file first so processes already reading library_file are not disturbed.
+    Returns the read-only memmap of library_file
+    """
+    operator = _interpolation_operator(np.asarray(model_q, dtype=np.float64), np.asarray(exp_q, dtype=np.float64), cache_dir)
+    library_file = Path(library_file)
+    tmp_file = _temporary_file(library_file)
+    
+    interp_library = np.lib.format.open_memmap(tmp_file, mode='w+', dtype=dtype, shape=(library.shape[1], operator.shape[0]))
+    for nstart in range(0, library.shape[1], chunk_size):
+        interp_library[nstart:nstart+chunk_size] = (operator@np.asarray(library[:, nstart:nstart+chunk_size], dtype=np.float64)).T
+    interp_library.flush()
+    del interp_library
+    
+    os.replace(tmp_file, library_file)
+    return np.load(library_file, mmap_mode='r')
+
+@functools.lru_cache(maxsize=4)
+def _open_library(library_file, mtime_ns=None):
+    """
+    Open a memory-mapped library read-only, once per process. The pages are shared by every process mapping the same file.
+    mtime_ns: modification time of library_file so a rewritten file is opened again
+    """
+    return np.load(library_file, mmap_mode='r')
+
+def _cluster_profiles(profiles, sigma=None, n_clusters=100, n_refine=10, chunk_size=10000, rng=None):
+    """
+    Cluster the interpolated profiles (nConf, nq) by their error weighted distance on the experimental q values,
+    d_ij^2 = sum(((I_i - I_j)/sigma)^2). Starts from n_clusters profiles drawn as in k-means++ and refines the
+    centers with n_refine k-means iterations, the distances are computed in chunks of conformers as matrix products.
+    Returns the medoids (conformer closest to each center) and the cluster label of every conformer
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+    if sigma is None:
+        sigma = np.ones(profiles.shape[1])
+    n_clusters = min(n_clusters, profiles.shape[0])
+    
+    def nearest(centers):
+        labels = np.zeros(profiles.shape[0], dtype=np.int64)
+        distances = np.zeros(profiles.shape[0])
+        center_norm = np.power(centers, 2).sum(axis=1)
+        for nstart in range(0, profiles.shape[0], chunk_size):
+            weighted = np.asarray(profiles[nstart:nstart+chunk_size], dtype=np.float64)/sigma
+            dist2 = np.power(weighted, 2).sum(axis=1)[:, None] + center_norm[None, :] - 2*weighted@centers.T
+            labels[nstart:nstart+chunk_size] = dist2.argmin(axis=1)
+            distances[nstart:nstart+chunk_size] = dist2.min(axis=1).clip(min=0)
+        return labels, distances
+    
+    ## k-means++ start: every new center is drawn with probability proportional to the distance to the closest center
+    centers = np.asarray(profiles[[rng.integers(profiles.shape[0])]], dtype=np.float64)/sigma
+    distances = nearest(centers)[1]
+    while (centers.shape[0] < n_clusters) and (distances.sum() > 0):
+        new_center = np.asarray(profiles[[rng.choice(profiles.shape[0], p=distances/distances.sum())]], dtype=np.float64)/sigma
+        distances = np.minimum(distances, nearest(new_center)[1])
+        centers = np.vstack([centers, new_center])
+    for nrefine in range(n_refine):
+        labels, distances = nearest(centers)
+        counts = np.bincount(labels, minlength=centers.shape[0])
+        sums = np.zeros_like(centers)
+        for nstart in range(0, profiles.shape[0], chunk_size):
+            np.add.at(sums, labels[nstart:nstart+chunk_size], np.asarray(profiles[nstart:nstart+chunk_size], dtype=np.float64)/sigma)
+        ## empty clusters are dropped
+        centers = sums[counts > 0]/counts[counts > 0, None]
+    
+    labels, distances = nearest(centers)
+    ## medoid: the member closest to its center, clusters are relabelled 0..n-1 in the order of the medoids
+    occupied = np.unique(labels)
+    medoids = np.array([np.where(labels == nclust)[0][distances[labels == nclust].argmin()] for nclust in occupied])
+    return medoids, np.searchsorted(occupied, labels)
+
+def _read_SANSFile(file_path, q_grid, skiprows=6):
+    """
+    Read one calculated scattering file (Pepsi-SANS format: 6 header lines, q and I(q) columns)
+    Profiles on a different q grid are resampled onto q_grid
+    """
+    sansdf = pd.read_csv(file_path, sep=r'\s+', usecols=[0,1], skiprows=skiprows, header=None, names=['q','I'])
+    file_q = sansdf['q'].values
+    if (file_q.shape[0] == q_grid.shape[0]) and np.allclose(file_q, q_grid, rtol=1e-6, atol=1e-9):
+        return sansdf['I'].values
+    
+    if (q_grid.min() < file_q.min()) or (q_grid.max() > file_q.max()):
+        print(f"Warning: {file_path} covers q = {file_q.min()}-{file_q.max()}, extrapolating to {q_grid.min()}-{q_grid.max()}")
+    return scpint.make_interp_spline(file_q, sansdf['I'].values, k=3)(q_grid)
+
+def _file_signature(file_path):
+    file_stat = os.stat(file_path)
+    return [file_stat.st_size, file_stat.st_mtime_ns]
+
+def _read_library_cache(cache_file, q_grid):
+    """
+    Read the binary library cache: cache_file (.npy, (nConf, nq)) and the manifest next to it (.json)
+    Returns {file name: (file signature, intensities)} or an empty dict if there is no usable cache
+    """
+    cache_file = Path(cache_file)
+    manifest_file = cache_file.with_suffix('.json')
+    if not (cache_file.exists() and manifest_file.exists()):
+        return {}
+    
+    with open(manifest_file, mode='r') as mfile:
+        manifest = json.load(mfile)
+    if manifest['grid_key'] != _grid_key(q_grid):
+        print(f"Library cache {cache_file} was written for a different q grid: rereading all files")
+        return {}
+    
+    intensities = np.load(cache_file, mmap_mode='r')
+    return {name:(signature, intensities[nrow]) for nrow, (name, signature) in enumerate(zip(manifest['files'], manifest['signatures']))}
+
+def _write_library_cache(cache_file, q_grid, file_names, signatures, intensities):
+    """
+    Write the library cache atomically, the .npy matrix is conformer-major (nConf, nq)
+    """
+    cache_file = Path(cache_file)
+    manifest_file = cache_file.with_suffix('.json')
+    tmp_cache = _temporary_file(cache_file)
+    tmp_manifest = _temporary_file(manifest_file, suffix='.tmp')
+    
+    np.save(tmp_cache, intensities)
+    with open(tmp_manifest, mode='w') as mfile:
+        json.dump({'grid_key':_grid_key(q_grid), 'files':list(file_names), 'signatures':signatures}, mfile)
+    os.replace(tmp_cache, cache_file)
+    os.replace(tmp_manifest, manifest_file)
+
+def _read_SANSFiles(sans_dir: Path, sans_struct, qmin=0.0, qmax=0.5, nq=501,
+                    n_workers=None, processes=False, cache_file=None):
+    """
+    Read in the sans files listed in the SCATTERINGFILE column of sans_struct
+    Files are parsed concurrently with a thread pool (or a process pool with processes=True) of n_workers.
+    cache_file: .npy file (plus a .json manifest of file names, sizes and modification times) holding the
+    parsed library. Only files that are new or changed since the cache was written are parsed again.
+    Returns the (nq, nConf) library
+    """
+    q_grid = np.linspace(qmin, qmax, nq)
+    file_names = sans_struct['SCATTERINGFILE'].astype(str).values
+    file_paths = [f"{sans_dir}/{fname}" for fname in file_names]
+    
+    cached = {} if cache_file is None else _read_library_cache(cache_file, q_grid)
+    signatures = [_file_signature(fpath) for fpath in file_paths] if cache_file is not None else [None]*len(file_paths)
+    
+    intensities = np.zeros((len(file_paths), nq))
+    reread = []
+    for nfile, (fname, signature) in enumerate(zip(file_names, signatures)):
+        if (fname in cached) and (cached[fname][0] == signature):
+            intensities[nfile] = cached[fname][1]
+        else:
+            reread.append(nfile)
+    
+    if len(reread) > 0:
+        pool_executor = ProcessPoolExecutor if processes else ThreadPoolExecutor
+        with pool_executor(max_workers=n_workers) as pool:
+            for nfile, file_intensity in zip(reread, pool.map(_read_SANSFile, [file_paths[nfile] for nfile in reread],
+                                                               [q_grid]*len(reread), chunksize=(64 if processes else 1))):
+                intensities[nfile] = file_intensity
+        
+        if cache_file is not None:
+            print(f"Read {len(reread)} of {len(file_paths)} scattering files, writing the library cache {cache_file}", flush=True)
+            _write_library_cache(cache_file, q_grid, file_names, signatures, intensities)
+    
+    return pd.DataFrame(index=q_grid, columns=sans_struct.index, data=intensities.T)
+
+def _gram_index(profiles, expected, sigma=None, chunk_size=2000, index_file=None):
+    """
+    Error weighted inner products of the interpolated profiles (nConf, nq) and the experiment, from which the chi2
+    of the linear fit of any ensemble follows without the q values:
+    gram: <I_i/sigma, I_j/sigma> (nConf, nConf), in memory or in the memory-mapped .npy index_file
+    profile_target: <I_i/sigma, y/sigma>, profile_flat: <I_i/sigma, 1/sigma>
+    target_target: <y/sigma, y/sigma>, target_flat: <y/sigma, 1/sigma>, flat_flat: <1/sigma, 1/sigma>, nq
+    The gram matrix is symmetric, only its upper chunk_size blocks are computed and mirrored. index_file is written
+    to a temporary file first as the library memmap, with a .json manifest of the hash of the profiles and sigma;
+    an index_file whose manifest matches is reused. The experiment only enters the vectors, computed every time
+    """
+    if sigma is None:
+        sigma = np.ones(profiles.shape[1])
+    n_conf = profiles.shape[0]
+    target = np.asarray(expected, dtype=np.float64)/sigma
+    flat = 1.0/np.asarray(sigma, dtype=np.float64)
+    
+    reuse = False
+    if index_file is not None:
+        index_file = Path(index_file)
+        manifest_file = index_file.with_suffix('.json')
+        index_hash = hashlib.sha1(np.ascontiguousarray(sigma, dtype=np.float64).tobytes())
+        for nstart in range(0, n_conf, chunk_size):
+            index_hash.update(np.ascontiguousarray(profiles[nstart:nstart+chunk_size], dtype=np.float64).tobytes())
+        index_key = f"{index_hash.hexdigest()[:16]}_{n_conf}_{profiles.shape[1]}"
+        if index_file.exists() and manifest_file.exists():
+            with open(manifest_file, mode='r') as mfile:
+                reuse = json.load(mfile).get('index_key') == index_key
+        if reuse:
+            gram = np.load(index_file, mmap_mode='r')
+        else:
+            tmp_file = _temporary_file(index_file)
+            gram = np.lib.format.open_memmap(tmp_file, mode='w+', dtype=np.float64, shape=(n_conf, n_conf))
+    else:
+        gram = np.zeros((n_conf, n_conf))
+    profile_target = np.zeros(n_conf)
+    profile_flat = np.zeros(n_conf)
+    for nstart in range(0, n_conf, chunk_size):
+        weighted = np.asarray(profiles[nstart:nstart+chunk_size], dtype=np.float64)/sigma
+        if not reuse:
+            for mstart in range(nstart, n_conf, chunk_size):
+                block = weighted@(np.asarray(profiles[mstart:mstart+chunk_size], dtype=np.float64)/sigma).T
+                gram[nstart:nstart+chunk_size, mstart:mstart+chunk_size] = block
+                gram[mstart:mstart+chunk_size, nstart:nstart+chunk_size] = block.T
+        profile_target[nstart:nstart+chunk_size] = weighted@target
+        profile_flat[nstart:nstart+chunk_size] = weighted@flat
+    
+    if (index_file is not None) and (not reuse):
+        gram.flush()
+        del gram
+        tmp_manifest = _temporary_file(manifest_file, suffix='.tmp')
+        with open(tmp_manifest, mode='w') as mfile:
+            json.dump({'index_key':index_key}, mfile)
+        os.replace(tmp_file, index_file)
+        os.replace(tmp_manifest, manifest_file)
+        gram = np.load(index_file, mmap_mode='r')
+    return {'gram':gram, 'profile_target':profile_target, 'profile_flat':profile_flat,
+            'target_target':target@target, 'target_flat':target@flat, 'flat_flat':flat@flat, 'nq':profiles.shape[1]}
@@ -0,0 +1,42 @@
+"""
+Shared fixtures of the tests: GASANS-dask.py loaded as the gasans module and synthetic libraries and experiments
+"""
+import sys
+import importlib.util
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+_spec = importlib.util.spec_from_file_location("gasans", Path(__file__).resolve().parents[1]/"GASANS-dask.py")
+gasans = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(gasans)
+
+
+def synthetic_library(nconf=30, seed=0):
+    """
+    Guinier-like profiles on the Pepsi-SANS q grid and an experimental curve made from two of them
+    """
+    rng = np.random.default_rng(seed)
+    q = np.linspace(0, 0.5, 501)
+    library = pd.DataFrame(index=q, data=np.vstack([100*np.exp(-np.power(q*rg, 2)/3.0)+0.05
+                                                     for rg in rng.uniform(10, 40, nconf)]).T)
+    expQ = np.linspace(0.01, 0.45, 90)
+    intensity = 2.0*(0.4*np.interp(expQ, q, library[3].values) + 0.6*np.interp(expQ, q, library[8].values)) + 0.01
+    error = 0.02*intensity + 1e-3
+    expdata = pd.DataFrame({'Q':expQ, 'I(Q)':intensity + rng.normal(0, error), 'Error':error})
+    return library, expdata
+
+def synthetic_ensemble(nq=80, ens_size=3, seed=0):
+    """
+    Profiles of one ensemble (nq, ens_size) at the experimental q values and an experiment made from them
+    """
+    rng = np.random.default_rng(seed)
+    q = np.linspace(0.01, 0.45, nq)
+    set_data = np.vstack([np.exp(-np.power(q*rg, 2)/3.0) for rg in rng.uniform(10, 40, ens_size)]).T
+    weights = rng.dirichlet(np.ones(ens_size))
+    error = 0.02*(set_data@weights) + 1e-3
+    intensity = 3.0*(set_data@weights) + 0.01 + rng.normal(0, error)
+    expdata = pd.DataFrame({'Q':q, 'I(Q)':intensity, 'Error':error})
+    return set_data, expdata
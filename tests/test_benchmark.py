@@ -0,0 +1,33 @@
+import sys
+import json
+import tempfile
+import subprocess
+from pathlib import Path
+from unittest import TestCase
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+import benchmark_gasans
+
+
+class BenchmarkSmokeTest(TestCase):
+
+    def test_tiny_run(self):
+        args = benchmark_gasans._parse_args(['--nconf', '20', '--nq', '30', '--ensemble-size', '2', '--generations', '2',
+                                             '--repeats', '1', '--executor', 'serial', '--workers', '1', '--max-workers', '1'])
+        results = json.loads(json.dumps(benchmark_gasans.run_benchmarks(args), default=float))
+        size_results = results['sizes']['2']
+        self.assertEqual(len(size_results['truth']['ensemble']), 2)
+        self.assertGreater(size_results['evaluation']['evaluations_per_s'], 0)
+        self.assertEqual(len(size_results['evolve']['best_ensemble']), 2)
+        self.assertEqual(size_results['scaling']['strong'][0]['speedup'], 1.0)
+
+    def test_json_output(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            output = Path(tmpdir)/'bench.json'
+            subprocess.run([sys.executable, str(Path(benchmark_gasans.__file__)), '--nconf', '12', '--nq', '25',
+                            '--generations', '1', '--repeats', '1', '--executor', 'serial', '--workers', '1',
+                            '--output', str(output)], check=True, capture_output=True, cwd=tmpdir)
+            with open(output) as fbench:
+                results = json.load(fbench)
+        self.assertEqual(list(results['sizes'].keys()), ['2'])
+        self.assertIn('setup', results['sizes']['2'])
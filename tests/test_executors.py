@@ -0,0 +1,74 @@
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from unittest import TestCase
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+from helpers import gasans, synthetic_library
+from executors import LocalClient, LocalAsCompleted, make_client
+
+
+def _square(value, offset=0):
+    return value*value + offset
+
+
+class LocalClientTest(TestCase):
+
+    def test_backends_agree(self):
+        for backend in ('serial', 'threads', 'processes'):
+            with LocalClient(backend, n_workers=2) as client:
+                self.assertEqual(client.gather(client.map(_square, [1, 2, 3], offset=1)), [2, 5, 10])
+                self.assertEqual(sum(client.nthreads().values()), 1 if backend == 'serial' else 2)
+
+    def test_processes_share_the_library_file(self):
+        library = np.arange(12.0).reshape(3, 4)
+        with LocalClient('processes', n_workers=2) as client:
+            shared = client.scatter(library, broadcast=True)
+            self.assertIsInstance(shared, str)
+            np.testing.assert_array_equal(np.load(shared, mmap_mode='r'), library)
+            ## functions of modules the workers cannot import are sent with cloudpickle
+            fits = client.gather(client.map(gasans.score_combinations, [np.array([[0, 1]])], [shared],
+                                            expdata=synthetic_library()[1].iloc[:4], ens_size=2, topk=1))
+            self.assertEqual(len(fits), 1)
+        self.assertFalse(Path(shared).exists())
+
+    def test_threaded_scatters_keep_their_data(self):
+        with LocalClient('processes', n_workers=1) as client:
+            with ThreadPoolExecutor(max_workers=8) as pool:
+                shared = list(pool.map(lambda value: client.scatter(np.full(50, float(value))), range(200)))
+            self.assertEqual(len(set(shared)), 200)
+            for value, shared_file in enumerate(shared):
+                np.testing.assert_array_equal(np.load(shared_file), value)
+
+    def test_as_completed_with_added_futures(self):
+        with LocalClient('threads', n_workers=2) as client:
+            completed = LocalAsCompleted([client.submit(_square, 2)], with_results=True)
+            results = []
+            for future, result in completed:
+                results.append(result)
+                if len(results) < 3:
+                    completed.add(client.submit(_square, result))
+        self.assertEqual(results, [4, 16, 256])
+
+    def test_unknown_executor(self):
+        with self.assertRaises(ValueError):
+            with make_client('mpi'):
+                pass
+
+
+class ExecutorEvolveTest(TestCase):
+
+    def test_fits_match_on_every_backend(self):
+        library, expdata = synthetic_library()
+        options = {'ensemble_size':2, 'number_generations':3, 'number_iterations':1, 'random_seed':2,
+                   'fitting_algorithm':'Linear Least Squares', 'batch_evaluation':False}
+        serial = gasans.GAEnsembleOpt(library, expdata, parallel=False, **options)
+        serial.evolve(dask_client=None)
+        for backend in ('serial', 'threads', 'processes'):
+            ga = gasans.GAEnsembleOpt(library, expdata, **options)
+            with LocalClient(backend, n_workers=2) as client:
+                ga.evolve(dask_client=client)
+            np.testing.assert_allclose(ga.gen_rchi2, serial.gen_rchi2)
+            np.testing.assert_array_equal(ga.cbest_rchi2['ensemble'], serial.cbest_rchi2['ensemble'])
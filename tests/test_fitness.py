@@ -0,0 +1,205 @@
+import sys
+from pathlib import Path
+from unittest import TestCase, mock
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+from helpers import gasans, synthetic_ensemble
+
+
+class LinearFitnessTest(TestCase):
+
+    def test_linear_matches_lmfit(self):
+        set_data, expdata = synthetic_ensemble()
+        linear = gasans.fitness(set_data, expdata, 3, fitting_algorithm='Linear Least Squares')
+        lmfit_fit = gasans.fitness(set_data, expdata, 3, fitting_algorithm='leastsq')
+        
+        self.assertTrue(linear['chi2'] <= lmfit_fit['chi2']*(1+1e-6))
+        self.assertAlmostEqual(linear['chi2'], lmfit_fit['chi2'], places=4)
+        self.assertAlmostEqual(linear['aic'], lmfit_fit['aic'], places=3)
+        self.assertEqual(list(linear['params'].keys()), list(lmfit_fit['params'].keys()))
+        weights = [linear['params'][f'w{nw}'] for nw in range(1, 4)]
+        self.assertAlmostEqual(sum(weights), 1.0)
+
+    def test_linear_model_residuals(self):
+        set_data, expdata = synthetic_ensemble(seed=3)
+        linear = gasans.fitness(set_data, expdata, 3, fitting_algorithm='Linear Least Squares')
+        pars = gasans.gen_modelparams(3, linear['params'])
+        model = gasans._residual_lmf(pars, set_data)
+        
+        np.testing.assert_allclose(linear['model'], model)
+        np.testing.assert_allclose(linear['residuals'],
+                                   (model-expdata['I(Q)'].values)/expdata['Error'].values)
+
+    def test_linear_nonnegative_weights(self):
+        set_data, expdata = synthetic_ensemble(seed=5)
+        ## a profile that anti-correlates with the data would need a negative weight
+        set_data[:, 2] = set_data[:, 2][::-1]
+        linear = gasans.fitness(set_data, expdata, 3, fitting_algorithm='bvls')
+        self.assertTrue(all(linear['params'][f'w{nw}'] >= 0 for nw in range(1, 4)))
+
+
+class BatchFitnessTest(TestCase):
+
+    def test_batch_matches_fitness(self):
+        ensembles = [synthetic_ensemble(seed=seed) for seed in range(6)]
+        expdata = ensembles[0][1]
+        ens_data = np.stack([set_data for set_data, _ in ensembles])
+        ## duplicate conformer in an ensemble: rank deficient, refit with the bounded solver
+        ens_data[4, :, 1] = ens_data[4, :, 0]
+        batch = gasans._fit_linear_batch(ens_data, expdata['I(Q)'].values, expdata['Error'].values)
+        
+        for nens in range(ens_data.shape[0]):
+            single = gasans.fitness(ens_data[nens], expdata, 3, fitting_algorithm='Linear Least Squares')
+            self.assertAlmostEqual(batch['chi2'][nens], single['chi2'], places=6)
+            self.assertAlmostEqual(batch['aic'][nens], single['aic'], places=6)
+            np.testing.assert_allclose(batch['model'][nens], single['model'], rtol=1e-6, atol=1e-9)
+            if nens != 4:
+                np.testing.assert_allclose(batch['params'][nens], list(single['params'].values()), rtol=1e-6, atol=1e-9)
+
+    def test_bounded_refits_together(self):
+        ## ensembles of the conformers of the experiment and random ones: many weights end on their bound
+        set_data, expdata = synthetic_ensemble(ens_size=2, seed=3)
+        rng = np.random.default_rng(7)
+        q = expdata['Q'].values
+        library = np.vstack([set_data.T] + [np.exp(-np.power(q*rg, 2)/3.0) for rg in rng.uniform(10, 40, 10)])
+        ensembles = np.vstack([np.append(rng.choice(2, 1), rng.choice(np.arange(2, 12), 2, replace=False))
+                               for nens in range(30)])
+        ens_data = np.rollaxis(library[ensembles], 2, 1)
+        expected, sigma = expdata['I(Q)'].values, expdata['Error'].values
+        reference = [gasans._fit_linear_lsq(set_data, expected, sigma) for set_data in ens_data]
+        
+        with mock.patch.object(gasans, '_fit_linear_lsq', side_effect=AssertionError("refit one by one")):
+            batch = gasans._fit_linear_batch(ens_data, expected, sigma)
+        
+        bounded = np.array([np.any(coeffs == 0) for coeffs, _, _ in reference])
+        self.assertGreater(bounded.sum(), 0)
+        for nens, (coeffs, background, _) in enumerate(reference):
+            single = gasans._linear_params(coeffs, background)
+            np.testing.assert_allclose(batch['params'][nens], list(single.values()), rtol=1e-6, atol=1e-9)
+
+
+class WarmStartTest(TestCase):
+
+    def test_local_fit_from_optimum(self):
+        set_data, expdata = synthetic_ensemble(seed=4)
+        exact = gasans.fitness(set_data, expdata, 3, fitting_algorithm='Linear Least Squares')
+        warm = gasans.fitness(set_data, expdata, 3, fitting_algorithm='differential_evolution', init_params=exact['params'])
+        
+        self.assertAlmostEqual(warm['chi2'], exact['chi2'], places=4)
+        self.assertLess(warm['nfev'], 200)
+
+    def test_fallback_on_invalid_weights(self):
+        set_data, expdata = synthetic_ensemble(seed=4)
+        ## the local fit cannot give a valid fit with weights above the cutoff
+        warm = gasans.fitness(set_data, expdata, 3, fitting_algorithm='leastsq', init_params={'c':3.0, 'b':0.0, 'w1':0.5, 'w2':0.5, 'w3':0.0},
+                              cut_weight=2.0)
+        cold = gasans.fitness(set_data, expdata, 3, fitting_algorithm='leastsq')
+        self.assertGreater(warm['nfev'], cold['nfev'])
+        self.assertAlmostEqual(warm['chi2'], cold['chi2'], places=6)
+
+
+class JointFitnessTest(TestCase):
+
+    def test_joint_fit_shares_weights(self):
+        rng = np.random.default_rng(6)
+        q = np.linspace(0.01, 0.45, 60)
+        radii = rng.uniform(10, 40, 2)
+        ## the same conformers at two contrasts
+        contrasts = [np.vstack([np.exp(-np.power(q*rg*factor, 2)/3.0) for rg in radii]).T for factor in (1.0, 0.7)]
+        weights = np.array([0.35, 0.65])
+        intensity = np.concatenate([2.0*(contrasts[0]@weights) + 0.01, 0.5*(contrasts[1]@weights) + 0.03])
+        error = 0.01*intensity + 1e-4
+        slices = [slice(0, 60), slice(60, 120)]
+        
+        joint = gasans._fit_linear_joint_batch(np.concatenate(contrasts)[None], intensity, error, slices)
+        np.testing.assert_allclose(joint['params'][0], [2.0, 0.01, 0.5, 0.03, 0.35, 0.65], rtol=1e-5, atol=1e-7)
+        self.assertLess(joint['chi2'][0], 1e-8)
+        
+        expdata = pd.DataFrame({'Q':np.tile(q, 2), 'I(Q)':intensity, 'Error':error})
+        single = gasans.fitness(np.concatenate(contrasts), expdata, 2, fitting_algorithm='Linear Least Squares', dataset_slices=slices)
+        self.assertEqual(list(single['params'].keys()), gasans._param_names(2, 2))
+        self.assertAlmostEqual(single['params']['w1'], 0.35, places=5)
+
+    def test_joint_fit_duplicate_conformer(self):
+        rng = np.random.default_rng(7)
+        q = np.linspace(0.01, 0.45, 60)
+        radii = rng.uniform(10, 40, 2)
+        contrasts = [np.vstack([np.exp(-np.power(q*rg*factor, 2)/3.0) for rg in radii]).T for factor in (1.0, 0.7)]
+        intensity = np.concatenate([2.0*(contrasts[0]@[0.35, 0.65]) + 0.01, 0.5*(contrasts[1]@[0.35, 0.65]) + 0.03])
+        error = 0.01*intensity + 1e-4
+        slices = [slice(0, 60), slice(60, 120)]
+        ens_data = np.stack([np.concatenate(contrasts)]*2)
+        ## duplicate conformer in the second ensemble: rank deficient, solved one by one
+        ens_data[1, :, 1] = ens_data[1, :, 0]
+        
+        joint = gasans._fit_linear_joint_batch(ens_data, intensity, error, slices)
+        self.assertTrue(np.all(np.isfinite(joint['chi2'])))
+        self.assertLess(joint['chi2'][0], 1e-8)
+        single = gasans._fit_linear_joint_batch(ens_data[1:, :, :1], intensity, error, slices)
+        self.assertAlmostEqual(joint['chi2'][1], single['chi2'][0]*(120-4)/(120-5), places=6)
+        np.testing.assert_allclose(joint['params'][1, :4], single['params'][0, :4], rtol=1e-6)
+
+
+class GramFitnessTest(TestCase):
+
+    def check_gram_matches_batch(self, ens_size, n_conf=12, seed=0):
+        set_data, expdata = synthetic_ensemble(ens_size=ens_size, seed=seed)
+        rng = np.random.default_rng(seed+100)
+        q = expdata['Q'].values
+        library = np.vstack([set_data.T] + [np.exp(-np.power(q*rg, 2)/3.0) for rg in rng.uniform(10, 40, n_conf-ens_size)])
+        ensembles = np.vstack([np.arange(ens_size)] + [rng.choice(n_conf, ens_size, replace=False) for nens in range(20)])
+        ## duplicate conformer: rank deficient
+        ensembles[-1, 1] = ensembles[-1, 0]
+        sigma = expdata['Error'].values
+        batch = gasans._fit_linear_batch(np.rollaxis(library[ensembles], 2, 1), expdata['I(Q)'].values, sigma)
+        gram = gasans._fit_linear_gram(ensembles, gasans._gram_index(library, expdata['I(Q)'].values, sigma))
+        
+        self.assertNotIn('model', gram)
+        np.testing.assert_allclose(gram['chi2'], batch['chi2'], rtol=1e-6)
+        np.testing.assert_allclose(gram['aic'], batch['aic'], rtol=1e-6, atol=1e-6)
+        np.testing.assert_allclose(gram['params'][:-1], batch['params'][:-1], rtol=1e-5, atol=1e-7)
+
+    def test_gram_matches_batch(self):
+        self.check_gram_matches_batch(3)
+
+    def test_gram_matches_batch_large_ensembles(self):
+        ## larger than LINEAR_SUBSET_MAX_SIZE, the bounded refits run one by one
+        self.check_gram_matches_batch(gasans.LINEAR_SUBSET_MAX_SIZE+1, n_conf=20, seed=1)
+
+
+class BootstrapTest(TestCase):
+
+    def test_error_bootstrap_covers_the_fit(self):
+        set_data, expdata = synthetic_ensemble()
+        sigma = expdata['Error'].values
+        bootstrap = gasans._bootstrap_fits(set_data[None], expdata['I(Q)'].values, sigma, n_boot=400, rng=1)
+        self.assertEqual(bootstrap['params'].shape, (1, 400, 5))
+        
+        ## the spread of the weights matches the covariance of the unconstrained linear fit
+        design = np.column_stack([set_data, np.ones(set_data.shape[0])])/sigma[:, None]
+        coeff_std = np.sqrt(np.diag(np.linalg.inv(design.T@design)))
+        scaled = bootstrap['params'][0, :, 2:]*bootstrap['params'][0, :, :1]
+        np.testing.assert_allclose(scaled.std(axis=0), coeff_std[:3], rtol=0.2)
+        
+        fit = gasans._fit_linear_batch(set_data[None], expdata['I(Q)'].values, sigma)
+        intervals = gasans._bootstrap_intervals({'params':bootstrap['params'][0], 'chi2':bootstrap['chi2'][0]},
+                                                gasans._param_names(3))
+        for npar, par in enumerate(gasans._param_names(3)):
+            self.assertLess(intervals[f'{par}_low'], fit['params'][0, npar])
+            self.assertGreater(intervals[f'{par}_high'], fit['params'][0, npar])
+
+    def test_q_bootstrap_of_joint_fits(self):
+        set_data, expdata = synthetic_ensemble(nq=40)
+        ens_data = np.concatenate([set_data, set_data])[None]
+        expected = np.concatenate([expdata['I(Q)'].values, 0.5*expdata['I(Q)'].values])
+        sigma = np.concatenate([expdata['Error'].values, 0.5*expdata['Error'].values])
+        bootstrap = gasans._bootstrap_fits(ens_data, expected, sigma, n_boot=50, method='q', rng=2,
+                                           dataset_slices=[slice(0, 40), slice(40, 80)])
+        self.assertEqual(bootstrap['params'].shape, (1, 50, 7))
+        ## q points are resampled within each dataset, the second stays half of the first
+        np.testing.assert_allclose(bootstrap['params'][0, :, 2]/bootstrap['params'][0, :, 0], 0.5, rtol=2e-2)
+        with self.assertRaises(ValueError):
+            gasans._bootstrap_fits(ens_data, expected, sigma, method='jackknife')
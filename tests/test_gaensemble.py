@@ -0,0 +1,706 @@
+import os
+import sys
+import json
+import pickle
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from unittest import TestCase, mock
+
+import numpy as np
+import pandas as pd
+import dask.distributed as distributed
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+from helpers import gasans, synthetic_library
+from executors import LocalClient
+
+
+class FitnessCacheTest(TestCase):
+
+    def test_lru_eviction(self):
+        cache = gasans.FitnessCache(max_size=2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.put('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(len(cache), 2)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_cached_weights_follow_ensemble_order(self):
+        library, expdata = synthetic_library()
+        ga = gasans.GAEnsembleOpt(library, expdata, ensemble_size=3, number_generations=2, number_iterations=1,
+                                  fitting_algorithm='Linear Least Squares')
+        ensembles = np.array([[3, 8, 12], [1, 2, 5]])
+        first = ga._cached_fit_ensembles(ensembles, None)
+        second = ga._cached_fit_ensembles(ensembles[:, ::-1], None)
+        
+        self.assertEqual(ga.time_log['cache_hits'], 2)
+        np.testing.assert_allclose(second['chi2'], first['chi2'])
+        np.testing.assert_allclose(second['params'][:, 2:], first['params'][:, 2:][:, ::-1])
+        np.testing.assert_allclose(first['params'], ga._fit_ensembles(ensembles, None)['params'])
+
+    def test_shared_cache_keeps_the_fits_of_other_options(self):
+        library, expdata = synthetic_library()
+        other_library = library.copy()
+        other_library[8] = 2.0*other_library[8]
+        options = {'ensemble_size':2, 'fitting_algorithm':'Linear Least Squares'}
+        cache = gasans.FitnessCache()
+        ensemble = np.array([3, 8])
+        reference = gasans.GAEnsembleOpt(library, expdata, fitness_cache=cache, **options)
+        reference._cached_fit_ensembles(ensemble.reshape(1, -1), None)
+        
+        for other in [gasans.GAEnsembleOpt(library, expdata, fitness_cache=cache, cutoff_weight=0.45, **options),
+                      gasans.GAEnsembleOpt(library, expdata, fitness_cache=cache, warm_start=True, **options),
+                      gasans.GAEnsembleOpt(library, expdata, fitness_cache=cache, local_method='nelder', **options),
+                      gasans.GAEnsembleOpt(library, expdata, fitness_cache=cache, library_dtype='float32', **options),
+                      gasans.GAEnsembleOpt(other_library, expdata, fitness_cache=cache, **options)]:
+            other._cached_fit_ensembles(ensemble.reshape(1, -1), None)
+            self.assertEqual(other.time_log['cache_hits'], 0)
+        
+        same = gasans.GAEnsembleOpt(library, expdata, fitness_cache=cache, **options)
+        same._cached_fit_ensembles(ensemble.reshape(1, -1), None)
+        self.assertEqual(same.time_log['cache_hits'], 1)
+
+
+class LibraryBackendTest(TestCase):
+
+    def test_memmap_float32_library(self):
+        library, expdata = synthetic_library()
+        ga_memory = gasans.GAEnsembleOpt(library, expdata, ensemble_size=2, fitting_algorithm='Linear Least Squares')
+        with tempfile.TemporaryDirectory() as library_dir:
+            library_file = Path(library_dir)/'library.npy'
+            ga_memmap = gasans.GAEnsembleOpt(library, expdata, ensemble_size=2, fitting_algorithm='Linear Least Squares',
+                                             library_backend='memmap', library_dtype='float32', library_file=library_file)
+            self.assertIsInstance(ga_memmap.interp_matrix, np.memmap)
+            self.assertEqual(ga_memmap.interp_matrix.dtype, np.float32)
+            np.testing.assert_allclose(ga_memmap.interp_matrix, ga_memory.interp_matrix, rtol=1e-6)
+            
+            ensemble = np.array([3, 8])
+            worker_fit = gasans.fitness_indices(ensemble, str(library_file), expdata, 2, fitting_algorithm='Linear Least Squares')
+            memory_fit = ga_memory._fit_ensembles(ensemble.reshape(1, -1), None)
+            self.assertAlmostEqual(worker_fit['chi2'], memory_fit['chi2'][0], places=4)
+
+    def test_concurrent_sizes_share_the_memmap_library(self):
+        library, expdata = synthetic_library()
+        workdir = os.getcwd()
+        with tempfile.TemporaryDirectory() as library_dir:
+            os.chdir(library_dir)
+            try:
+                with ThreadPoolExecutor(max_workers=4) as pool:
+                    gas = list(pool.map(lambda ens_size: gasans.GAEnsembleOpt(library, expdata, ensemble_size=ens_size,
+                                                                              fitting_algorithm='Linear Least Squares',
+                                                                              library_backend='memmap'), [2, 3, 4, 5]))
+                self.assertEqual(len(set(ga.library_file for ga in gas)), 1)
+                self.assertEqual(os.listdir(library_dir), [gas[0].library_file.name])
+                for ga in gas:
+                    np.testing.assert_array_equal(ga.interp_matrix, np.load(gas[0].library_file))
+            finally:
+                os.chdir(workdir)
+
+
+class CountingClient(LocalClient):
+    """
+    LocalClient counting the scattered and cancelled data
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.scattered = []
+        self.cancelled = []
+    
+    def scatter(self, data, broadcast=True, hash=True):
+        self.scattered.append(data)
+        return super().scatter(data, broadcast=broadcast, hash=hash)
+    
+    def cancel(self, futures):
+        self.cancelled.extend(futures)
+        super().cancel(futures)
+
+
+class WorkerLibraryTest(TestCase):
+
+    def test_fitness_indices_matches_fitness(self):
+        library, expdata = synthetic_library()
+        ga = gasans.GAEnsembleOpt(library, expdata, ensemble_size=2, fitting_algorithm='Linear Least Squares')
+        ensemble = np.array([3, 8])
+        worker_fit = gasans.fitness_indices(ensemble, ga.interp_matrix, ga.experiment, 2, fitting_algorithm='Linear Least Squares')
+        fit = gasans.fitness(ga.interp_matrix[ensemble, :].T, ga.experiment, 2, fitting_algorithm='Linear Least Squares')
+        self.assertEqual(worker_fit['chi2'], fit['chi2'])
+        self.assertEqual(worker_fit['params'], fit['params'])
+        np.testing.assert_array_equal(worker_fit['model'], fit['model'])
+
+    def test_one_scatter_per_evolve(self):
+        library, expdata = synthetic_library()
+        ga = gasans.GAEnsembleOpt(library, expdata, ensemble_size=2, number_generations=3, number_iterations=2,
+                                  fitting_algorithm='Linear Least Squares', batch_evaluation=False)
+        with CountingClient('threads', n_workers=2) as client:
+            ga.evolve(dask_client=client)
+            ## the library and the experiment, once for both iterations, cancelled at the end
+            self.assertEqual(len(client.scattered), 2)
+            self.assertEqual(len(client.cancelled), 2)
+        self.assertIsNone(ga.worker_library)
+        self.assertEqual(len(gasans._WORKER_DATA), 0)
+
+    def test_sizes_share_the_scattered_library(self):
+        library, expdata = synthetic_library()
+        gas = [gasans.GAEnsembleOpt(library, expdata, ensemble_size=ens_size, fitting_algorithm='Linear Least Squares')
+               for ens_size in (2, 3)]
+        with CountingClient('processes', n_workers=1) as client:
+            for ga in gas:
+                ga._scatter_library(client)
+            self.assertEqual(len(client.scattered), 2)
+            self.assertEqual(gas[0].worker_library, gas[1].worker_library)
+            gas[0]._release_library()
+            self.assertEqual(len(client.cancelled), 0)
+            gas[1]._release_library()
+            self.assertEqual(len(client.cancelled), 2)
+
+
+class OperatorTest(TestCase):
+
+    def setUp(self):
+        library, expdata = synthetic_library(nconf=40)
+        self.ga = gasans.GAEnsembleOpt(library, expdata, ensemble_size=3, number_generations=2, number_iterations=1,
+                                       fitting_algorithm='Linear Least Squares', random_seed=7)
+
+    def test_unique_rows(self):
+        np.testing.assert_array_equal(gasans.unique_rows(np.array([[1, 2, 3], [4, 1, 4], [5, 6, 5]])),
+                                      [True, False, False])
+
+    def test_crossover_swaps_tail_and_head(self):
+        self.ga.p_crossover = 0.0 ## always cross after the first element
+        self.ga.parent_pairs = np.array([[[0, 1, 2], [3, 4, 5]],
+                                         [[0, 1, 2], [0, 5, 6]]])
+        self.ga.crossover()
+        ## the second pair would make non unique children so it is kept
+        np.testing.assert_array_equal(self.ga.children, [[0, 3, 4], [1, 2, 5], [0, 1, 2], [0, 5, 6]])
+
+    def test_mutation_keeps_children_unique(self):
+        self.ga.p_mutate = 1.0
+        self.ga.mut_indices = np.arange(10, 40)
+        self.ga.children = self.ga.indices[self.ga.randomcol_indices()]
+        original = self.ga.children.copy()
+        self.ga.mutation()
+        self.assertTrue(np.all(gasans.unique_rows(self.ga.children)))
+        mutated = np.any(self.ga.children != original, axis=1)
+        self.assertTrue(np.all(self.ga.children[mutated] >= 10))
+        self.assertEqual(self.ga.children.dtype, np.int64)
+
+    def test_duplicate_ensembles_fit_once(self):
+        ensembles = np.array([[3, 8, 12], [12, 3, 8], [1, 2, 5]])
+        fits = self.ga._evaluate_fits(ensembles, None)
+        self.assertEqual(self.ga.time_log['duplicate_ensembles'], 1)
+        self.assertEqual(fits['chi2'][0], fits['chi2'][1])
+        np.testing.assert_allclose(fits['params'][1, 2:], fits['params'][0, 2:][[2, 0, 1]])
+
+    def test_seeded_evolution_is_reproducible(self):
+        library, expdata = synthetic_library(nconf=40)
+        bests = []
+        for nrun in range(2):
+            ga = gasans.GAEnsembleOpt(library, expdata, ensemble_size=2, number_generations=4, number_iterations=2,
+                                      fitting_algorithm='Linear Least Squares', random_seed=11)
+            ga.evolve(None)
+            bests.append([list(itbest['ensemble']) for itbest in ga.itbest_rchi2])
+        self.assertEqual(bests[0], bests[1])
+
+
+class ExhaustiveSearchTest(TestCase):
+
+    def test_top_ensembles_match_all_fits(self):
+        library, expdata = synthetic_library(nconf=15)
+        ga = gasans.GAEnsembleOpt(library, expdata, ensemble_size=2, number_iterations=1, search_mode='exhaustive',
+                                  exhaustive_topk=3, exhaustive_chunksize=17, parallel=False,
+                                  fitting_algorithm='Linear Least Squares')
+        ga.evolve(dask_client=None)
+        
+        all_ensembles = np.array([[n1, n2] for n1 in range(15) for n2 in range(n1+1, 15)])
+        fits = ga._fit_ensembles(all_ensembles, None)
+        valid = ~np.any(fits['params'][:, 2:] < ga.cut_weight, axis=1)
+        fitness = gasans.invert_absx2(fits['chi2'][valid])
+        best = all_ensembles[valid][np.argsort(-fitness)[:3]]
+        
+        self.assertEqual(len(ga.itbest_rchi2), 3)
+        np.testing.assert_array_equal(np.array([itbest['ensemble'] for itbest in ga.itbest_rchi2]), best)
+        np.testing.assert_array_equal(ga.cbest_rchi2['ensemble'], best[0])
+
+
+    def test_client_and_gram_paths_agree(self):
+        library, expdata = synthetic_library(nconf=15)
+        options = dict(ensemble_size=2, number_iterations=1, search_mode='exhaustive', exhaustive_topk=3,
+                       fitting_algorithm='Linear Least Squares', fitness_function='inverse_absolute', method='rank')
+        serial = gasans.GAEnsembleOpt(library, expdata, parallel=False, **options)
+        serial.evolve(dask_client=None)
+        for gram_index in (False, True):
+            ga = gasans.GAEnsembleOpt(library, expdata, gram_index=gram_index, **options)
+            with CountingClient('threads', n_workers=2) as client:
+                ga.evolve(dask_client=client)
+                ## the gram index is not sent to the workers, its chunks are scored in this process
+                self.assertEqual(len(client.scattered), 0 if gram_index else 2)
+            np.testing.assert_array_equal(np.array([itbest['ensemble'] for itbest in ga.itbest_rchi2]),
+                                          np.array([itbest['ensemble'] for itbest in serial.itbest_rchi2]))
+            for itbest in ga.itbest_rchi2:
+                self.assertAlmostEqual(itbest['fitness'], ga._fitness_function()(itbest['chi2']))
+
+
+class ConvergenceTest(TestCase):
+
+    def make_ga(self, **kwargs):
+        library, expdata = synthetic_library()
+        return gasans.GAEnsembleOpt(library, expdata, ensemble_size=2, number_generations=50, number_iterations=4,
+                                    fitting_algorithm='Linear Least Squares', random_seed=5, **kwargs)
+
+    def test_plateau_stops_iteration(self):
+        ga = self.make_ga(convergence_generations=3)
+        ga.evolve(dask_client=None)
+        self.assertLess(ga.curr_gen, ga.n_gen)
+        self.assertGreaterEqual(ga.fitness_saturation, 3)
+
+    def test_iterations_stop_when_they_agree(self):
+        ga = self.make_ga(convergence_generations=3, iteration_agreement=1)
+        ga.evolve(dask_client=None)
+        self.assertEqual(ga.curr_iter, 0)
+        self.assertEqual(sum('ensemble' in itbest for itbest in ga.itbest_rchi2), 1)
+
+    def test_time_budget(self):
+        ga = self.make_ga(time_budget=0.0)
+        ga.evolve(dask_client=None)
+        self.assertEqual((ga.curr_iter, ga.curr_gen), (0, 1))
+
+
+class CheckpointTest(TestCase):
+
+    def make_ga(self, checkpoint_file, **kwargs):
+        library, expdata = synthetic_library()
+        return gasans.GAEnsembleOpt(library, expdata, ensemble_size=2, number_generations=6, number_iterations=2,
+                                    fitting_algorithm='Linear Least Squares', random_seed=11,
+                                    checkpoint_file=checkpoint_file, checkpoint_interval=2, **kwargs)
+
+    def test_resume_matches_uninterrupted_run(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            reference = self.make_ga(None)
+            reference.evolve(dask_client=None)
+            
+            interrupted = self.make_ga(Path(tmpdir)/'checkpoint.pkl')
+            evaluate = interrupted.evaluate
+            def killed_evaluate(client):
+                if (interrupted.curr_iter, interrupted.curr_gen) == (1, 3):
+                    raise KeyboardInterrupt
+                evaluate(client)
+            interrupted.evaluate = killed_evaluate
+            with self.assertRaises(KeyboardInterrupt):
+                interrupted.evolve(dask_client=None)
+            
+            resumed = self.make_ga(Path(tmpdir)/'checkpoint.pkl')
+            self.assertTrue(resumed.load_checkpoint())
+            self.assertEqual((resumed.curr_iter, resumed.curr_gen), (1, 2))
+            resumed.evolve(dask_client=None)
+            
+            for itbest, itbest_resumed in zip(reference.itbest_rchi2, resumed.itbest_rchi2):
+                np.testing.assert_array_equal(itbest['ensemble'], itbest_resumed['ensemble'])
+                self.assertAlmostEqual(itbest['chi2'], itbest_resumed['chi2'])
+            np.testing.assert_allclose(resumed.gen_rchi2, reference.gen_rchi2)
+            self.assertEqual(resumed.stage, 'finished')
+
+    def test_history_is_spooled_not_pickled(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            reference = self.make_ga(None, results_file=Path(tmpdir)/'reference.npz')
+            reference.evolve(dask_client=None)
+            
+            checkpoint_file = Path(tmpdir)/'checkpoint.pkl'
+            interrupted = self.make_ga(checkpoint_file, results_file=Path(tmpdir)/'results.npz')
+            evaluate = interrupted.evaluate
+            def killed_evaluate(client):
+                if (interrupted.curr_iter, interrupted.curr_gen) == (1, 3):
+                    raise KeyboardInterrupt
+                evaluate(client)
+            interrupted.evaluate = killed_evaluate
+            with self.assertRaises(KeyboardInterrupt):
+                interrupted.evolve(dask_client=None)
+            ## generation 2 of the second iteration was recorded after the last checkpoint
+            self.assertGreater(len(interrupted.history), interrupted.history_saved)
+            with open(checkpoint_file, 'rb') as fcheck:
+                self.assertNotIn('history', pickle.load(fcheck))
+            
+            resumed = self.make_ga(checkpoint_file, results_file=Path(tmpdir)/'results.npz')
+            resumed.load_checkpoint()
+            resumed.evolve(dask_client=None)
+            self.assertEqual(len(resumed.history), len(reference.history))
+            for fits, reference_fits in zip(resumed.history, reference.history):
+                np.testing.assert_array_equal(fits['ensemble'], reference_fits['ensemble'])
+                np.testing.assert_array_equal(fits['generation'], reference_fits['generation'])
+
+    def test_checkpoint_of_other_run(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            ga = self.make_ga(Path(tmpdir)/'checkpoint.pkl')
+            ga.evolve(dask_client=None)
+            other = self.make_ga(Path(tmpdir)/'checkpoint.pkl', search_mode='exhaustive')
+            with self.assertRaises(ValueError):
+                other.load_checkpoint()
+
+
+class TelemetryTest(TestCase):
+
+    def test_record_per_generation(self):
+        library, expdata = synthetic_library()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            ga = gasans.GAEnsembleOpt(library, expdata, ensemble_size=2, number_generations=3, number_iterations=2,
+                                      fitting_algorithm='Linear Least Squares', random_seed=3,
+                                      telemetry_file=Path(tmpdir)/'telemetry.jsonl',
+                                      profile_generations=[1], profile_dir=tmpdir)
+            ga.evolve(dask_client=None)
+            with open(Path(tmpdir)/'telemetry.jsonl') as ftel:
+                records = [json.loads(line) for line in ftel]
+            self.assertTrue(all((Path(tmpdir)/f'gasans_profile_EnsSize2_Iteration{it}_Generation1.prof').exists() for it in range(2)))
+        
+        ## iterations can stop early, the generations of each are recorded in order
+        for it in range(2):
+            generations = [rec['generation'] for rec in records if rec['iteration'] == it]
+            self.assertEqual(generations, list(range(len(generations))))
+            self.assertGreater(len(generations), 1)
+        self.assertEqual(records[-1]['best_chi2'], ga.cbest_rchi2['chi2'])
+        self.assertTrue(all(0 < rec['ensemble_diversity'] <= 1 for rec in records))
+        self.assertIn('evaluation', records[0])
+
+    def test_task_stream_of_concurrent_sizes(self):
+        library, expdata = synthetic_library()
+        with tempfile.TemporaryDirectory() as tmpdir, \
+             distributed.Client(n_workers=2, threads_per_worker=1, processes=False, dashboard_address=':0') as client:
+            def run_size(ens_size):
+                ga = gasans.GAEnsembleOpt(library, expdata, ensemble_size=ens_size, number_generations=3,
+                                          number_iterations=1, fitting_algorithm='Linear Least Squares',
+                                          batch_evaluation=False, random_seed=ens_size,
+                                          telemetry_file=Path(tmpdir)/f'telemetry_{ens_size}.jsonl',
+                                          profile_generations=[0], profile_dir=tmpdir)
+                ga.evolve(dask_client=client)
+                return ga
+            with ThreadPoolExecutor(max_workers=2) as size_pool:
+                runs = list(size_pool.map(run_size, [2, 3]))
+            for ga in runs:
+                with open(Path(tmpdir)/f'telemetry_{ga.ens_size}.jsonl') as ftel:
+                    records = [json.loads(line) for line in ftel]
+                ## only the tasks of this size are counted, not those of the other size on the same cluster
+                self.assertTrue(all(rec['dask_tasks'] <= ga.n_ens for rec in records))
+                self.assertTrue(all(rec['dask_idle'] >= 0 for rec in records))
+                self.assertTrue((Path(tmpdir)/f'gasans_profile_EnsSize{ga.ens_size}_Iteration0_Generation0.prof').exists())
+
+
+class QReductionTest(TestCase):
+
+    def test_error_weighted_rebinning(self):
+        library, expdata = synthetic_library()
+        reduced = gasans._reduce_qpoints(expdata, 'rebin', n_q=30)
+        self.assertEqual(reduced.shape[0], 30)
+        ## 1/Error^2 is conserved by the rebinning
+        self.assertAlmostEqual(np.power(reduced['Error'], -2).sum(), np.power(expdata['Error'], -2).sum())
+        self.assertTrue(np.all(np.diff(reduced['Q'].values) > 0))
+        
+        shannon = gasans._reduce_qpoints(expdata, 'shannon', dmax=60, oversampling=2)
+        self.assertEqual(shannon.shape[0], int(np.ceil(2*(expdata['Q'].max()-expdata['Q'].min())*60/np.pi)))
+        with self.assertRaises(ValueError):
+            gasans._reduce_qpoints(expdata, 'shannon')
+
+    def test_best_model_scored_on_full_data(self):
+        library, expdata = synthetic_library()
+        ga = gasans.GAEnsembleOpt(library, expdata, ensemble_size=2, fitting_algorithm='Linear Least Squares',
+                                  search_mode='exhaustive', parallel=False, q_reduction='rebin', n_q=30)
+        self.assertEqual(ga.experiment.shape[0], 30)
+        ga.evolve(dask_client=None)
+        
+        ga.evaluate_bestfit()
+        self.assertEqual(ga.full_fit[0]['residuals'].shape[0], expdata.shape[0])
+        self.assertLess(ga.full_fit[0]['chi2'], 2.0)
+
+
+class IncrementalSizeTest(TestCase):
+
+    def test_extension_of_the_seeds(self):
+        library, expdata = synthetic_library()
+        ga = gasans.GAEnsembleOpt(library, expdata, ensemble_size=2, number_generations=5, number_iterations=1,
+                                  fitting_algorithm='Linear Least Squares', parallel=False, random_seed=1,
+                                  seed_ensembles=[[8]], seed_fraction=0.5, seed_candidates=1)
+        ga._init_iteration(0)
+        n_seeded = int(0.5*ga.n_ens)
+        np.testing.assert_array_equal(ga.parents[:n_seeded], np.tile([8, 3], (n_seeded, 1)))
+        self.assertEqual(np.unique(ga.parents[n_seeded:]).shape[0], ga.parents[n_seeded:].size)
+        
+        with self.assertRaises(ValueError):
+            gasans.GAEnsembleOpt(library, expdata, ensemble_size=2, seed_ensembles=[[1, 2, 3]])
+
+    def test_top_ensembles_seed_the_next_size(self):
+        library, expdata = synthetic_library()
+        size2 = gasans.GAEnsembleOpt(library, expdata, ensemble_size=2, fitting_algorithm='Linear Least Squares',
+                                     search_mode='exhaustive', exhaustive_topk=5, parallel=False)
+        size2.evolve(dask_client=None)
+        seeds = size2.top_ensembles(3)
+        self.assertEqual(seeds, [sorted(itbest['ensemble']) for itbest in size2.itbest_rchi2[:3]])
+        
+        size3 = gasans.GAEnsembleOpt(library, expdata, ensemble_size=3, number_generations=2, number_iterations=1,
+                                     fitting_algorithm='Linear Least Squares', parallel=False, random_seed=0,
+                                     seed_ensembles=seeds)
+        size3._init_iteration(0)
+        self.assertTrue(all(np.isin(seeds[nens%3], size3.parents[nens]).all() for nens in range(int(0.5*size3.n_ens))))
+
+
+class SteadyStateTest(TestCase):
+
+    def test_steady_state_evolution(self):
+        library, expdata = synthetic_library()
+        ga = gasans.GAEnsembleOpt(library, expdata, ensemble_size=2, number_generations=8, number_iterations=2,
+                                  fitting_algorithm='Linear Least Squares', random_seed=0,
+                                  evolution_mode='steady_state', steady_state_inflight=4)
+        with self.assertRaises(ValueError):
+            ga.evolve(dask_client=None)
+        
+        with distributed.Client(processes=False, n_workers=1, threads_per_worker=2, dashboard_address=None) as client:
+            ga.evolve(dask_client=client)
+        
+        self.assertTrue(all('ensemble' in itbest for itbest in ga.itbest_rchi2))
+        self.assertEqual(ga.cbest_rchi2['fitness'], max(itbest['fitness'] for itbest in ga.itbest_rchi2))
+        self.assertTrue(np.all(ga.cbest_rchi2['fit_pars']['w1'] >= ga.cut_weight))
+        self.assertTrue(np.all(gasans.unique_rows(ga.parents)))
+        self.assertGreater(ga.time_log['cache_misses'], ga.n_ens)
+        
+        with self.assertRaises(ValueError):
+            gasans.GAEnsembleOpt(library, expdata, evolution_mode='steady_state', island_model=True)
+        with self.assertRaises(ValueError):
+            gasans.GAEnsembleOpt(library, expdata, evolution_mode='steady_state', warm_start=True)
+
+    def test_more_inflight_than_population(self):
+        library, expdata = synthetic_library()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            telemetry_file = Path(tmpdir)/'telemetry.jsonl'
+            ga = gasans.GAEnsembleOpt(library, expdata, ensemble_size=2, number_generations=4, number_iterations=1,
+                                      fitting_algorithm='Linear Least Squares', random_seed=0, evolution_mode='steady_state',
+                                      telemetry_file=telemetry_file)
+            with LocalClient('threads', n_workers=8) as client:
+                ## the default inflight, twice the worker threads, is more than the population
+                self.assertGreater(2*sum(client.nthreads().values()), ga.n_ens)
+                ga.evolve(dask_client=client)
+            with open(telemetry_file) as ftel:
+                records = [json.loads(line) for line in ftel]
+        self.assertEqual([record['generation'] for record in records], list(range(ga.curr_gen)))
+        self.assertEqual(records[-1]['best_chi2'], ga.cbest_rchi2['chi2'])
+        self.assertTrue(records[-1]['converged'] and not any(record['converged'] for record in records[:-1]))
+
+
+class NoValidEnsembleTest(TestCase):
+
+    def test_outputs_skipped_without_a_valid_ensemble(self):
+        library, expdata = synthetic_library()
+        structuredf = pd.DataFrame({'pdb':[f'conf_{nconf}.pdb' for nconf in range(30)],
+                                    'scattering':[f'conf_{nconf}.dat' for nconf in range(30)]})
+        ## two weights cannot both be above 0.6
+        config = {'ensemble_size':2, 'number_generations':3, 'number_iterations':1, 'cutoff_weight':0.6,
+                  'fitting_algorithm':'Linear Least Squares'}
+        workdir = os.getcwd()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            os.chdir(tmpdir)
+            try:
+                ga = gasans._run_ensemble_size(config, library, expdata, structuredf, None)
+            finally:
+                os.chdir(workdir)
+            self.assertFalse(ga._has_valid_best())
+            self.assertEqual(os.listdir(tmpdir), [])
+
+
+class ConcurrentSizesTest(TestCase):
+
+    def test_failed_size_does_not_stop_the_others(self):
+        library, expdata = synthetic_library()
+        structuredf = pd.DataFrame({'pdb':[f'conf_{nconf}.pdb' for nconf in range(30)],
+                                    'scattering':[f'conf_{nconf}.dat' for nconf in range(30)]})
+        configs = [{'ensemble_size':2, 'number_generations':3, 'number_iterations':1,
+                    'fitting_algorithm':'Linear Least Squares', 'random_seed':1},
+                   {'ensemble_size':3, 'number_generations':3, 'number_iterations':1,
+                    'fitting_algorithm':'Linear Least Squares', 'steady_state':True, 'warm_start':True}]
+        workdir = os.getcwd()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            os.chdir(tmpdir)
+            try:
+                finished, failed = gasans._run_concurrent_sizes(configs, 2, library, expdata, structuredf, None)
+            finally:
+                os.chdir(workdir)
+            self.assertEqual(list(finished.keys()), [2])
+            self.assertEqual(list(failed.keys()), [3])
+            self.assertTrue(finished[2]._has_valid_best())
+            self.assertIn('gasans_summary_EnsSize2.csv', os.listdir(tmpdir))
+
+
+class ResultsStoreTest(TestCase):
+
+    def test_reload_without_rerunning(self):
+        library, expdata = synthetic_library()
+        options = {'ensemble_size':2, 'number_generations':5, 'number_iterations':2,
+                   'fitting_algorithm':'Linear Least Squares', 'parallel':False, 'random_seed':3}
+        with tempfile.TemporaryDirectory() as tmpdir:
+            results_file = Path(tmpdir)/'results.npz'
+            ga = gasans.GAEnsembleOpt(library, expdata, results_file=results_file, **options)
+            ga.evolve(dask_client=None)
+            ga.save_results()
+            
+            results = gasans.read_results(results_file)
+            self.assertEqual(results.shape[0], sum(fits['chi2'].shape[0] for fits in ga.history))
+            self.assertEqual(list(results.columns[6:]), ['c', 'b', 'w1', 'w2', 'ensemble_index_1', 'ensemble_index_2'])
+            self.assertEqual((results['generation'] == 0).sum(), ga.n_ens*results['iteration'].nunique())
+            
+            reloaded = gasans.GAEnsembleOpt(library, expdata, **options)
+            reloaded.load_results(results_file)
+            self.assertEqual(reloaded.cbest_rchi2['fitness'], ga.cbest_rchi2['fitness'])
+            np.testing.assert_array_equal(reloaded.cbest_rchi2['ensemble'], ga.cbest_rchi2['ensemble'])
+            np.testing.assert_allclose(reloaded.cbest_rchi2['model'], ga.cbest_rchi2['model'])
+            np.testing.assert_allclose(reloaded.evaluate_bestfit(), ga.evaluate_bestfit())
+            
+            structuredf = pd.DataFrame({'pdb':[f'conf_{nconf}.pdb' for nconf in range(30)],
+                                        'scattering':[f'conf_{nconf}.dat' for nconf in range(30)], 'rg':np.arange(30.0)})
+            reloaded._write_parameterfile("summary_EnsSize{}.csv", structuredf, pfile_path=tmpdir)
+            summary = pd.read_csv(Path(tmpdir)/'summary_EnsSize2.csv')
+            self.assertEqual(summary.shape[0], len(reloaded.itbest_rchi2))
+            np.testing.assert_array_equal(summary['rg_1'], summary['ensemble_index_1'])
+            self.assertTrue(all(summary['PDBNAME_2'] == [f'conf_{nconf}.pdb' for nconf in summary['ensemble_index_2']]))
+            self.assertTrue(np.all(np.diff(summary['chi2']) >= 0))
+            
+            with self.assertRaises(ValueError):
+                gasans.GAEnsembleOpt(library, expdata, **dict(options, ensemble_size=3)).load_results(results_file)
+
+
+class BootstrapBestTest(TestCase):
+
+    def test_intervals_in_the_outputs(self):
+        library, expdata = synthetic_library()
+        ga = gasans.GAEnsembleOpt(library, expdata, ensemble_size=2, fitting_algorithm='Linear Least Squares',
+                                  search_mode='exhaustive', exhaustive_topk=3, parallel=False, random_seed=0, n_bootstrap=100)
+        ga.evolve(dask_client=None)
+        ga.bootstrap_best()
+        self.assertTrue(all(itbest['bootstrap']['params'].shape == (100, 4) for itbest in ga.itbest_rchi2))
+        
+        structuredf = pd.DataFrame({'pdb':[f'conf_{nconf}.pdb' for nconf in range(30)],
+                                    'scattering':[f'conf_{nconf}.dat' for nconf in range(30)]})
+        with tempfile.TemporaryDirectory() as tmpdir:
+            ga._write_parameterfile("summary_EnsSize{}.csv", structuredf, pfile_path=tmpdir)
+            summary = pd.read_csv(Path(tmpdir)/'summary_EnsSize2.csv')
+            self.assertTrue(np.all(summary['w1_low'] <= summary['w1']) and np.all(summary['w1'] <= summary['w1_high']))
+            self.assertTrue(np.all(summary['chi2_low'] < summary['chi2_high']))
+            
+            ga._write_bestmodel(tmpdir)
+            best_model = pd.read_csv(Path(tmpdir)/'best_model_EnsembleSize2.csv', sep=' ')
+            self.assertTrue(np.all(best_model['error'] > 0))
+            self.assertFalse(np.allclose(best_model['error'], 0.04*best_model['intensity']))
+
+    def test_no_bootstrap_by_default(self):
+        library, expdata = synthetic_library()
+        ga = gasans.GAEnsembleOpt(library, expdata, ensemble_size=2, fitting_algorithm='Linear Least Squares',
+                                  search_mode='exhaustive', exhaustive_topk=3, parallel=False)
+        ga.evolve(dask_client=None)
+        self.assertIsNone(ga.bootstrap_best())
+        with tempfile.TemporaryDirectory() as tmpdir:
+            ga._write_bestmodel(tmpdir)
+            best_model = pd.read_csv(Path(tmpdir)/'best_model_EnsembleSize2.csv', sep=' ')
+            np.testing.assert_allclose(best_model['error'], 0.04*best_model['intensity'], rtol=1e-5)
+
+
+class GramIndexTest(TestCase):
+
+    def test_gram_scores_match_library_fits(self):
+        library, expdata = synthetic_library(nconf=40)
+        runs = {}
+        for gram_index in (False, True):
+            ga = gasans.GAEnsembleOpt(library, expdata, ensemble_size=2, number_generations=4, number_iterations=1,
+                                      fitting_algorithm='Linear Least Squares', random_seed=5, gram_index=gram_index)
+            ga.evolve(None)
+            runs[gram_index] = ga
+        np.testing.assert_array_equal(runs[True].cbest_rchi2['ensemble'], runs[False].cbest_rchi2['ensemble'])
+        self.assertAlmostEqual(runs[True].cbest_rchi2['chi2'], runs[False].cbest_rchi2['chi2'], places=6)
+        ## the models are only computed for the bests
+        self.assertTrue(np.all(np.isnan(runs[True].gen_models)))
+        np.testing.assert_allclose(runs[True].cbest_rchi2['model'], runs[False].cbest_rchi2['model'], rtol=1e-6)
+        np.testing.assert_allclose(runs[True].cbest_rchi2['residuals'], runs[False].cbest_rchi2['residuals'], rtol=1e-5, atol=1e-8)
+        
+        with self.assertRaises(ValueError):
+            gasans.GAEnsembleOpt(library, expdata, ensemble_size=2, fitting_algorithm='leastsq', gram_index=True)
+
+    def test_memory_mapped_exhaustive_search(self):
+        library, expdata = synthetic_library(nconf=15)
+        options = dict(ensemble_size=2, number_iterations=1, search_mode='exhaustive', exhaustive_topk=3, parallel=False,
+                       fitting_algorithm='Linear Least Squares')
+        ga = gasans.GAEnsembleOpt(library, expdata, **options)
+        ga.evolve(dask_client=None)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            gram_ga = gasans.GAEnsembleOpt(library, expdata, gram_index=True, gram_index_file=Path(tmpdir)/'gram.npy', **options)
+            gram_ga.evolve(dask_client=None)
+            self.assertIsInstance(gram_ga.gram['gram'], np.memmap)
+            del gram_ga.gram
+        np.testing.assert_array_equal(np.array([itbest['ensemble'] for itbest in gram_ga.itbest_rchi2]),
+                                      np.array([itbest['ensemble'] for itbest in ga.itbest_rchi2]))
+
+
+class IslandModelTest(TestCase):
+
+    def make_ga(self, **kwargs):
+        library, expdata = synthetic_library(nconf=40)
+        return gasans.GAEnsembleOpt(library, expdata, ensemble_size=2, number_generations=4, number_iterations=2,
+                                    fitting_algorithm='Linear Least Squares', batch_evaluation=False, random_seed=3,
+                                    island_model=True, migration_interval=1, n_migrants=2, **kwargs)
+
+    def test_migration_and_island_bests(self):
+        ga = self.make_ga()
+        migrations = []
+        migrate = ga._migrate
+        def recorded_migrate(islands):
+            migrants = [island['gen_parents'][np.argsort(island['gen_fitness'][island['curr_gen']-1, :])[::-1][:2]].copy()
+                        for island in islands]
+            migrate(islands)
+            migrations.append((migrants, [island['children'].copy() for island in islands]))
+        ga._migrate = recorded_migrate
+        with LocalClient('serial') as client:
+            ga.evolve(dask_client=client)
+        
+        self.assertEqual(len(migrations), 3)
+        for migrants, children in migrations:
+            ## ring migration: the fittest of each island are among the children of the next one
+            for nisland in range(2):
+                for migrant in migrants[nisland-1]:
+                    self.assertTrue(np.any(np.all(children[nisland] == migrant, axis=1)))
+        
+        self.assertEqual(len(ga.itbest_rchi2), 2)
+        for itbest in ga.itbest_rchi2:
+            refit = ga._fit_ensembles(np.array([itbest['ensemble']]), None)
+            self.assertAlmostEqual(itbest['chi2'], refit['chi2'][0], places=6)
+        self.assertEqual(ga.cbest_rchi2['chi2'], min(itbest['chi2'] for itbest in ga.itbest_rchi2))
+
+    def test_islands_stop_when_they_agree(self):
+        ga = self.make_ga(iteration_agreement=2)
+        ga.n_gen = 30
+        with LocalClient('serial') as client:
+            ga.evolve(dask_client=client)
+        self.assertTrue(ga.iter_converged)
+        self.assertLess(ga.curr_gen, 30)
+        np.testing.assert_array_equal(np.sort(ga.itbest_rchi2[0]['ensemble']), np.sort(ga.itbest_rchi2[1]['ensemble']))
+
+    def test_warm_start_from_own_island(self):
+        ga = self.make_ga(warm_start=True)
+        ## the children (next parents) of each island and the scales fit in its last generation
+        previous_fits = {}
+        next_generation = ga._next_generation
+        def recorded_generation():
+            next_generation()
+            previous_fits[ga.curr_iter] = ([tuple(np.sort(child)) for child in ga.children],
+                                           set(ga.gen_paramfit.values[0, :].astype(float)))
+        migrate = ga._migrate
+        def recorded_migrate(islands):
+            migrate(islands)
+            for nisland, island in enumerate(islands):
+                previous_fits[nisland] = ([tuple(np.sort(child)) for child in island['children']], previous_fits[nisland][1])
+        ga._next_generation, ga._migrate = recorded_generation, recorded_migrate
+        
+        warm_starts = []
+        fitness_indices = gasans.fitness_indices
+        def recorded_fitness(ensemble, *args, init_params=None, **kwargs):
+            if init_params is not None:
+                island_fits = [fits for parents, fits in previous_fits.values() if tuple(np.sort(ensemble)) in parents][0]
+                warm_starts.append(init_params['c'] in island_fits)
+            return fitness_indices(ensemble, *args, init_params=init_params, **kwargs)
+        with mock.patch.object(gasans, 'fitness_indices', recorded_fitness), LocalClient('serial') as client:
+            ga.evolve(dask_client=client)
+        self.assertGreater(len(warm_starts), 0)
+        self.assertTrue(all(warm_starts))
@@ -0,0 +1,140 @@
+import os
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from unittest import TestCase
+
+import numpy as np
+import pandas as pd
+import scipy.interpolate as scpint
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+import sans_library
+
+
+class InterpolationTest(TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(1)
+        self.model_q = np.linspace(0, 0.5, 501)
+        self.exp_q = np.sort(rng.uniform(0.005, 0.49, 75))
+        self.library = np.vstack([100*np.exp(-np.power(self.model_q*rg, 2)/3.0)
+                                  for rg in rng.uniform(10, 40, 12)]).T
+
+    def test_operator_matches_splines(self):
+        interp = sans_library._interpolate_library(self.library, self.model_q, self.exp_q)
+        splines = np.vstack([scpint.splev(self.exp_q, scpint.splrep(self.model_q, profile, s=0), der=0)
+                             for profile in self.library.T])
+        np.testing.assert_allclose(interp, splines, rtol=1e-8, atol=1e-10)
+
+    def test_operator_cache(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            operator = sans_library._interpolation_operator(self.model_q, self.exp_q, cache_dir=cache_dir)
+            self.assertEqual(len(list(Path(cache_dir).glob('interp_operator_*.npy'))), 1)
+            cached = sans_library._interpolation_operator(self.model_q, self.exp_q, cache_dir=cache_dir)
+            np.testing.assert_array_equal(operator, cached)
+
+    def test_concurrent_memmap_writers(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            library_file = Path(tmpdir)/"library.npy"
+            with ThreadPoolExecutor(max_workers=4) as pool:
+                libraries = list(pool.map(lambda nwriter: np.array(sans_library._interpolate_library_memmap(
+                                              self.library, self.model_q, self.exp_q, library_file, chunk_size=3)), range(8)))
+            expected = sans_library._interpolate_library(self.library, self.model_q, self.exp_q)
+            for library in libraries:
+                np.testing.assert_allclose(library, expected, rtol=1e-5, atol=1e-6)
+            ## every writer moved its own temporary file
+            self.assertEqual(os.listdir(tmpdir), ["library.npy"])
+
+
+class ReadSANSFilesTest(TestCase):
+
+    def write_profile(self, fpath, q, intensity):
+        with open(fpath, mode='w') as sfile:
+            sfile.write("# Pepsi-SANS header\n"*6)
+            for qval, ival in zip(q, intensity):
+                sfile.write(f"{qval:.6e} {ival:.6e}\n")
+
+    def test_read_and_cache(self):
+        q = np.linspace(0, 0.5, 501)
+        with tempfile.TemporaryDirectory() as sans_dir:
+            for nconf in range(4):
+                self.write_profile(f"{sans_dir}/conf{nconf}.dat", q, np.exp(-q*(nconf+1)))
+            ## a profile on a coarser grid is resampled onto the library grid
+            self.write_profile(f"{sans_dir}/coarse.dat", q[::2], np.exp(-q[::2]*5))
+            structure = pd.DataFrame({'PDBNAME':[f"conf{nconf}.pdb" for nconf in range(5)],
+                                      'SCATTERINGFILE':[f"conf{nconf}.dat" for nconf in range(4)]+['coarse.dat']})
+            cache_file = Path(sans_dir)/'library.npy'
+            
+            library = sans_library._read_SANSFiles(sans_dir, structure, n_workers=2, cache_file=cache_file)
+            self.assertEqual(library.shape, (501, 5))
+            self.assertEqual(library.values.dtype, np.float64)
+            np.testing.assert_allclose(library[1].values, np.exp(-q*2), rtol=1e-5)
+            np.testing.assert_allclose(library[4].values, np.exp(-q*5), rtol=1e-4)
+            self.assertTrue(cache_file.exists() and cache_file.with_suffix('.json').exists())
+            
+            ## change one file, only that one is read again
+            self.write_profile(f"{sans_dir}/conf2.dat", q, np.exp(-q*10)+1)
+            os.utime(f"{sans_dir}/conf2.dat", ns=(1, 1))
+            reread = sans_library._read_SANSFiles(sans_dir, structure, cache_file=cache_file)
+            np.testing.assert_allclose(reread[2].values, np.exp(-q*10)+1, rtol=1e-5)
+            np.testing.assert_allclose(reread.drop(columns=2).values, library.drop(columns=2).values)
+
+
+class ClusterProfilesTest(TestCase):
+
+    def test_separated_groups(self):
+        rng = np.random.default_rng(2)
+        q = np.linspace(0.01, 0.4, 50)
+        centers = [100*np.exp(-np.power(q*rg, 2)/3.0) for rg in (10, 25, 40)]
+        profiles = np.vstack([centers[n % 3]*(1 + 0.001*rng.standard_normal(q.shape[0])) for n in range(30)])
+        medoids, labels = sans_library._cluster_profiles(profiles, np.ones(q.shape[0]), 3, rng=np.random.default_rng(0))
+        self.assertEqual(medoids.shape[0], np.unique(labels).shape[0])
+        np.testing.assert_array_equal(labels[medoids], np.arange(medoids.shape[0]))
+        ## members of one group always share a cluster
+        for ngroup in range(3):
+            self.assertEqual(np.unique(labels[ngroup::3]).shape[0], 1)
+
+
+class GramIndexTest(TestCase):
+
+    def test_memmap_matches_memory(self):
+        rng = np.random.default_rng(4)
+        profiles = rng.uniform(1, 2, (25, 40))
+        expected = rng.uniform(1, 2, 40)
+        sigma = rng.uniform(0.01, 0.1, 40)
+        index = sans_library._gram_index(profiles, expected, sigma, chunk_size=7)
+        np.testing.assert_allclose(index['gram'], (profiles/sigma)@(profiles/sigma).T)
+        np.testing.assert_allclose(index['profile_target'], (profiles/sigma)@(expected/sigma))
+        self.assertAlmostEqual(index['flat_flat'], np.sum(np.power(sigma, -2.0)))
+        with tempfile.TemporaryDirectory() as tmpdir:
+            index_file = Path(tmpdir)/"gram.npy"
+            mapped = sans_library._gram_index(profiles, expected, sigma, chunk_size=7, index_file=index_file)
+            self.assertIsInstance(mapped['gram'], np.memmap)
+            np.testing.assert_allclose(mapped['gram'], index['gram'])
+            self.assertEqual(sorted(os.listdir(tmpdir)), ["gram.json", "gram.npy"])
+            del mapped
+
+    def test_index_file_reused_for_same_profiles(self):
+        rng = np.random.default_rng(5)
+        profiles = rng.uniform(1, 2, (25, 40))
+        sigma = rng.uniform(0.01, 0.1, 40)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            index_file = Path(tmpdir)/"gram.npy"
+            first = sans_library._gram_index(profiles, rng.uniform(1, 2, 40), sigma, chunk_size=7, index_file=index_file)
+            written = index_file.stat().st_mtime_ns
+            del first
+            
+            ## another experiment with the same errors: the gram matrix is read back, the vectors are new
+            expected = rng.uniform(1, 2, 40)
+            reused = sans_library._gram_index(profiles, expected, sigma, chunk_size=7, index_file=index_file)
+            self.assertEqual(index_file.stat().st_mtime_ns, written)
+            np.testing.assert_allclose(reused['profile_target'], (profiles/sigma)@(expected/sigma))
+            del reused
+            
+            other_sigma = 2*sigma
+            rebuilt = sans_library._gram_index(profiles, expected, other_sigma, chunk_size=7, index_file=index_file)
+            np.testing.assert_allclose(rebuilt['gram'], (profiles/other_sigma)@(profiles/other_sigma).T)
+            self.assertEqual(sorted(os.listdir(tmpdir)), ["gram.json", "gram.npy"])
+            del rebuilt